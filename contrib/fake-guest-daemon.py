@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Memory Overcommitment Manager
+# Copyright (C) 2011 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Serve made up guest statistics to the GuestNetworkDaemon Collector, for
+# load testing without guests.  Run it as the name-to-ip-helper of the
+# Collector as well, with the guest name as the only argument, to give every
+# guest its own loopback address:
+#
+#   [Collector: GuestNetworkDaemon]
+#   name-to-ip-helper: /path/to/fake-guest-daemon.py
+
+import hashlib
+import logging
+import signal
+from optparse import OptionParser
+from mom.Collectors.GuestNetworkDaemon import _FakeServer
+
+
+def guest_ip(name):
+    digest = hashlib.md5(name).digest()
+    return "127.%i.%i.%i" % (ord(digest[0]), ord(digest[1]),
+                             max(1, ord(digest[2])))
+
+
+def main():
+    usage = "usage: %prog [options] | %prog <guest name>"
+    parser = OptionParser(usage)
+    parser.add_option('-a', '--address', dest='address', default='0.0.0.0',
+                      help='Listen on ADDRESS [%default]')
+    parser.add_option('-p', '--port', dest='port', type='int', default=2187,
+                      help='Listen on PORT [%default]')
+    parser.add_option('-d', '--delay', dest='delay', type='float', default=0,
+                      help='Answer after DELAY seconds [%default]')
+    (options, args) = parser.parse_args()
+
+    if len(args) == 1:
+        print guest_ip(args[0])
+        return
+    elif args:
+        parser.error("Too many arguments")
+
+    logging.basicConfig(level=logging.INFO)
+    server = _FakeServer(options.address, options.port, options.delay)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,20 @@ def getActiveGuests(mom):
     for guest in guests:
         print guest
 
+def getPolicyProfile(mom):
+    profile = mom.getPolicyProfile()
+    for section in ('expressions', 'functions', 'builtins'):
+        entries = sorted(profile[section].items(),
+                         key=lambda (name, entry): entry['time'], reverse=True)
+        print "%s:\n%s" % (section.capitalize(), '=' * (len(section) + 1))
+        for (name, entry) in entries:
+            print "%10.6f s %8i calls  %s" % (entry['time'], entry['calls'],
+                                              name)
+        print
+
+def resetPolicyProfile(mom):
+    mom.resetPolicyProfile()
+
 def usage(parser):
     parser.usageExit()
 
@@ -86,6 +100,10 @@ def main():
                     const='get_statistics', help='(No arguments) Get the latest host and guest statistics')
     cmds.add_option('--get-active-guests', dest='cmd', action='append_const',
                     const='get_active_guests', help='(No arguments) Get a list of guests that are being actively managed')
+    cmds.add_option('--get-policy-profile', dest='cmd', action='append_const',
+                    const='get_policy_profile', help='(No arguments) Print where the time evaluating the policy goes')
+    cmds.add_option('--reset-policy-profile', dest='cmd', action='append_const',
+                    const='reset_policy_profile', help='(No arguments) Reset the policy profile')
     parser.add_option_group(cmds)
     (options, args) = parser.parse_args()
 
@@ -110,6 +128,10 @@ def main():
             getStatistics(mom)
         elif options.cmd[0] == 'get_active_guests':
             getActiveGuests(mom)
+        elif options.cmd[0] == 'get_policy_profile':
+            getPolicyProfile(mom)
+        elif options.cmd[0] == 'reset_policy_profile':
+            resetPolicyProfile(mom)
     except Exception, e:
         print "Command '%s' failed: %s" % (options.cmd[0], e)
         sys.exit(1)
@@ -0,0 +1,350 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import fcntl
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import select
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from mom.Collectors import Collector
+from mom.Statistics import monotonic
+
+
+class _Collection(object):
+    """
+    A collection of the data of a Monitor in progress
+    """
+    def __init__(self, monitor, schema, due, seq, interval):
+        self.monitor = monitor
+        self.schema = schema
+        self.due = due
+        self.seq = seq
+        self.interval = interval
+        # (collector, result of Monitor._call()) in the order of the
+        # collectors
+        self.results = [(c, None) for c in schema.collectors]
+        # The collectors which did not complete or time out yet
+        self.pending = len(self.results)
+        # The collectors still running in the pool, timed out or not
+        self.running = 0
+        # Set once the results are merged into the Monitor
+        self.merged = False
+
+
+class _Task(object):
+    """
+    The call of one collector in a collection
+    """
+    def __init__(self, collection, index, deadline):
+        self.collection = collection
+        self.index = index
+        self.deadline = deadline
+        # The generator of an AsyncCollector, and the file descriptor it
+        # waits for
+        self.coroutine = None
+        self.fd = None
+        self.done = False
+
+
+class CollectionEngine(object):
+    """
+    Collect the data of many Monitors in an event loop, so that the
+    collections waiting for I/O overlap in a single thread.  AsyncCollectors
+    run in the loop, the other Collectors in a pool of 'workers' threads.
+    The Monitors are scheduled the same way as by a CollectionScheduler.
+
+    A collector which does not complete within its 'timeout' attribute, or
+    the interval of its Monitor if it has none, counts as a CollectionError.
+    Collectors running in the pool cannot be interrupted, their Monitor is
+    only collected again once they return.  The coroutines of the
+    AsyncCollectors must each wait for a different file.
+    """
+    def __init__(self, workers, name='CollectionEngine'):
+        self.logger = logging.getLogger('mom.CollectionEngine')
+        # Guards the data shared with other threads: added, completed,
+        # monitors and busy
+        self.lock = threading.Lock()
+        # (monitor, interval) added since the loop last looked
+        self.added = []
+        # (task, result) of the collectors which returned in the pool
+        self.completed = deque()
+        # The Monitors scheduled, until they stop running
+        self.monitors = set()
+        # The time the loop spent working since 'since'
+        self.busy = 0.0
+        self.since = monotonic()
+
+        # Owned by the loop: (due time, sequence number, monitor, interval)
+        # of the Monitors waiting for their next collection, (deadline,
+        # sequence number, task) of the tasks started, and the tasks waiting
+        # for each file descriptor
+        self.heap = []
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.waiting = {}
+
+        self.pool = ThreadPool(workers)
+        self.poller = select.poll()
+        # Other threads write to the pipe to wake the loop up
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_fds[0], select.POLLIN)
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add(self, monitor, interval):
+        """
+        Collect the data of 'monitor' every 'interval' seconds until it stops
+        running, see Monitor._should_run()
+        """
+        with self.lock:
+            self.monitors.add(monitor)
+            self.added.append((monitor, interval))
+        self._wakeup()
+
+    def scheduled(self, monitor):
+        return monitor in self.monitors
+
+    def utilization(self):
+        """
+        Return the fraction of the time the event loop spent working since
+        the last call, as a list like CollectionScheduler.utilization()
+        """
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.since
+            busy = self.busy
+            self.busy = 0.0
+            self.since = now
+        if elapsed <= 0:
+            return [0.0]
+        return [min(1.0, busy / elapsed)]
+
+    def shutdown(self, timeout=None):
+        """
+        Stop the event loop and the pool, abandoning the collections in
+        progress
+        """
+        self.running = False
+        self._wakeup()
+        self.thread.join(timeout)
+        self.pool.terminate()
+        for fd in self.wakeup_fds:
+            os.close(fd)
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_fds[1], 'x')
+        except OSError, e:
+            # The loop has been woken up already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _loop(self):
+        try:
+            while self.running:
+                events = self.poller.poll(self._poll_timeout())
+                start = monotonic()
+                for fd, event in events:
+                    if fd == self.wakeup_fds[0]:
+                        self._drain()
+                    elif fd in self.waiting:
+                        self._step(self.waiting[fd])
+                self._complete()
+                now = monotonic()
+                self._expire(now)
+                self._start_due(now)
+                with self.lock:
+                    self.busy += monotonic() - start
+        except Exception:
+            self.logger.error("Collection engine crashed", exc_info=True)
+        finally:
+            for task in self.waiting.values():
+                task.coroutine.close()
+
+    def _poll_timeout(self):
+        """
+        Return the time until the next collection or deadline is due, in
+        milliseconds as expected by poll(), or None if nothing is due
+        """
+        due = []
+        if self.heap:
+            due.append(self.heap[0][0])
+        if self.deadlines:
+            due.append(self.deadlines[0][0])
+        if not due:
+            return None
+        return max(0, int((min(due) - monotonic()) * 1000) + 1)
+
+    def _drain(self):
+        try:
+            while os.read(self.wakeup_fds[0], 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        with self.lock:
+            added = self.added
+            self.added = []
+        now = monotonic()
+        for monitor, interval in added:
+            # Spread the Monitors added together over the interval
+            due = now + random.uniform(0, interval)
+            heapq.heappush(self.heap,
+                           (due, next(self.sequence), monitor, interval))
+
+    def _start_due(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, monitor, interval = heapq.heappop(self.heap)
+            if not monitor._should_run():
+                self._drop(monitor, "%s ending")
+                continue
+            try:
+                schema = monitor._schema()
+            except Exception:
+                self.logger.error("%s crashed", monitor.name, exc_info=True)
+                self._drop(monitor)
+                continue
+            collection = _Collection(monitor, schema, due, seq, interval)
+            if not schema.collectors:
+                self._finish(collection)
+            for index, c in enumerate(schema.collectors):
+                timeout = getattr(c, 'timeout', interval)
+                task = _Task(collection, index, now + timeout)
+                heapq.heappush(self.deadlines,
+                               (task.deadline, next(self.sequence), task))
+                if isinstance(c, Collector.AsyncCollector):
+                    task.coroutine = c.collect_async()
+                    self._step(task)
+                else:
+                    collection.running += 1
+                    self.pool.apply_async(
+                        monitor._call, (c,),
+                        callback=functools.partial(self._completed, task))
+
+    def _step(self, task):
+        """
+        Resume the coroutine of a task until it waits or completes
+        """
+        if task.fd is not None:
+            self.poller.unregister(task.fd)
+            del self.waiting[task.fd]
+            task.fd = None
+        try:
+            item = next(task.coroutine)
+        except StopIteration:
+            self._done(task, None)
+            return
+        except (Collector.CollectionError, Collector.FatalError), e:
+            self._done(task, e)
+            return
+        except Exception:
+            task.collection.monitor.logger.exception(
+                "Unexpected collection error")
+            self._done(task, None)
+            return
+        if type(item) is not tuple:
+            self._done(task, item)
+            return
+        fd, event = item
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        task.fd = fd
+        self.waiting[fd] = task
+        self.poller.register(fd, event)
+
+    def _completed(self, task, result):
+        """
+        Called in the pool when a collector returns
+        """
+        with self.lock:
+            self.completed.append((task, result))
+        self._wakeup()
+
+    def _complete(self):
+        while True:
+            with self.lock:
+                if not self.completed:
+                    return
+                task, result = self.completed.popleft()
+            collection = task.collection
+            collection.running -= 1
+            if task.done:
+                # Timed out, the collection may have been waiting for it
+                if collection.merged and collection.running == 0:
+                    self._reschedule(collection)
+            else:
+                self._done(task, result)
+
+    def _expire(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, seq, task = heapq.heappop(self.deadlines)
+            if not task.done:
+                c = task.collection.schema.collectors[task.index]
+                self._done(task, Collector.CollectionError(
+                    "Collector %s timed out" % str(c)))
+
+    def _done(self, task, result):
+        if task.done:
+            return
+        task.done = True
+        if task.coroutine is not None:
+            if task.fd is not None:
+                self.poller.unregister(task.fd)
+                del self.waiting[task.fd]
+                task.fd = None
+            task.coroutine.close()
+        collection = task.collection
+        c = collection.results[task.index][0]
+        collection.results[task.index] = (c, result)
+        collection.pending -= 1
+        if collection.pending == 0:
+            self._finish(collection)
+
+    def _finish(self, collection):
+        monitor = collection.monitor
+        try:
+            monitor._merge(collection.schema, collection.results)
+        except Exception:
+            self.logger.error("%s crashed", monitor.name, exc_info=True)
+            self._drop(monitor)
+            return
+        collection.merged = True
+        if collection.running == 0:
+            self._reschedule(collection)
+
+    def _reschedule(self, collection):
+        # Collections which are late are skipped, not made up for
+        due = max(collection.due + collection.interval, monotonic())
+        heapq.heappush(self.heap, (due, collection.seq, collection.monitor,
+                                   collection.interval))
+
+    def _drop(self, monitor, message=None):
+        if message is not None:
+            self.logger.info(message, monitor.name)
+        with self.lock:
+            self.monitors.discard(monitor)
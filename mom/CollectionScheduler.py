@@ -0,0 +1,143 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+from mom.Statistics import monotonic
+
+
+class CollectionScheduler(object):
+    """
+    Collect the data of many Monitors with a fixed number of worker threads
+    rather than a thread per Monitor.  The Monitors are kept in a heap by the
+    time their next collection is due.  A Monitor is collected by a single
+    worker at a time, every 'interval' seconds counted from its first
+    collection so that the intervals do not drift, and the first collections
+    are spread over an interval so that Monitors added together are not
+    collected together.
+    """
+    def __init__(self, workers, name='CollectionScheduler'):
+        self.logger = logging.getLogger('mom.CollectionScheduler')
+        self.cond = threading.Condition()
+        # (due time, sequence number, monitor, interval)
+        self.heap = []
+        self.sequence = itertools.count()
+        # The Monitors scheduled, until they stop running
+        self.monitors = set()
+        # The time spent collecting by each worker since 'since'
+        self.busy = [0.0] * workers
+        self.since = monotonic()
+        self.running = True
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, args=(i,),
+                                      name='%s-%i' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, monitor, interval):
+        """
+        Collect the data of 'monitor' every 'interval' seconds until it stops
+        running, see Monitor._should_run()
+        """
+        due = monotonic() + random.uniform(0, interval)
+        with self.cond:
+            self.monitors.add(monitor)
+            heapq.heappush(self.heap,
+                           (due, next(self.sequence), monitor, interval))
+            self.cond.notify()
+
+    def scheduled(self, monitor):
+        return monitor in self.monitors
+
+    def _next(self):
+        """
+        Wait for the next Monitor due for collection.
+        Return: Its heap entry, or None once the scheduler is shut down
+        """
+        with self.cond:
+            while self.running:
+                now = monotonic()
+                if self.heap and self.heap[0][0] <= now:
+                    return heapq.heappop(self.heap)
+                if self.heap:
+                    self.cond.wait(self.heap[0][0] - now)
+                else:
+                    self.cond.wait()
+            return None
+
+    def _work(self, worker):
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            due, seq, monitor, interval = entry
+            if not monitor._should_run():
+                self._drop(monitor, "%s ending")
+                continue
+            start = monotonic()
+            try:
+                monitor.collect()
+            except Exception:
+                self.logger.error("%s crashed", monitor.name, exc_info=True)
+                self._drop(monitor)
+                continue
+            finally:
+                end = monotonic()
+                with self.cond:
+                    self.busy[worker] += end - start
+            # Collections which are late are skipped, not made up for
+            due += interval
+            if due < end:
+                due = end
+            with self.cond:
+                heapq.heappush(self.heap, (due, seq, monitor, interval))
+                self.cond.notify()
+
+    def _drop(self, monitor, message=None):
+        if message is not None:
+            self.logger.info(message, monitor.name)
+        with self.cond:
+            self.monitors.discard(monitor)
+
+    def utilization(self):
+        """
+        Return the fraction of the time each worker spent collecting since
+        the last call
+        """
+        with self.cond:
+            now = monotonic()
+            elapsed = now - self.since
+            busy = self.busy
+            self.busy = [0.0] * len(busy)
+            self.since = now
+        if elapsed <= 0:
+            return [0.0] * len(busy)
+        return [min(1.0, seconds / elapsed) for seconds in busy]
+
+    def shutdown(self, timeout=None):
+        """
+        Stop the workers once they are done with the current collections
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
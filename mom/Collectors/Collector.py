@@ -15,7 +15,9 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import re
+import select
 import sys
+import time
 import logging
 
 class Collector:
@@ -59,6 +61,55 @@ class Collector:
         """
         return set()
 
+# Events an AsyncCollector may wait for
+READ = select.POLLIN
+WRITE = select.POLLOUT
+
+class AsyncCollector(Collector):
+    """
+    A Collector which spends most of its time waiting for I/O, so that an
+    event loop can overlap the collections of many Monitors, see
+    CollectionEngine.  Its collect_async() method is a generator which yields
+    (file, event) to wait until 'file' (a file descriptor or any object with
+    a fileno() method) is ready for READ or WRITE, and yields the dictionary
+    of statistics last.  A collection taking longer than 'timeout' seconds
+    fails with a CollectionError.
+
+    The collect() method waits for the events itself, so asynchronous
+    Collectors also work without an event loop.
+    """
+    timeout = 5
+
+    def collect(self):
+        return run_async(self.collect_async(), self.timeout)
+
+    def collect_async(self):
+        """
+        The asynchronous interface of the Collector, see above.
+        Override this method when creating new asynchronous collectors.
+        """
+        yield {}
+
+def run_async(coroutine, timeout):
+    """
+    Run the collect_async() generator of an AsyncCollector, blocking while
+    it waits.
+    Return: The statistics it yields last, or None if it yields none
+    """
+    deadline = time.time() + timeout
+    try:
+        for item in coroutine:
+            if type(item) is not tuple:
+                return item
+            poller = select.poll()
+            poller.register(*item)
+            remaining = deadline - time.time()
+            if remaining <= 0 or not poller.poll(remaining * 1000):
+                raise CollectionError("Timed out after %s seconds" % timeout)
+        return None
+    finally:
+        coroutine.close()
+
 
 def get_collectors(config_str, properties, global_config):
     """
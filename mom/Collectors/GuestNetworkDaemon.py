@@ -14,9 +14,14 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import errno
+import heapq
+import os
+import select
 import sys
 import signal
 import socket
+import time
 from subprocess import *
 import ConfigParser
 import logging
@@ -57,6 +62,53 @@ def sock_receive(conn, logger=None):
     else:
         return msg.rstrip("\n")
 
+def async_send(conn, msg):
+    """
+    Send a message via a non-blocking socket connection, waiting as an
+    AsyncCollector does.  '\n' marks the end of the message.
+    """
+    msg = msg + "\n"
+    sent = 0
+    while sent < len(msg):
+        try:
+            ret = conn.send(msg[sent:])
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            yield (conn, WRITE)
+            continue
+        if ret == 0:
+            raise socket.error("Unable to send on socket")
+        sent = sent + ret
+
+def async_receive(conn, reply, logger=None):
+    """
+    Receive a '\n' terminated message via a non-blocking socket connection,
+    waiting as an AsyncCollector does.  The message is appended to 'reply'.
+    """
+    msg = ""
+    done = False
+    if logger:
+        logger.debug('async_receive(%s)' % conn)
+    while not done:
+        try:
+            chunk = conn.recv(4096)
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            yield (conn, READ)
+            continue
+        if logger:
+            logger.debug("async_receive: received next chunk: %s" % repr(chunk))
+        if chunk == '':
+            done = True
+        msg = msg + chunk
+        if msg[-1:] == '\n':
+            done = True
+    if len(msg) == 0:
+        raise socket.error("Unable to receive on socket")
+    reply.append(msg.rstrip("\n"))
+
 def sock_close(sock):
     try:
         sock.shutdown(socket.SHUT_RDWR)
@@ -64,7 +116,7 @@ def sock_close(sock):
     except socket.error:
         pass
 
-class GuestNetworkDaemon(Collector):
+class GuestNetworkDaemon(AsyncCollector):
     """
     A guest memory stats Collector implemented over a socket connection.  Any
     data can be passed but the following stats are implemented:
@@ -80,7 +132,10 @@ class GuestNetworkDaemon(Collector):
         self.logger = logging.getLogger('mom.Collectors.GuestNetworkDaemon')
         self.name = properties['name']
         self.ip = self.get_guest_ip(properties)
-        self.port = 2187              # XXX: This needs to be configurable
+        try:
+            self.port = int(properties['config']['port'])
+        except KeyError:
+            self.port = 2187
         self.socket = None
         self.state = 'ok'
 
@@ -113,34 +168,57 @@ class GuestNetworkDaemon(Collector):
             return ip
 
     def connect(self):
+        """
+        Connect to the guest without blocking, waiting as an AsyncCollector
+        does
+        """
+        connected = False
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(5)
-            self.socket.connect((self.ip, self.port))
+            self.socket.setblocking(0)
+            err = self.socket.connect_ex((self.ip, self.port))
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                yield (self.socket, WRITE)
+                err = self.socket.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            connected = True
         except socket.error, msg:
-            sock_close(self.socket)
-            self.socket = None
             raise CollectionError('Network connection to %s failed: %s' %
                                   (self.name, msg))
+        finally:
+            # Also when the collection times out
+            if not connected:
+                sock_close(self.socket)
+                self.socket = None
 
-    def collect(self):
+    def collect_async(self):
         if self.state == 'dead':
-            return {}
+            yield {}
+            return
         if self.ip is None:
             self.state = 'dead'
             raise CollectionError('No IP address for guest %s' % self.name)
 
-        data = ""
         if self.socket is None:
-            self.connect()
+            for wait in self.connect():
+                yield wait
+        reply = []
         try:
-            sock_send(self.socket, "stats")
-            data = sock_receive(self.socket, self.logger)
+            for wait in async_send(self.socket, "stats"):
+                yield wait
+            for wait in async_receive(self.socket, reply, self.logger):
+                yield wait
         except socket.error, msg:
-            sock_close(self.socket)
-            self.socket = None
             raise CollectionError('Network communication to %s failed: %s' %
                                   (self.name, msg))
+        finally:
+            # Also when the collection times out
+            if not reply:
+                sock_close(self.socket)
+                self.socket = None
+        data = reply[0]
 
         self.state = 'ok'
 
@@ -155,7 +233,7 @@ class GuestNetworkDaemon(Collector):
         for key in self.getFields():
             if key in result:
                 ret[key] = result[key]
-        return ret
+        yield ret
 
     def getFields(self=None):
         return set(['mem_available', 'mem_unused', 'major_fault', 'minor_fault',
@@ -234,3 +312,97 @@ class _Server:
             self.session(conn, addr)
         sock_close(self.socket)
 
+
+class _FakeServer:
+    """
+    A stand-in for the guest side of the guest network Collector, which
+    serves made up statistics to any number of connections from a single
+    thread, after 'delay' seconds.  Used to load test the collection of many
+    guests without running them: bound to 0.0.0.0 it answers for every
+    loopback address, which a name-to-ip-helper can give to the guests.
+    """
+    def __init__(self, listen_ip='127.0.0.1', listen_port=2187, delay=0):
+        self.logger = logging.getLogger('mom.Collectors.GuestNetworkDaemon.FakeServer')
+        self.delay = delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((listen_ip, listen_port))
+        self.socket.listen(128)
+        self.socket.setblocking(0)
+        self.port = self.socket.getsockname()[1]
+        self.running = False
+        # Connections by file descriptor, with the data received from them
+        self.conns = {}
+        # (time, file descriptor, response) of the responses to send
+        self.replies = []
+        self.requests = 0
+
+    def stats(self):
+        self.requests += 1
+        return "mem_available:2097152,mem_unused:524288,swap_in:0," \
+               "swap_out:0,major_fault:%i,minor_fault:%i" % \
+               (self.requests, self.requests * 10)
+
+    def _accept(self, poller):
+        try:
+            conn, addr = self.socket.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        self.conns[conn.fileno()] = [conn, ""]
+        poller.register(conn.fileno(), select.POLLIN)
+
+    def _close(self, poller, fd):
+        poller.unregister(fd)
+        sock_close(self.conns.pop(fd)[0])
+
+    def _receive(self, poller, fd):
+        entry = self.conns[fd]
+        try:
+            chunk = entry[0].recv(4096)
+        except socket.error:
+            chunk = ''
+        if chunk == '':
+            self._close(poller, fd)
+            return
+        entry[1] += chunk
+        while '\n' in entry[1]:
+            cmd, entry[1] = entry[1].split('\n', 1)
+            if cmd == "stats":
+                response = self.stats()
+            elif cmd == "props":
+                response = "min_free:0.20,max_free:0.50"
+            else:
+                self._close(poller, fd)
+                return
+            heapq.heappush(self.replies,
+                           (time.time() + self.delay, fd, response))
+
+    def run(self):
+        self.logger.info("Fake server starting on port %i", self.port)
+        self.running = True
+        poller = select.poll()
+        poller.register(self.socket.fileno(), select.POLLIN)
+        while self.running:
+            timeout = 100
+            if self.replies:
+                timeout = min(timeout, max(0, (self.replies[0][0] -
+                                               time.time()) * 1000))
+            for fd, event in poller.poll(timeout):
+                if fd == self.socket.fileno():
+                    self._accept(poller)
+                elif fd in self.conns:
+                    self._receive(poller, fd)
+            while self.replies and self.replies[0][0] <= time.time():
+                when, fd, response = heapq.heappop(self.replies)
+                if fd in self.conns:
+                    try:
+                        sock_send(self.conns[fd][0], response)
+                    except socket.error:
+                        self._close(poller, fd)
+        for fd in self.conns.keys():
+            self._close(poller, fd)
+        sock_close(self.socket)
+
+    def stop(self):
+        self.running = False
@@ -17,6 +17,7 @@
 import os
 from subprocess import *
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcessIndex import get_process_index
 
 class HostKSM(Collector):
     """
@@ -41,6 +42,7 @@ class HostKSM(Collector):
     def __init__(self, properties):
         self.open_files()
         self.interval = properties['interval']
+        self.processes = get_process_index()
         self.pid = self._get_ksmd_pid()
         self.last_jiff = self.get_ksmd_jiffies()
 
@@ -91,18 +93,11 @@ class HostKSM(Collector):
         Estimate how much memory has been reported to KSM for potential sharing.
         We assume that qemu is reporting guest physical memory areas to KSM.
         """
-        try:
-            p1 = Popen(["pgrep", "qemu"], stdout=PIPE).communicate()[0]
-        except OSError:
-            raise CollectionError("HostKSM: Unable to execute pgrep")
-        pids = p1.split()
-        if len(pids) == 0:
-            return 0
-        ps_argv = ["ps", "-ovsz", "h"] + pids
-        p1 = Popen(ps_argv, stdout=PIPE).communicate()[0]
         mem_tot = 0
-        for mem in p1.split():
-            mem_tot = mem_tot + int(mem)
+        for pid in self.processes.find_name('qemu'):
+            mem = self.processes.vsz(pid)
+            if mem is not None:
+                mem_tot = mem_tot + mem
         return mem_tot
 
     def collect(self):
@@ -0,0 +1,152 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import threading
+
+
+class ProcessIndex(object):
+    """
+    An index of the command lines of the processes running on the host, read
+    from /proc rather than by running ps or pgrep.  Every lookup lists the
+    process ids again but only reads the command lines of the processes
+    which were not indexed yet, and again on the next lookup in case they
+    were indexed between fork() and exec().  The pid found for a uuid is
+    remembered as long as its command line still holds the uuid, and the
+    processes matching a uuid are read again in case their pid was reused.
+
+    The index is shared by the threads of MOM, see get_process_index().
+    """
+    def __init__(self, root='/proc'):
+        self.root = root
+        self.lock = threading.Lock()
+        # The arguments of every process, by pid.  Kernel threads have none.
+        self.cmdlines = {}
+        # The processes indexed by the last refresh
+        self.young = set()
+        self.uuids = {}
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+
+    def _read(self, pid, name):
+        try:
+            with open('%s/%i/%s' % (self.root, pid, name), 'r') as f:
+                return f.read()
+        except (IOError, OSError):
+            # The process exited
+            return None
+
+    def _cmdline(self, pid):
+        data = self._read(pid, 'cmdline')
+        if data is None:
+            return None
+        return data.rstrip('\0').split('\0') if data else []
+
+    def refresh(self):
+        """
+        Index the processes started since the last refresh and forget the
+        ones which exited.  Must be called with the lock held.
+        """
+        try:
+            pids = set(int(name) for name in os.listdir(self.root)
+                       if name.isdigit())
+        except OSError:
+            pids = set()
+        for pid in set(self.cmdlines) - pids:
+            del self.cmdlines[pid]
+        for uuid, pid in self.uuids.items():
+            if pid not in pids:
+                del self.uuids[uuid]
+        new = pids - set(self.cmdlines)
+        for pid in new | (self.young & pids):
+            cmdline = self._cmdline(pid)
+            if cmdline is not None:
+                self.cmdlines[pid] = cmdline
+            else:
+                self.cmdlines.pop(pid, None)
+        self.young = new
+
+    def find_uuid(self, uuid):
+        """
+        Find the processes having 'uuid' in their command line, like the
+        qemu process of a guest.
+        Return: The list of their pids
+        """
+        with self.lock:
+            pid = self.uuids.get(uuid)
+            if pid is not None and self._match_uuid(uuid, [pid]):
+                return [pid]
+            self.refresh()
+            pids = self._match_uuid(uuid)
+            if len(pids) == 1:
+                self.uuids[uuid] = pids[0]
+            else:
+                self.uuids.pop(uuid, None)
+            return pids
+
+    def _match_uuid(self, uuid, pids=None):
+        """
+        Return: The pids, of the ones given or of all the processes indexed,
+                whose command line holds 'uuid' once read again
+        """
+        if pids is None:
+            pids = [pid for pid, cmdline in self.cmdlines.items()
+                    if uuid in ' '.join(cmdline)]
+        matches = []
+        for pid in pids:
+            cmdline = self._cmdline(pid)
+            if cmdline is None:
+                self.cmdlines.pop(pid, None)
+                continue
+            self.cmdlines[pid] = cmdline
+            if uuid in ' '.join(cmdline):
+                matches.append(pid)
+        return sorted(matches)
+
+    def find_name(self, name):
+        """
+        Find the processes whose program name contains 'name', like
+        'pgrep name' does
+        Return: The list of their pids
+        """
+        with self.lock:
+            self.refresh()
+            return sorted(pid for pid, cmdline in self.cmdlines.items()
+                          if cmdline and name in os.path.basename(cmdline[0]))
+
+    def vsz(self, pid):
+        """
+        Return: The virtual memory size of a process in kB, or None if it
+                exited
+        """
+        data = self._read(pid, 'statm')
+        if not data:
+            return None
+        return int(data.split()[0]) * self.page_kb
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_process_index():
+    """
+    Return: The ProcessIndex of the host, created on first use
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ProcessIndex()
+        return _index
@@ -16,33 +16,68 @@
 
 import logging
 import math
+from mom.Statistics import Statistics
+
+# Returned by Statistics.latest() for missing fields
+_MISSING = object()
 
 class EntityError(Exception):
     def __init__(self, message):
         self.message = message
 
-class Entity:
+class Entity(object):
     """
     An entity is an object that is designed to be inserted into the rule-
     processing namespace.  The properties and statistics elements allow it to
     contain a snapshot of Monitor data that can be used as inputs to rules.  The
     rule-accessible methods provide a simple syntax for referencing data.
     """
+    __slots__ = ('properties', 'variables', 'statistics', 'controls',
+                 'monitor', '_borrowed', '_fields')
+
+    logger = logging.getLogger('mom.Entity')
+
     def __init__(self, monitor=None):
         self.properties = {}
         self.variables = {}
-        self.statistics = []
+        self.statistics = Statistics()
         self.controls = {}
         self.monitor = monitor
-        self.logger = logging.getLogger('mom.Entity')
+        # Names of the dictionaries shared with the Monitor, see _share()
+        self._borrowed = set()
+        # Statistics readable as attributes, shared by all the Entities of a
+        # Monitor, see _finalize()
+        self._fields = frozenset()
+
+    def _own(self, name):
+        """
+        Return the dictionary 'name', copied first if it is shared
+        """
+        if name in self._borrowed:
+            setattr(self, name, dict(getattr(self, name)))
+            self._borrowed.discard(name)
+        return getattr(self, name)
+
+    def _share(self, properties, variables, statistics):
+        """
+        Use the data of a Monitor without copying it: the dictionaries are
+        only copied before they are changed, and statistics are a snapshot.
+        """
+        self.properties = properties
+        self.variables = variables
+        self.statistics = statistics
+        self._borrowed = set(['properties', 'variables'])
 
     def _set_property(self, name, val):
-        self.properties[name] = val
+        self._own('properties')[name] = val
 
     def _set_variable(self, name, val):
-        self.variables[name] = val
+        self._own('variables')[name] = val
 
     def _set_statistics(self, stats):
+        if isinstance(stats, Statistics):
+            self.statistics = stats.snapshot()
+            return
         for row in stats:
             self.statistics.append(row)
 
@@ -58,14 +93,27 @@ class Entity:
         Once all data has been added to the Entity, perform any extra processing
         """
         # Add the most-recent stats to the top-level namespace for easy access
-        # from within rules scripts.
-        if len(self.statistics) > 0:
+        # from within rules scripts.  They are read when they are used, see
+        # __getattr__().  Entities without a Monitor show all of them.
+        if self.monitor is None:
+            self._fields = frozenset(self.statistics.columns)
+            return
+        self._fields = self.monitor.field_index
+        if self.monitor.logger.isEnabledFor(logging.DEBUG) and \
+                len(self.statistics) > 0:
             for stat in self.statistics[-1].keys():
-                if stat in self.monitor.valid_fields:
-                    setattr(self, stat, self.statistics[-1][stat])
-                else:
+                if stat not in self._fields:
                     self.monitor.logger.debug("Field '%s' not known. Ignoring." % stat)
 
+    def __getattr__(self, name):
+        # Only called for attributes which are not found otherwise, including
+        # the slots not set yet
+        if name not in Entity.__slots__ and name in self._fields:
+            value = self.statistics.latest(name, _MISSING)
+            if value is not _MISSING:
+                return value
+        raise AttributeError(name)
+
     def _disp(self, name=''):
         """
         Debugging function to display the structure of an Entity.
@@ -101,7 +149,7 @@ class Entity:
         #    raise KeyError("Field '%s' is not declared in any collector." % name)
 
         if len(self.statistics) > 0:
-            return self.statistics[-1].get(name, default)
+            return self.statistics.latest(name, default)
         else:
             return None
 
@@ -115,39 +163,102 @@ class Entity:
         if (len(self.statistics) == 0):
             raise EntityError("Statistic '%s' not available" % name)
 
-        total = 0
-        nonEmptyStats = [x for x in self.statistics \
-                         if x.get(name, None) is not None]
-        for row in nonEmptyStats:
-            total = total + row[name]
-        if (len(nonEmptyStats) == 0):
+        count, total = self.statistics.total(name)
+        if (count == 0):
             return float(0)
         else:
-            return float(total / len(nonEmptyStats))
+            return float(total / count)
+
     def StatStdDeviation(self, name):
         """
         Calculate standart deviation of all values in statistic-stack.
         If there is not such name of statistic in past snapshot, return None.
         """
-        vals = []
-        for row in self.statistics:
-            if name in row:
-                vals.append(row[name])
+        variance = self.statistics.variance(name)
+        if variance is None:
+            return None
+        return math.sqrt(variance)
+
+    def StatMin(self, name):
+        """
+        Get the lowest recent value of a statistic, or None if there is none.
+        """
+        return self.statistics.minimum(name)
 
-        if not vals:
+    def StatMax(self, name):
+        """
+        Get the highest recent value of a statistic, or None if there is none.
+        """
+        return self.statistics.maximum(name)
+
+    def StatAvgWindow(self, name, seconds):
+        """
+        Calculate the average value of a statistic over the samples collected
+        in the last 'seconds' seconds before the latest one.  Returns None if
+        there is no such value.
+        """
+        values = [value for time, value
+                  in self.statistics.window(name, seconds)]
+        if not values:
+            return None
+        return float(sum(values)) / len(values)
+
+    def StatAvgTier(self, name, tier):
+        """
+        Calculate the average value of a statistic over the periods kept in
+        the rollup tier of 'tier' seconds, see the history-tiers option.
+        Returns None if there is no such value.
+        """
+        try:
+            summaries = self.statistics.rollup(name, tier)
+        except KeyError:
+            raise EntityError("No history tier of %s seconds" % tier)
+        count = sum(summary[1] for summary in summaries)
+        if count == 0:
             return None
+        return float(sum(summary[2] for summary in summaries)) / count
 
-        count = len(vals)
-        average = float(sum(vals)) / count
-        sum_pow2 = sum(map(lambda x: x**2, vals))
-        stdev = math.sqrt(1.0 / count * sum_pow2 - average ** 2)
-        return stdev
+    def StatRate(self, name, seconds):
+        """
+        Calculate the change per second of a statistic over the samples
+        collected in the last 'seconds' seconds before the latest one.
+        Returns None unless the statistic was collected at different times in
+        that window.
+        """
+        window = self.statistics.window(name, seconds)
+        if len(window) < 2 or window[0][0] == window[-1][0]:
+            return None
+        return float(window[-1][1] - window[0][1]) / \
+            (window[-1][0] - window[0][0])
+
+    def StatDelta(self, name):
+        """
+        Calculate the difference between the last two values of a statistic.
+        Returns None if there are not two values.
+        """
+        values = self.statistics.recent(name, 2)
+        if len(values) < 2:
+            return None
+        return values[1] - values[0]
+
+    def StatEWMA(self, name, alpha):
+        """
+        Get the exponentially weighted moving average of a statistic with
+        smoothing factor 'alpha' (the weight of the latest value), or None if
+        there is no value.  The first call for a factor averages the recent
+        values, the Monitor keeps the average up to date from then on.
+        """
+        if not 0 < alpha <= 1:
+            raise EntityError("Smoothing factor %s not in (0, 1]" % alpha)
+        if self.monitor is not None:
+            self.monitor.track_ewma(name, alpha)
+        return self.statistics.ewma(name, alpha)
 
     def SetVar(self, name, val):
         """
         Store a named value in this Entity.
         """
-        self.variables[name] = val
+        self._own('variables')[name] = val
 
     def UpdateStatVal(self, name, val):
         """
@@ -155,10 +266,17 @@ class Entity:
         where is stored to another tick of interval. This can be used to
         calculate stats set of values that doesn't exists in collectors.
         """
-        self.statistics[-1][name] = val
-        setattr(self, name, self.statistics[-1][name])
+        self._update_stat(name, val)
         self.monitor.update_statistics_variable(name, val)
 
+    def _update_stat(self, name, val):
+        """
+        Change value of 'name' stat in this Entity only
+        """
+        self.statistics.update(name, val)
+        if name not in self._fields:
+            self._fields = self._fields.union([name])
+
     def GetVmName(self):
         """
         Get name of VM
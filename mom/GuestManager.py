@@ -19,23 +19,85 @@ import time
 import sys
 import re
 import logging
+import Queue
+from mom.CollectionEngine import CollectionEngine
+from mom.CollectionScheduler import CollectionScheduler
 from mom.GuestMonitor import GuestMonitor
+from mom.HypervisorInterfaces.HypervisorInterface import VM_STARTED, \
+     VM_STOPPED
+
+class FleetSnapshot(object):
+    """
+    The data of all ready guests as published at one point in time, taken in
+    a single pass by GuestManager.snapshot().  The latest statistics form a
+    table of guests by fields: 'ids' lists the guests and 'columns' maps
+    every field to the list of its values in the same order, None for the
+    guests without it.  Snapshots are shared by all readers until a guest
+    publishes new data, so they must not be changed.
+    """
+    def __init__(self, generation, guests, last_data):
+        self.generation = generation
+        self.ids = tuple(id for id, monitor, published in guests)
+        self.monitors = [monitor for id, monitor, published in guests]
+        self.publications = [published for id, monitor, published in guests]
+        self.properties = [published.properties for published
+                           in self.publications]
+        # The last data collected for every guest, ready or not
+        self.last_data = last_data
+        # The latest sample of each guest, as returned by Statistics
+        self.rows = [published.statistics[-1] if published.statistics
+                     else {} for published in self.publications]
+        fields = set()
+        for row in self.rows:
+            fields.update(row)
+        self.fields = tuple(sorted(fields))
+        self.columns = dict((name, [row.get(name) for row in self.rows])
+                            for name in self.fields)
+
+    def entities(self):
+        """
+        Return: A dictionary of new Entities, indexed by guest id
+        """
+        return dict((id, monitor.entity(published)) for id, monitor, published
+                    in zip(self.ids, self.monitors, self.publications))
 
 class GuestManager(threading.Thread):
     """
     The GuestManager thread maintains a list of currently active guests on the
     system.  When a new guest is discovered, a new GuestMonitor is spawned.
     When GuestMonitors stop running, they are removed from the list.
+
+    Guests are discovered as soon as the hypervisor interface reports them
+    started or stopped, if it supports events.  The list of guests is still
+    polled every 'guest-manager-interval' seconds to catch up with any event
+    missed.
     """
-    def __init__(self, config, hypervisor_iface):
+    def __init__(self, config, hypervisor_iface, pipeline=None):
         threading.Thread.__init__(self, name='GuestManager')
         self.setDaemon(True)
         self.config = config
         self.hypervisor_iface = hypervisor_iface
         self.logger = logging.getLogger('mom.GuestManager')
+        # Replaced rather than changed, with guests_sem held, so that it can
+        # be read without the lock
         self.guests = {}
         self.last_data = {}
+        # The last FleetSnapshot, taken again once the guests publish new data
+        self.fleet = None
         self.guests_sem = threading.Semaphore()
+        # (event, id, uuid) reported by the hypervisor interface
+        self.events = Queue.Queue()
+        # Workers collecting the guests, unless each has its own thread
+        workers = config.getint('main', 'guest-collector-threads')
+        if pipeline is not None:
+            self.scheduler = pipeline
+        elif config.getboolean('main', 'guest-collector-events'):
+            self.scheduler = CollectionEngine(max(workers, 1),
+                                              'GuestCollector')
+        elif workers > 0:
+            self.scheduler = CollectionScheduler(workers, 'GuestCollector')
+        else:
+            self.scheduler = None
         self.start()
 
     def spawn_guest_monitors(self, domain_list):
@@ -44,22 +106,23 @@ class GuestManager(threading.Thread):
         we are not already tracking.  The GuestMonitor constructor might block
         so don't hold guests_sem while calling it.
         """
-        self.guests_sem.acquire()
         spawn_list = set(domain_list) - set(self.guests)
-        self.guests_sem.release()
         for id in spawn_list:
             info = self.hypervisor_iface.getVmInfo(id)
             if info is None:
                 self.logger.error("Failed to get guest:%s information -- monitor "\
                     "can't start", id)
                 continue
-            guest = GuestMonitor(self.config, info, self.hypervisor_iface)
-            if guest.isAlive():
+            guest = GuestMonitor(self.config, info, self.hypervisor_iface,
+                                 self.scheduler)
+            if guest.is_active():
                 self.guests_sem.acquire()
                 if id not in self.guests:
-                    self.guests[id] = guest
+                    guests = dict(self.guests)
+                    guests[id] = guest
+                    self.guests = guests
                 else:
-                    del guest
+                    guest.terminate()
                 self.guests_sem.release()
 
     def wait_for_guest_monitors(self):
@@ -69,44 +132,110 @@ class GuestManager(threading.Thread):
         while True:
             self.guests_sem.acquire()
             if len(self.guests) > 0:
-                (id, thread) = self.guests.popitem()
+                guests = dict(self.guests)
+                (id, thread) = guests.popitem()
+                self.guests = guests
             else:
                 id = None
             self.guests_sem.release()
             if id is not None:
-                thread.join(0)
+                if thread.scheduler is None:
+                    thread.join(0)
             else:
                 break
+        if self.scheduler is not None:
+            self.scheduler.shutdown(5)
 
     def check_threads(self, domain_list):
         """
         Check for stale and/or deceased threads and remove them.
         """
         self.guests_sem.acquire()
+        guests = dict(self.guests)
         for (id, thread) in self.guests.items():
             # Check if the thread has died
-            if not thread.isAlive():
-                del self.guests[id]
+            if not thread.is_active():
+                del guests[id]
             # Check if the domain has ended according to hypervisor interface
             elif id not in domain_list:
                 thread.terminate()
-                del self.guests[id]
+                del guests[id]
+        self.guests = guests
         self.guests_sem.release()
 
+    def _vm_event(self, event, id, uuid):
+        """
+        Called back by the hypervisor interface, from any thread
+        """
+        self.events.put((event, id, uuid))
+
+    def wait_for_events(self, timeout):
+        """
+        Handle the guest events reported during the next 'timeout' seconds
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                event = self.events.get(True, remaining)
+            except Queue.Empty:
+                return
+            try:
+                self.handle_event(*event)
+            except Exception:
+                self.logger.error("Failed to handle guest event %s", event,
+                                  exc_info=True)
+
+    def handle_event(self, event, id, uuid):
+        if event == VM_STARTED:
+            self.logger.debug("Guest %s started", id)
+            self.spawn_guest_monitors([id])
+        elif event == VM_STOPPED:
+            self.logger.debug("Guest %s stopped", uuid)
+            self.guests_sem.acquire()
+            guests = dict(self.guests)
+            for (guest_id, thread) in self.guests.items():
+                if guest_id == id or \
+                        thread.properties.get('uuid') == uuid:
+                    thread.terminate()
+                    del guests[guest_id]
+            self.guests = guests
+            self.guests_sem.release()
+
+    def snapshot(self):
+        """
+        Take the data of all ready GuestMonitors, without waiting for any of
+        them.  The snapshot is reused as long as no guest came, went or
+        published new data, so that every reader of a policy interval shares
+        the same one.
+        Return: A FleetSnapshot
+        """
+        guests = []
+        generation = []
+        last_data = {}
+        for id, monitor in sorted(self.guests.items()):
+            published = monitor.published
+            ready = monitor.ready is True
+            if ready:
+                guests.append((id, monitor, published))
+            generation.append((id, published.generation, ready))
+            last_data[id] = published.last_data
+        generation = tuple(generation)
+        fleet = self.fleet
+        if fleet is None or fleet.generation != generation:
+            fleet = FleetSnapshot(generation, guests, last_data)
+            self.fleet = fleet
+            self.last_data = fleet.last_data
+        return fleet
+
     def interrogate(self):
         """
-        Interrogate all active GuestMonitors
+        Interrogate all active GuestMonitors, without waiting for any of them
         Return: A dictionary of Entities, indexed by guest id
         """
-        ret = {}
-        self.last_data = {}
-        self.guests_sem.acquire()
-        for (id, monitor) in self.guests.items():
-            entity = monitor.interrogate()
-            self.last_data[id] = monitor.get_last_data()
-            if entity is not None:
-                ret[id] = entity
-        self.guests_sem.release()
+        ret = self.snapshot().entities()
         self.logger.error('GuestManager.interrogate result: %s' % self.last_data)
         return ret
 
@@ -117,25 +246,35 @@ class GuestManager(threading.Thread):
         try:
             self.logger.info("Guest Manager starting");
             interval = self.config.getint('main', 'guest-manager-interval')
+            if self.hypervisor_iface.registerVmEventCallback(self._vm_event):
+                self.logger.info("Guest Manager following guest events")
             while self.config.getint('__int__', 'running') == 1:
                 domain_list = self.hypervisor_iface.getVmList()
                 if domain_list is not None:
                     self.spawn_guest_monitors(domain_list)
                     self.check_threads(domain_list)
-                time.sleep(interval)
+                self.wait_for_events(interval)
             self.wait_for_guest_monitors()
         except Exception as e:
             self.logger.error("Guest Manager crashed", exc_info=True)
         else:
             self.logger.info("Guest Manager ending")
 
+    def rpc_get_collector_utilization(self):
+        """
+        Return the fraction of the time each worker collecting the guests was
+        busy since the last call, or an empty list if every guest has its own
+        thread
+        """
+        if self.scheduler is None:
+            return []
+        return self.scheduler.utilization()
+
     def rpc_get_active_guests(self):
         ret = []
-        self.guests_sem.acquire()
         for (id, monitor) in self.guests.items():
             if monitor.isReady():
                 name = monitor.getGuestName()
                 if name is not None:
                     ret.append(name)
-        self.guests_sem.release()
         return ret
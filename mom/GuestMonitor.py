@@ -25,9 +25,11 @@ from mom.Collectors import Collector
 
 class GuestMonitor(Monitor, threading.Thread):
     """
-    A GuestMonitor thread collects and reports statistics about 1 running guest
+    A GuestMonitor thread collects and reports statistics about 1 running guest.
+    Given a CollectionScheduler or a CollectionEngine, the GuestMonitor runs no
+    thread of its own and is collected by the scheduler instead.
     """
-    def __init__(self, config, info, hypervisor_iface):
+    def __init__(self, config, info, hypervisor_iface, scheduler=None):
         threading.Thread.__init__(self, name="guest:%s" % id)
         self.config = config
         self.logger = logging.getLogger('mom.GuestMonitor')
@@ -35,6 +37,7 @@ class GuestMonitor(Monitor, threading.Thread):
         self.setName("GuestMonitor-%s" % info['name'])
         Monitor.__init__(self, config, self.getName())
         self.setDaemon(True)
+        self.scheduler = scheduler
         self.data_sem.acquire()
         self.properties.update(info)
         self.properties['hypervisor_iface'] = hypervisor_iface
@@ -46,7 +49,21 @@ class GuestMonitor(Monitor, threading.Thread):
         if self.collectors is None:
             self.logger.error("Guest Monitor initialization failed")
             return
-        self.start()
+        if scheduler is None:
+            self.start()
+        else:
+            self.logger.info("%s starting", self.getName())
+            interval = self.config.getint('main', 'guest-monitor-interval')
+            scheduler.add(self, interval)
+
+    def is_active(self):
+        """
+        Check if the GuestMonitor is still collecting, in its thread or in
+        the scheduler
+        """
+        if self.scheduler is None:
+            return self.isAlive()
+        return self.scheduler.scheduled(self)
 
     def run(self):
         try:
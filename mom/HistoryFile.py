@@ -0,0 +1,179 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import mmap
+import os
+import struct
+import time
+from mom.Statistics import monotonic
+
+MAGIC = 'MOMHIST1'
+
+# Magic, number of records, length of the field names, records written
+HEADER = struct.Struct('<8sIIQ')
+
+# State of a field in a record
+ABSENT = 0      # not collected, or not a number
+NONE = 1
+INT = 2
+FLOAT = 3
+BOOL = 4
+
+# Range of the ints a record holds
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class HistoryFile(object):
+    """
+    The samples of a Monitor kept in a memory-mapped ring file, so that the
+    history survives restarts.  A record has a fixed width given by the
+    field names: the wall-clock time of the sample, a state byte per field
+    and 8 bytes per field holding an int, a float or a bool.  Values of
+    other types are not kept.
+
+    The file is only used by the collecting thread of its Monitor.  Files of
+    guests which are gone are left behind, and attached again if the guests
+    come back.
+    """
+    def __init__(self, history_dir, name, capacity):
+        self.logger = logging.getLogger('mom.HistoryFile')
+        self.filename = "%s/%s.hist" % (history_dir, name)
+        self.capacity = capacity
+        self.map = None
+        self.names = None
+
+    def attach(self, names):
+        """
+        Map the file for samples of the fields 'names', starting it again
+        unless it holds records of exactly these fields.
+        Return: The (timestamp, sample) of the records kept, oldest first,
+                with monotonic() timestamps and the samples as dictionaries
+        """
+        self.close()
+        names = tuple(names)
+        blob = '\n'.join(names)
+        self.names = names
+        self.record = struct.Struct('<d%iB' % len(names))
+        self.record_size = _align(self.record.size) + 8 * len(names)
+        self.offset = _align(HEADER.size + len(blob))
+        size = self.offset + self.capacity * self.record_size
+        try:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fresh = not self._matches(fd, size, blob)
+                if fresh:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        except (OSError, IOError, mmap.error), e:
+            self.logger.warn("Cannot map history file %s: %s", self.filename,
+                             e)
+            self.map = None
+            return []
+
+        if fresh:
+            HEADER.pack_into(self.map, 0, MAGIC, self.capacity, len(blob), 0)
+            self.map[HEADER.size:HEADER.size + len(blob)] = blob
+            self.written = 0
+            return []
+        self.written = HEADER.unpack_from(self.map, 0)[3]
+        return self._records()
+
+    def _matches(self, fd, size, blob):
+        if os.fstat(fd).st_size != size:
+            return False
+        data = os.read(fd, HEADER.size + len(blob))
+        if len(data) != HEADER.size + len(blob):
+            return False
+        magic, capacity, length, written = HEADER.unpack_from(data)
+        return (magic == MAGIC and capacity == self.capacity and
+                length == len(blob) and data[HEADER.size:] == blob)
+
+    def _records(self):
+        # Timestamps are stored as the time of day, which the monotonic
+        # clock does not survive.  They are kept in order and in the past
+        # even if the time of day was changed.
+        now = monotonic()
+        shift = now - time.time()
+        last = float('-inf')
+        first = max(0, self.written - self.capacity)
+        records = []
+        for n in xrange(first, self.written):
+            offset = self.offset + (n % self.capacity) * self.record_size
+            fields = self.record.unpack_from(self.map, offset)
+            offset += _align(self.record.size)
+            sample = {}
+            for name, state in zip(self.names, fields[1:]):
+                if state == INT:
+                    sample[name] = struct.unpack_from('<q', self.map,
+                                                      offset)[0]
+                elif state == FLOAT:
+                    sample[name] = struct.unpack_from('<d', self.map,
+                                                      offset)[0]
+                elif state == BOOL:
+                    sample[name] = struct.unpack_from('<q', self.map,
+                                                      offset)[0] != 0
+                elif state == NONE:
+                    sample[name] = None
+                offset += 8
+            last = min(max(fields[0] + shift, last), now)
+            records.append((last, sample))
+        return records
+
+    def append(self, values):
+        """
+        Write the values of a sample, in the order of the names given to
+        attach(), over the oldest record once the file is full
+        """
+        if self.map is None:
+            return
+        offset = self.offset + \
+            (self.written % self.capacity) * self.record_size
+        states = []
+        data = offset + _align(self.record.size)
+        for value in values:
+            if value is None:
+                states.append(NONE)
+            elif isinstance(value, bool):
+                states.append(BOOL)
+                struct.pack_into('<q', self.map, data, value)
+            elif isinstance(value, float):
+                states.append(FLOAT)
+                struct.pack_into('<d', self.map, data, value)
+            elif isinstance(value, (int, long)) and \
+                    INT_MIN <= value <= INT_MAX:
+                states.append(INT)
+                struct.pack_into('<q', self.map, data, value)
+            else:
+                states.append(ABSENT)
+            data += 8
+        self.record.pack_into(self.map, offset, time.time(), *states)
+        # The record is complete before it is counted
+        self.written += 1
+        struct.pack_into('<Q', self.map, HEADER.size - 8, self.written)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -24,14 +24,21 @@ from mom.Collectors import Collector
 class HostMonitor(Monitor, threading.Thread):
     """
     The Host Monitor thread collects and reports statistics about the host.
+    When a pipeline is given it does not start the thread and is collected
+    at every tick of the pipeline instead.
     """
-    def __init__(self, config, hypervisor_iface):
+    def __init__(self, config, hypervisor_iface, pipeline=None):
         threading.Thread.__init__(self, name="HostMonitor")
         Monitor.__init__(self, config, self.getName())
         self.setDaemon(True)
         self.config = config
         self.logger = logging.getLogger('mom.HostMonitor')
-        self.interval = self.config.getint('main', 'host-monitor-interval')
+        self.pipeline = pipeline
+        if pipeline is None:
+            self.interval = self.config.getint('main',
+                                               'host-monitor-interval')
+        else:
+            self.interval = pipeline.interval
         # Append monitor interval to properties because HostKSM needs it
         # to calculate ksmd cpu usage.
         self.properties['interval'] = self.interval
@@ -43,7 +50,20 @@ class HostMonitor(Monitor, threading.Thread):
         if self.collectors is None:
             self.logger.error("Host Monitor initialization failed")
             return
-        self.start()
+        if pipeline is None:
+            self.start()
+        else:
+            self.logger.info("Host Monitor starting")
+            pipeline.add(self, self.interval)
+
+    def is_active(self):
+        """
+        Check if the Host Monitor is still collecting, in its thread or in
+        the pipeline
+        """
+        if self.pipeline is None:
+            return self.isAlive()
+        return self.pipeline.scheduled(self)
 
     def run(self):
         self.logger.info("Host Monitor starting")
@@ -14,6 +14,11 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+# Guest lifecycle events, see HypervisorInterface.registerVmEventCallback().
+# Guests migrating in and out start and stop.
+VM_STARTED = 'started'
+VM_STOPPED = 'stopped'
+
 class HypervisorInterface:
     """
     HypervisorInterface is an abstract class which defines all interfaces
@@ -28,6 +33,17 @@ class HypervisorInterface:
         """
         pass
 
+    def registerVmEventCallback(self, callback):
+        """
+        This method asks the hypervisor to call callback(event, id, uuid)
+        whenever a guest starts (VM_STARTED) or stops (VM_STOPPED), from any
+        thread.  'id' is the identifier of the guest returned by getVmList(),
+        which may be None for guests which stopped.  It returns False if the
+        hypervisor does not report events, in which case the guests are only
+        found by calling getVmList().
+        """
+        return False
+
     def getVmInfo(self, uuid):
         """
         This method returns basic information of a given guest, including
@@ -57,6 +57,10 @@ class fakeInterface(HypervisorInterface):
         self._parse_sample_file(sample_file)
         self.sample_index = -1
 
+        # Called back when simulated guests start or stop
+        self.event_callbacks = []
+        self.running = set()
+
     def _parse_sample_file(self, filename):
         """
         Format description:
@@ -216,8 +220,27 @@ class fakeInterface(HypervisorInterface):
                 self.logger.debug('getVmList got %s' % s)
                 pass
         self.logger.info('XX list = %s' % ret)
+        self._emit_events(ret)
         return ret
 
+    def _emit_events(self, running):
+        """
+        Report the guests which started or stopped since the last sample
+        like a hypervisor would, see registerVmEventCallback()
+        """
+        running = set(running)
+        for name in sorted(running - self.running):
+            for callback in self.event_callbacks:
+                callback(VM_STARTED, name, self.domains[name]['uuid'])
+        for name in sorted(self.running - running):
+            for callback in self.event_callbacks:
+                callback(VM_STOPPED, None, self.domains[name]['uuid'])
+        self.running = running
+
+    def registerVmEventCallback(self, callback):
+        self.event_callbacks.append(callback)
+        return True
+
     def getVmInfo(self, idvm):
         data = {}
         data['uuid'] = self.domains[idvm]['uuid']
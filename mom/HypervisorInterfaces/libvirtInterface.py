@@ -15,10 +15,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import libvirt
-import re
 import logging
-from subprocess import *
+import threading
 from mom.HypervisorInterfaces.HypervisorInterface import *
+from mom.Collectors.ProcessIndex import get_process_index
 from xml.etree import ElementTree
 from xml.dom.minidom import parseString as _domParseStr
 
@@ -37,6 +37,10 @@ class libvirtInterface(HypervisorInterface):
         self.interval = config.getint('main', 'guest-monitor-interval')
         self.logger = logging.getLogger('mom.libvirtInterface')
         libvirt.registerErrorHandler(self._error_handler, None)
+        # Callbacks for guest lifecycle events, registered again with every
+        # connection
+        self.event_callbacks = []
+        self.events = self._start_event_loop()
         self._connect()
         self._setStatsFields()
 
@@ -55,6 +59,70 @@ class libvirtInterface(HypervisorInterface):
         except libvirt.libvirtError, e:
             self.logger.error("libvirtInterface: error setting up " \
                     "connection: %s", e.message)
+            return
+        for callback in self.event_callbacks:
+            self._registerLifecycleCallback(callback)
+
+    def _start_event_loop(self):
+        """
+        Run the default libvirt event loop in a thread, which libvirt needs
+        to deliver domain events.  It must be set up before connecting.
+        Return: True if the bindings support events
+        """
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError), e:
+            self.logger.info("libvirtInterface: no domain events: %s", e)
+            return False
+
+        def run():
+            while True:
+                try:
+                    libvirt.virEventRunDefaultImpl()
+                except libvirt.libvirtError, e:
+                    self.logger.warn("libvirtInterface: event loop error: "
+                                     "%s", e.message)
+        thread = threading.Thread(target=run, name='libvirtEventLoop')
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+    def _registerLifecycleCallback(self, callback):
+        try:
+            self.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycleEvent, callback)
+        except libvirt.libvirtError, e:
+            # Not reconnecting here, _connect() registers the callbacks
+            self.logger.warn("libvirtInterface: cannot follow domain "
+                             "events: %s", e.message)
+            return False
+        return True
+
+    def _lifecycleEvent(self, conn, domain, event, detail, callback):
+        """
+        Translate libvirt lifecycle events, including incoming and outgoing
+        migrations, to the events of registerVmEventCallback()
+        """
+        try:
+            if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+                callback(VM_STARTED, domain.ID(), domain.UUIDString())
+            elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                callback(VM_STOPPED, None, domain.UUIDString())
+        except libvirt.libvirtError, e:
+            # The guest is found by the next poll instead
+            self.logger.warn("libvirtInterface: lifecycle event error: %s",
+                             e.message)
+        except Exception:
+            self.logger.exception("libvirtInterface: lifecycle event error")
+
+    def registerVmEventCallback(self, callback):
+        if not self.events or self.conn is None:
+            return False
+        if not self._registerLifecycleCallback(callback):
+            return False
+        self.event_callbacks.append(callback)
+        return True
 
     def _reconnect(self):
         try:
@@ -121,11 +189,11 @@ class libvirtInterface(HypervisorInterface):
     def _domainGetPid(self, uuid):
         """
         This is an ugly way to find the pid of the qemu process associated with
-        this guest.  Scan ps output looking for our uuid and record the pid.
-        Something is probably wrong if more or less than 1 match is returned.
+        this guest.  Look for our uuid in the command lines of the processes
+        and record the pid.  Something is probably wrong if more or less than
+        1 match is returned.
         """
-        p1 = Popen(["ps", "axww"], stdout=PIPE).communicate()[0]
-        matches = re.findall("^\s*(\d+)\s+.*" + uuid, p1, re.M)
+        matches = get_process_index().find_uuid(uuid)
         if len(matches) < 1:
             self.logger.warn("No matching process for domain with uuid %s", \
                              uuid)
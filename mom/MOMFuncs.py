@@ -62,6 +62,16 @@ class MOMFuncs(object):
         self.logger.info("getNamedPolicies()")
         return self.threads['policy_engine'].rpc_get_named_policies()
 
+    @exported
+    def getPolicyProfile(self):
+        self.logger.info("getPolicyProfile()")
+        return self.threads['policy_engine'].rpc_get_policy_profile()
+
+    @exported
+    def resetPolicyProfile(self):
+        self.logger.info("resetPolicyProfile()")
+        return self.threads['policy_engine'].rpc_reset_policy_profile()
+
     @exported
     def setVerbosity(self, verbosity):
         self.logger.info("setVerbosity()")
@@ -74,12 +84,22 @@ class MOMFuncs(object):
         self.logger.info("getStatistics()")
         host_stats = self.threads['host_monitor'].interrogate().statistics[-1]
         guest_stats = {}
-        guest_entities = self.threads['guest_manager'].interrogate().values()
-        for entity in guest_entities:
-            guest_stats[entity.properties['name']] = entity.statistics[-1]
+        fleet = self.threads['guest_manager'].snapshot()
+        for properties, row in zip(fleet.properties, fleet.rows):
+            guest_stats[properties['name']] = row
         ret = {'host': host_stats, 'guests': guest_stats}
         return ret
 
+    @exported
+    def getCollectorUtilization(self):
+        self.logger.info("getCollectorUtilization()")
+        return self.threads['guest_manager'].rpc_get_collector_utilization()
+
+    @exported
+    def getPipelineStats(self):
+        self.logger.info("getPipelineStats()")
+        return self.threads['policy_engine'].rpc_get_pipeline_stats()
+
     @exported
     def getActiveGuests(self):
         self.logger.info("getActiveGuests()")
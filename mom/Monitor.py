@@ -17,10 +17,50 @@
 import threading
 import ConfigParser
 import logging
-from collections import deque
+from collections import namedtuple
 from mom.Collectors import Collector
 from mom.Entity import Entity
+from mom.HistoryFile import HistoryFile
 from mom.Plotter import Plotter
+from mom.Statistics import Statistics
+from mom.Statistics import parse_rollups
+
+# The data of a Monitor as readers see it, see Monitor._publish()
+Publication = namedtuple('Publication', ['generation', 'properties',
+                                         'variables', 'statistics',
+                                         'last_data'])
+
+class Schema(object):
+    """
+    The fields reported by a list of Collectors, compiled once.  A sample is
+    merged into a list of values in the order of names, and the fields
+    collected are the bits set in a mask, so that checking that all the
+    mandatory fields are there is a single test.
+    """
+    def __init__(self, collectors):
+        self.collectors = list(collectors)
+        fields = set()
+        optional_fields = set()
+        for c in collectors:
+            fields |= c.getFields()
+            optional_fields |= c.getOptionalFields()
+        # Remove mandatory fields from the optional list
+        # This can happen when more than one collector is able to provide
+        # the value
+        self.fields = frozenset(fields)
+        self.optional_fields = frozenset(optional_fields - fields)
+        self.names = tuple(sorted(fields | optional_fields))
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        self.required = 0
+        for name in fields:
+            self.required |= 1 << self.positions[name]
+
+    def missing(self, mask):
+        """
+        Return the mandatory fields whose bits are not set in 'mask'
+        """
+        return set(name for name in self.fields
+                   if not mask & 1 << self.positions[name])
 
 class Monitor(object):
     """
@@ -28,19 +68,32 @@ class Monitor(object):
     reported.  Each monitor has a dictionary of properties which are relatively
     static such as a name or ID.  Additionally, statistics are collected over
     time and queued so averages and trends can be analyzed.
+
+    The data is changed by the collecting thread and by the policy, which
+    take data_sem in turn, but readers never wait for them: every change is
+    published by replacing a read-only Publication, which readers take as a
+    whole.
     """
     def __init__(self, config, name):
-        # Guard the data with a semaphore to ensure consistency.
+        # Guard the data with a semaphore to ensure consistency between
+        # writers.
         self.data_sem = threading.Semaphore()
         self.properties = {}
-        self.statistics = deque()
+        history_length = config.getint('main', 'sample-history-length')
+        self.statistics = Statistics(
+            history_length, parse_rollups(config.get('main', 'history-tiers')))
         self.variables = {}
         self.name = name
         self.fields = None
         self.optional_fields = None
+        # The Schema of the collectors, compiled again when they change
+        self.schema = None
+        # The valid fields, shared by the Entities of this Monitor
+        self.field_index = frozenset()
         self.collectors = []
         self.logger = logging.getLogger('mom.Monitor')
-        self.last_data = []
+        self.published = Publication(0, self.properties, self.variables,
+                                     self.statistics.snapshot(), [])
 
         plot_dir = config.get('__int__', 'plot-subdir')
         if plot_dir != '':
@@ -48,6 +101,13 @@ class Monitor(object):
         else:
             self.plotter = None
 
+        # The samples are also kept on disk if a history directory is set
+        history_dir = config.get('main', 'history-dir')
+        if history_dir != '':
+            self.history = HistoryFile(history_dir, name, history_length)
+        else:
+            self.history = None
+
         self.ready = None
         self._terminate = False
 
@@ -58,8 +118,8 @@ class Monitor(object):
     def collect(self):
         """
         Collect a set of statistics by invoking all defined collectors and
-        merging the data into one dictionary and pushing it onto the deque of
-        historical statistics.  Maintain a history length as specified in the
+        merging the data into one dictionary and appending it to the ring of
+        historical statistics, which holds as many samples as specified in the
         config file.
 
         Note: Priority is given to collectors based on the order that they are
@@ -67,93 +127,178 @@ class Monitor(object):
         statistic only the value produced by the first collector will be saved).
         Return: The dictionary of collected statistics
         """
+        schema = self._schema()
+        results = []
+        for c in self.collectors:
+            collected = self._call(c)
+            results.append((c, collected))
+            if isinstance(collected, Collector.FatalError):
+                break
+        return self._merge(schema, results)
 
-        # The first time we are called, populate the list of expected fields
-        if self.fields is None:
-            self.fields = set()
-            for c in self.collectors:
-                self.fields |= c.getFields()
-            self.logger.debug("Using fields: %s", repr(self.fields))
-
-        # The first time we are called, populate the list of optional fields
-        if self.optional_fields is None:
-            self.optional_fields = set()
-            for c in self.collectors:
-                self.optional_fields |= c.getOptionalFields()
-            self.logger.debug("Using optional fields: %s", repr(self.optional_fields))
-
-        # Remove mandatory fields from the optional list
-        # This can happen when more than one collector is able to provide
-        # the value
-        self.optional_fields = self.optional_fields.difference(self.fields)
+    def _schema(self):
+        """
+        Return the Schema of the collectors
+        """
+        # Populate the lists of expected and optional fields the first time
+        # we are called, and whenever the collectors change
+        schema = self.schema
+        if schema is None or schema.collectors != self.collectors:
+            schema = self._set_schema(Schema(self.collectors))
+        return schema
 
-        if self.plotter is not None:
-            self.plotter.setFields(self.fields.union(self.optional_fields))
+    def _call(self, c):
+        """
+        Call Collector 'c'.
+        Return: The data collected, or the CollectionError or FatalError
+                raised.  Other errors are logged and count as no data.
+        """
+        try:
+            return c.collect()
+        except (Collector.CollectionError, Collector.FatalError), e:
+            return e
+        except Exception:
+            self.logger.exception("Unexpected collection error")
+            return None
 
-        data = {}
-        for c in self.collectors:
-            try:
-                collected = c.collect()
-                if collected is None:
-                    self.logger.debug("Collector %s did not "
-                                      "return any data", str(c))
-                    continue
-                #self.logger.info('collected data from %s:\n%s' % (str(c), collected))
-                for (key, val) in collected.items():
-                    if key not in data or data[key] is None:
-                        data[key] = val
-            except Collector.CollectionError, e:
-                self._disp_collection_error("Collection error: %s" % e.msg)
-            except Collector.FatalError, e:
-                self._set_not_ready("Fatal Collector error: %s" % e.msg)
+    def _merge(self, schema, results):
+        """
+        Merge the results of the collectors, as (collector, result of
+        _call()) in their order, and append them to the statistics.
+        Return: The dictionary of collected statistics
+        """
+        positions = schema.positions
+        values = [None] * len(schema.names)
+        collected_mask = 0
+        # Fields which no collector declared
+        extra = {}
+        for c, collected in results:
+            if isinstance(collected, Collector.CollectionError):
+                self._disp_collection_error("Collection error: %s" %
+                                            collected.msg)
+                continue
+            if isinstance(collected, Collector.FatalError):
+                self._set_not_ready("Fatal Collector error: %s" %
+                                    collected.msg)
                 self.terminate()
                 return None
+            if collected is None:
+                self.logger.debug("Collector %s did not "
+                                  "return any data", str(c))
+                continue
+            try:
+                #self.logger.info('collected data from %s:\n%s' % (str(c), collected))
+                for (key, val) in collected.iteritems():
+                    pos = positions.get(key)
+                    if pos is None:
+                        if extra.get(key) is None:
+                            extra[key] = val
+                    else:
+                        collected_mask |= 1 << pos
+                        if values[pos] is None:
+                            values[pos] = val
             except Exception:
                 self.logger.exception("Unexpected collection error")
 
-        if not set(data).issuperset(self.fields):
+        if collected_mask & schema.required != schema.required:
             self._set_not_ready("Incomplete data: missing %s" % \
-                                (self.fields - set(data)))
+                                schema.missing(collected_mask))
             return None
 
-        # put None to all unset (optional) fields
-        for k in self.optional_fields:
-            data.setdefault(k, None)
+        # Unset (optional) fields are None
+        names = schema.names
+        if extra:
+            names = names + tuple(extra)
+            values.extend(extra.itervalues())
+        data = dict(zip(names, values))
 
         self.data_sem.acquire()
-        self.statistics.append(data)
-        if len(self.statistics) > self.config.getint('main', 'sample-history-length'):
-            self.statistics.popleft()
+        self.statistics.append_values(names, values)
+        self._publish(data)
         self.data_sem.release()
         self._set_ready()
 
+        if self.history is not None:
+            self.history.append(values[:len(schema.names)])
+
         if self.plotter is not None:
             self.plotter.plot(data)
 
-        self.last_data = data
-
-        self.logger.info('ALL collected data:\n---------------------\n%s\n---------------------' % (data))
+        self.logger.info('ALL collected data:\n---------------------\n%s\n---------------------', data)
         return data
 
+    def _set_schema(self, schema):
+        """
+        Use a new Schema, which only happens when the collectors change
+        """
+        self.schema = schema
+        self.fields = set(schema.fields)
+        self.optional_fields = set(schema.optional_fields)
+        self.logger.debug("Using fields: %s", repr(self.fields))
+        self.logger.debug("Using optional fields: %s", repr(self.optional_fields))
+        self.field_index = frozenset(schema.names)
+        if self.plotter is not None:
+            self.plotter.setFields(schema.names)
+        if self.history is not None:
+            self._restore(self.history.attach(schema.names))
+        return schema
+
+    def _restore(self, records):
+        """
+        Start the history with the samples kept on disk by a previous run, as
+        long as nothing was collected yet
+        """
+        if not records:
+            return
+        self.data_sem.acquire()
+        try:
+            if len(self.statistics) == 0:
+                for timestamp, sample in records:
+                    self.statistics.append(sample, timestamp)
+                self._publish()
+                self.logger.info("%s: restored %i samples", self.name,
+                                 len(records))
+        finally:
+            self.data_sem.release()
+
+    def _publish(self, last_data=None):
+        """
+        Make the current data visible to readers, with the last collected data
+        if it changed.  The statistics are published as a snapshot, which
+        later changes copy as needed.  Called with data_sem held.
+        """
+        published = self.published
+        if last_data is None:
+            last_data = published.last_data
+        self.published = Publication(published.generation + 1,
+                                     self.properties, self.variables,
+                                     self.statistics.snapshot(), last_data)
+
     def get_last_data(self):
-        return self.last_data
+        return self.published.last_data
 
     def interrogate(self):
         """
         Take a snapshot of this Monitor object and return an Entity object which
-        is useful for rules processing.
+        is useful for rules processing.  The snapshot takes the same time no
+        matter how long the history is: the Entity shares the data of the
+        Monitor and copies it before changing it.  Properties are not changed
+        once the Monitor is ready and variables are replaced, not changed.
+        No lock is taken, see _publish().
         Return: A new Entity object
         """
         if self.ready is not True:
             return None
+        return self.entity(self.published)
+
+    def entity(self, published):
+        """
+        Return a new Entity holding the data of Publication 'published'
+        """
         ret = Entity(monitor=self)
-        self.data_sem.acquire()
-        for prop in self.properties.keys():
-            ret._set_property(prop, self.properties[prop])
-        for var in self.variables.keys():
-            ret._set_variable(var, self.variables[var])
-        ret._set_statistics(self.statistics)
-        self.data_sem.release()
+        # Entities may change their statistics, the publication must not
+        ret._share(published.properties, published.variables,
+                   published.statistics.snapshot())
         ret._finalize()
         return ret
 
@@ -162,8 +307,11 @@ class Monitor(object):
         Update the variables array to store any updates from an Entity
         """
         self.data_sem.acquire()
-        for (var, val) in variables.items():
-            self.variables[var] = val
+        # Entities may share the current dictionary, see interrogate()
+        updated = dict(self.variables)
+        updated.update(variables)
+        self.variables = updated
+        self._publish()
         self.data_sem.release()
 
     def update_statistics_variable(self, name, value):
@@ -174,11 +322,26 @@ class Monitor(object):
         value, number.
 
         There could be problem with missing values when policy and monitor
-        threads are awake in different intervals.
+        threads are awake in different intervals, unless they run in a
+        Pipeline.
         """
         self.data_sem.acquire()
-        self.statistics[-1][name] = value
-        self.data_sem.release()
+        try:
+            self.statistics.update(name, value)
+            self._publish()
+        finally:
+            self.data_sem.release()
+
+    def track_ewma(self, name, alpha):
+        """
+        Keep the moving average of a field with smoothing factor 'alpha' up to
+        date in the statistics, for Entity.StatEWMA.
+        """
+        self.data_sem.acquire()
+        try:
+            self.statistics.ewma(name, alpha)
+        finally:
+            self.data_sem.release()
 
     def terminate(self):
         """
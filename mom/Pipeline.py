@@ -0,0 +1,206 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from mom.Statistics import monotonic
+
+
+class Pipeline(object):
+    """
+    Run the host and guest collections and the policy as ordered stages of
+    a single tick, so that the policy acts on data collected together rather
+    than on samples of different ages.  The PolicyEngine drives the ticks
+    every 'interval' seconds, counted from the first tick so that they do
+    not drift.  Each tick collects every Monitor added, with 'workers'
+    threads, then the PolicyEngine takes a snapshot of the data, evaluates
+    the policy and runs the controllers.
+
+    The Monitors are added like to a CollectionScheduler, but are collected
+    at every tick whatever their own interval.  A Monitor whose collection
+    does not complete within the interval is left behind by the tick, and
+    skipped by the next ones until it completes.  The time spent in each
+    stage and the age of the data of each Monitor at the snapshot are kept
+    for the last tick.
+    """
+    def __init__(self, interval, workers):
+        self.logger = logging.getLogger('mom.Pipeline')
+        self.interval = interval
+        self.lock = threading.Lock()
+        # The Monitors collected, until they stop running
+        self.monitors = set()
+        # The results of the collections which were late, by Monitor
+        self.late = {}
+        self.running = True
+        self.pool = ThreadPool(max(workers, 1))
+        self.due = None
+        # The time spent in the ticks since 'since'
+        self.busy = 0.0
+        self.since = monotonic()
+        # Of the current tick: its start, the end of its last stage, the
+        # seconds spent by stage and the age in seconds of the latest sample
+        # of each Monitor by name
+        self.started = None
+        self.mark = None
+        self.stages = {}
+        self.ages = {}
+        # The same of the last tick completed
+        self.latency = {}
+        self.sample_age = {}
+
+    def add(self, monitor, interval):
+        """
+        Collect the data of 'monitor' at every tick until it stops running,
+        see Monitor._should_run().  Its own 'interval' is not used.
+        """
+        with self.lock:
+            self.monitors.add(monitor)
+
+    def scheduled(self, monitor):
+        return monitor in self.monitors
+
+    def wait(self):
+        """
+        Sleep until the next tick is due
+        """
+        now = monotonic()
+        if self.due is None:
+            self.due = now + self.interval
+        else:
+            # Ticks which are late are skipped, not made up for
+            self.due = max(self.due + self.interval, now)
+        time.sleep(max(0, self.due - now))
+
+    def collect(self):
+        """
+        Start a tick with the collection stage: collect every Monitor and
+        wait for all of them
+        """
+        self.started = self.mark = monotonic()
+        self.stages = {}
+        self.ages = {}
+        with self.lock:
+            if not self.running:
+                return
+            monitors = sorted(self.monitors, key=lambda m: m.name)
+        results = []
+        for monitor in monitors:
+            result = self.late.get(monitor)
+            if result is not None:
+                if not result.ready():
+                    continue
+                del self.late[monitor]
+                if not result.get():
+                    self._drop(monitor)
+                    continue
+            results.append((monitor,
+                            self.pool.apply_async(self._collect, (monitor,))))
+        deadline = self.started + self.interval
+        for monitor, result in results:
+            try:
+                ok = result.get(max(0, deadline - monotonic()))
+            except TimeoutError:
+                self.logger.warn("%s: collection took more than %ss, "
+                                 "skipped", monitor.name, self.interval)
+                self.late[monitor] = result
+                continue
+            if not ok:
+                self._drop(monitor)
+        self.end_stage('collect')
+
+    def _collect(self, monitor):
+        if not monitor._should_run():
+            self.logger.info("%s ending", monitor.name)
+            return False
+        try:
+            monitor.collect()
+        except Exception:
+            self.logger.error("%s crashed", monitor.name, exc_info=True)
+            return False
+        return True
+
+    def _drop(self, monitor):
+        with self.lock:
+            self.monitors.discard(monitor)
+
+    def end_stage(self, stage):
+        """
+        Record the time spent in 'stage' of the current tick
+        """
+        if self.started is None:
+            return
+        now = monotonic()
+        self.stages[stage] = now - self.mark
+        self.mark = now
+
+    def sample_ages(self, monitors):
+        """
+        Record the age of the latest sample of 'monitors' at the snapshot,
+        except for the ones without samples
+        """
+        now = monotonic()
+        for monitor in monitors:
+            timestamp = monitor.published.statistics.latest_time()
+            if timestamp is not None:
+                self.ages[monitor.name] = now - timestamp
+
+    def end_tick(self):
+        """
+        End the current tick, whose stages are made available by stats()
+        """
+        if self.started is None:
+            return
+        elapsed = monotonic() - self.started
+        with self.lock:
+            self.latency = self.stages
+            self.sample_age = self.ages
+            self.busy += elapsed
+        self.started = None
+        self.logger.debug("Tick took %.3fs: %s", elapsed, self.latency)
+
+    def stats(self):
+        """
+        Return: The seconds spent in each stage of the last tick, and the age
+                in seconds of the data of each Monitor at its snapshot
+        """
+        with self.lock:
+            return {'latency': self.latency, 'sample_age': self.sample_age}
+
+    def utilization(self):
+        """
+        Return the fraction of the time spent in ticks since the last call,
+        as a list like CollectionScheduler.utilization()
+        """
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.since
+            busy = self.busy
+            self.busy = 0.0
+            self.since = now
+        if elapsed <= 0:
+            return [0.0]
+        return [min(1.0, busy / elapsed)]
+
+    def shutdown(self, timeout=None):
+        """
+        Stop collecting, once the collections in progress are done
+        """
+        with self.lock:
+            self.running = False
+        self.pool.close()
@@ -0,0 +1,258 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Analysis of all loaded policies as a single program, used to optimise their
+compiled code.  See Program.
+"""
+
+from Parser import Evaluator
+from Parser import NOT_CONSTANT
+from Parser import Token
+
+# Forms which may bind names, and so are never inlined
+BINDING_FORMS = frozenset(['defvar', 'set', 'setq', 'let', 'def', 'defun',
+                           'with'])
+
+# Maximum number of tokens in the body of a function to inline
+MAX_INLINE_SIZE = 64
+
+
+def _is_symbol(code):
+    return isinstance(code, Token) and code.kind == 'symbol'
+
+
+def symbols(code):
+    """
+    Return the names of all symbols in code, and of the objects of dotted ones
+    """
+    names = set()
+    stack = [code]
+    while stack:
+        code = stack.pop()
+        if isinstance(code, Token):
+            if code.kind == 'symbol':
+                names.add(code.value)
+                names.add(code.value.split('.')[0])
+        else:
+            stack.extend(code)
+    return names
+
+
+def _size(code):
+    if isinstance(code, Token):
+        return 1
+    return sum(map(_size, code))
+
+
+class Program(object):
+    """
+    Facts about the whole program made of the loaded policies, which hold no
+    matter which path the evaluation takes.  Positions of top-level
+    expressions are (policy name, index) tuples that sort in evaluation order.
+
+    constants: Names bound once by a top-level defvar to the value of a
+               constant expression and never bound in any other way, mapped to
+               (position of the defvar, value)
+    functions: Trivial functions defined only once, at the top level, mapped
+               to (position, policy digest, parameters, body, dotted) where
+               dotted are the parameters used as objects
+    names:     Every name the program or the policy engine may bind
+    strip_debug: True if debug calls do nothing but return their last argument
+    """
+    def __init__(self):
+        self.constants = {}
+        self.functions = {}
+        self.names = set()
+        self.strip_debug = False
+
+    def prepare(self, e, position):
+        """
+        Let evaluator 'e' optimise the expression at 'position' with the facts
+        established by the preceding expressions.
+        """
+        e.variables = self.names
+        e.constants = dict((name, value) for name, (pos, value)
+                           in self.constants.iteritems() if pos < position)
+        e.functions = dict((name, (params, body, dotted))
+                           for name, (pos, digest, params, body, dotted)
+                           in self.functions.iteritems() if pos < position)
+        e.strip_debug = self.strip_debug
+
+    def signature(self, names):
+        """
+        Return the facts the optimised code of an expression referring to
+        'names' may depend on.  The code compiled for an unchanged policy can
+        be reused as long as its signature does not change.
+        """
+        names = set(names)
+        for name in list(names):
+            if name in self.functions:
+                names |= symbols(self.functions[name][3])
+
+        facts = set()
+        for name in names:
+            if name in self.names:
+                facts.add(('variable', name))
+            if name in self.constants:
+                pos, value = self.constants[name]
+                facts.add(('constant', name, pos, repr(value)))
+            if name in self.functions:
+                facts.add(('function', name) + self.functions[name][:2])
+        if 'debug' in names:
+            facts.add(('debug', self.strip_debug))
+        return frozenset(facts)
+
+
+def analyze(policies, reserved=(), strip_debug=False, inline=True):
+    """
+    Analyse a program.  'policies' is the list of (name, digest, parsed code)
+    of the policies in evaluation order and 'reserved' the names bound before
+    the policies are evaluated.
+    Return: A Program
+    """
+    e = Evaluator()
+    program = Program()
+
+    defvars = []
+    defs = {}
+    for name, digest, code in policies:
+        for i, expr in enumerate(code, 1):
+            _scan(expr, (name, i), digest, True, program.names, defvars, defs)
+    # Names bound otherwise than by a top-level defvar
+    bound = set(program.names)
+    program.names.update(name for pos, name, value in defvars)
+    program.strip_debug = strip_debug and 'debug' not in program.names
+
+    # Only the first top-level defvar of a name binds it, the next ones do
+    # nothing as the name is bound in the global scope already
+    for names in (program.names, bound):
+        names.update(reserved)
+        names.update(e.stack.globals.iterkeys())
+    e.variables = program.names
+    e.constants = {}
+    for pos, name, value in defvars:
+        if name in bound:
+            continue
+        bound.add(name)
+        value = e.fold(value)
+        if value is not NOT_CONSTANT:
+            program.constants[name] = (pos, value)
+            e.constants[name] = value
+
+    if inline:
+        for name, entries in defs.iteritems():
+            if len(entries) != 1 or name in program.names:
+                continue
+            function = _trivial(entries[0], defs)
+            if function is not None:
+                program.functions[name] = function
+
+    return program
+
+
+def _scan(code, pos, digest, top, names, defvars, defs):
+    """
+    Record the names bound by code.  Top-level defvars, including the ones in
+    top-level blocks, are recorded in 'defvars' instead and all function
+    definitions in 'defs'.
+    """
+    if isinstance(code, Token) or not code:
+        return
+    head, args = code[0], code[1:]
+    form = head.value if _is_symbol(head) else None
+
+    if form == 'defvar' and args and _is_symbol(args[0]):
+        if top and len(args) == 2:
+            defvars.append((pos, args[0].value, args[1]))
+        else:
+            names.add(args[0].value)
+    elif form in ('set', 'setq') and args and _is_symbol(args[0]):
+        names.add(args[0].value)
+    elif form == 'let' and args and type(args[0]) == list:
+        for sym in args[0]:
+            if type(sym) == list and sym:
+                sym = sym[0]
+            if _is_symbol(sym):
+                names.add(sym.value)
+    elif form in ('def', 'defun') and len(args) >= 2:
+        params = args[1]
+        if type(params) == list:
+            names.update(p.value for p in params if _is_symbol(p))
+        elif _is_symbol(params):
+            names.add(params.value)
+        if _is_symbol(args[0]):
+            body = args[2] if len(args) == 3 else None
+            defs.setdefault(args[0].value, []).append(
+                (pos, digest, params, body, top))
+    elif form == 'with' and len(args) >= 2 and _is_symbol(args[1]):
+        names.add(args[1].value)
+
+    # Blocks do not create a scope
+    top = top and form == 'eval'
+    for arg in args:
+        _scan(arg, pos, digest, top, names, defvars, defs)
+
+
+def _trivial(definition, defs):
+    """
+    Check if the body of a function can replace its calls.  It must be small,
+    bind nothing, call no user function and use all of its parameters.
+    Return: The entry of Program.functions, or None
+    """
+    pos, digest, params, body, top = definition
+    if not top or body is None or type(params) != list:
+        return None
+    if not all(_is_symbol(p) and '.' not in p.value and p.value != 'nil'
+               for p in params):
+        return None
+    params = [p.value for p in params]
+    if len(set(params)) != len(params):
+        return None
+
+    # A block of a single expression evaluates to that expression
+    while type(body) == list and len(body) == 2 and _is_symbol(body[0]) and \
+            body[0].value == 'eval':
+        body = body[1]
+    if _size(body) > MAX_INLINE_SIZE:
+        return None
+
+    stack = [body]
+    while stack:
+        code = stack.pop()
+        if isinstance(code, Token) or not code:
+            continue
+        if _is_symbol(code[0]) and (code[0].value in BINDING_FORMS or
+                                    code[0].value in defs):
+            return None
+        stack.extend(code)
+
+    used = set()
+    dotted = set()
+    stack = [body]
+    while stack:
+        code = stack.pop()
+        if isinstance(code, Token):
+            if code.kind == 'symbol':
+                parts = code.value.split('.')
+                used.add(parts[0])
+                if len(parts) > 1:
+                    dotted.add(parts[0])
+        else:
+            stack.extend(code)
+    if not set(params) <= used:
+        return None
+    return (pos, digest, params, body, dotted & set(params))
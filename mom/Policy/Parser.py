@@ -13,14 +13,31 @@
 # You should have received a copy of the GNU General Public
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import copy
 import logging
 
 import re
-from spark import GenericScanner, GenericParser
+import threading
+import time
+from spark import GenericScanner
+
 
 class PolicyError(Exception): pass
 
+
+# Entity methods which only read data and can be called in any order
+PURE_METHODS = frozenset(['Prop', 'Stat', 'StatAvg', 'StatStdDeviation',
+                          'StatMin', 'StatMax', 'StatAvgWindow',
+                          'StatAvgTier', 'StatRate', 'StatDelta', 'GetVar',
+                          'GetVmName'])
+
+# Returned by GenericEvaluator.fold() for code whose value is not known
+NOT_CONSTANT = object()
+
+
 class Token(object):
+    __slots__ = ('kind', 'value')
+
     def __init__(self, kind, value=None):
         self.kind = kind
         if value == None:
@@ -34,11 +51,15 @@ class Token(object):
     def __repr__(self):
         return '[%s %s]' % (self.kind, self.value)
 
+
 class NumericToken(Token):
+    __slots__ = ('type',)
+
     def __init__(self, type, value):
         self.type = type
         Token.__init__(self, 'number', value)
 
+
 class Scanner(GenericScanner):
     def __init__(self, operators=''):
         self.operators = operators
@@ -110,58 +131,61 @@ class Scanner(GenericScanner):
     def t_user_op(self, s):
         self.rv.append(Token('operator', s))
 
-class Parser(GenericParser):
+
+class Parser(object):
+    """
+    Reader turning a list of tokens into the nested lists of the policy
+    language.  Its grammar is:
+
+      value ::= operator | number | symbol | string
+      value ::= ( value ... ) | [ value ... ] | { value ... }
+
+    where a curly list is read as an 'eval' block.  Tokens are consumed in a
+    single pass using an explicit stack of the lists being read, so the cost
+    is linear in the number of tokens regardless of nesting depth.
+    """
+    closing = {'(': ')', '[': ']', '{': '}'}
+
     def __init__(self, start='value'):
-        GenericParser.__init__(self, start)
+        if start not in ('value', 'value_list'):
+            raise ValueError("Unknown start symbol '%s'" % start)
+        self.start = start
+
+    def error(self, token):
+        logging.getLogger('mom.Parser').debug(
+            "Syntax error at or near `%s' token", token)
+        raise PolicyError('parse error')
+
+    def parse(self, tokens):
+        values = []
+        stack = []
+        for token in tokens:
+            kind = token.kind
+            if kind in self.closing:
+                stack.append((self.closing[kind], values))
+                if kind == '{':
+                    values = [Token('symbol', 'eval')]
+                else:
+                    values = []
+            elif kind in (')', ']', '}'):
+                if not stack or stack[-1][0] != kind:
+                    self.error(token)
+                outer = stack.pop()[1]
+                outer.append(values)
+                values = outer
+            else:
+                values.append(token)
 
-    def mklist(self, args):
-        if len(args) == 2:
-            return []
-        return args[1]
+        if stack:
+            self.error('EOF')
+        if self.start == 'value':
+            if len(values) != 1:
+                self.error('EOF' if not values else values[1])
+            return values[0]
+        if not values:
+            self.error('EOF')
+        return values
 
-    def p_value_list(self, args):
-        '''
-          value_list ::= value
-          value_list ::= value_list value
-        '''
-        if len(args) == 1:
-            return [args[0]]
-        return args[0] + [args[1]]
-
-    def p_list(self, args):
-        '''
-          list ::= ( )
-          list ::= ( value_list )
-        '''
-        return self.mklist(args)
-
-    def p_bracket_list(self, args):
-        '''
-          bracket_list ::= [ ]
-          bracket_list ::= [ value_list ]
-        '''
-        return self.mklist(args)
-
-    def p_curly_list(self, args):
-        '''
-          curly_list ::= { }
-          curly_list ::= { value_list }
-        '''
-        return [Token('symbol', 'eval')] + self.mklist(args)
-
-    def p_value(self, args):
-        '''
-          value ::= operator
-          value ::= number
-          value ::= operator
-          value ::= symbol
-          value ::= string
-          value ::= single_quote_string
-          value ::= list
-          value ::= curly_list
-          value ::= bracket_list
-         '''
-        return args[0]
 
 class ExternalFunctions(object):
     '''
@@ -179,11 +203,42 @@ class ExternalFunctions(object):
         logging.getLogger("mom.Evaluator").debug("debug: %s", values)
         return values[-1]
 
+
 class GenericEvaluator(object):
     operator_map = {}
 
-    def __init__(self):
-        pass
+    # Calls of builtins and user functions are recorded in this dictionary,
+    # see profiled().  Code is instrumented only when compiled by an evaluator
+    # with a profile.
+    profile = None
+
+    # Builtins without side effects, which are evaluated at compile time when
+    # all of their arguments are constants
+    foldable = frozenset()
+
+    # What the compiler may assume about the whole program, see
+    # Optimizer.Program.  The names bound to constants with their values, the
+    # trivial functions to inline as name -> (parameters, body, parameters
+    # used as objects), every name the program may bind and whether debug()
+    # calls do nothing.  No optimisation is done without constants.
+    constants = None
+    functions = None
+    variables = frozenset()
+    strip_debug = False
+
+    def __init__(self, bindings=None):
+        # Names bound by the code compiled and the stacks of this evaluator,
+        # shared with the evaluators running the compiled code
+        self.bindings = Bindings() if bindings is None else bindings
+        # CompileScopes of the function being compiled, innermost last
+        self._scopes = []
+        # Effects of the function or (with ...) body being compiled which
+        # prevent evaluating it for several guests in parallel, see _note()
+        self._effects = None
+        # Names of the body being compiled which hold the guest it is
+        # evaluated for: True for the iterator of a (with ...) body, the
+        # index of the parameter for a function body
+        self._entities = {}
 
     def get_operators(self):
         """
@@ -202,6 +257,25 @@ class GenericEvaluator(object):
         parser = Parser(start='value_list')
         return parser.parse(tokens)
 
+    def get_signature(self, fn):
+        """
+        Return the list of argument types declared by the docstring of
+        builtin 'fn'.  Docstrings are parsed only on first use and the result
+        is kept in a signature table owned by the evaluator class, so callers
+        must not modify the returned list.
+        """
+        cls = type(self)
+        signatures = cls.__dict__.get('_signatures')
+        if signatures is None:
+            signatures = {}
+            cls._signatures = signatures
+        try:
+            return signatures[fn.__name__]
+        except KeyError:
+            types = self.parse_doc(fn.__doc__)
+            signatures[fn.__name__] = types
+            return types
+
     # TODO: split up doc parsing...
     # use elipse syntax to indicate repetition in a
     # list.  IOW:
@@ -216,7 +290,7 @@ class GenericEvaluator(object):
         if doc == None:
             args = map(self.eval, args)
         else:
-            types = self.parse_doc(doc)
+            types = list(self.get_signature(fn))
 
             # check if we can check arity - it is not possible when variable
             # number of arguments is expected
@@ -282,43 +356,527 @@ class GenericEvaluator(object):
         else:
             raise PolicyError('Unknown function "%s" with no default handler' % name)
 
-class VariableStack(object):
+    def compile(self, code):
+        """
+        Lower a parsed expression into a Python closure.  The closure takes
+        the evaluator instance as its only argument and returns the same value
+        as eval() would for the same code.  All type checks, operator and
+        builtin lookups are resolved once here instead of on every evaluation.
+
+        Variable references are resolved the same way when possible: a name
+        that is certainly bound in one of the scopes opened by the code being
+        compiled is read from that scope directly, and a name that was never
+        bound outside of the global scope is read from the global scope.
+        Everything else searches the stack at evaluation time, so the dynamic
+        scoping of the language is kept.  The compiled code must be evaluated
+        by evaluators sharing the Bindings of this one.
+
+        Expressions that cannot be lowered (eg. malformed ones) are compiled
+        into a closure that defers to eval(), so any error is still raised at
+        evaluation time exactly as before.
+        """
+        if isinstance(code, Token):
+            return self._compile_token(code)
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return self._compile_fallback(code)
+
+        name = self._name(code[0])
+        if name is None:
+            return self._compile_fallback(code)
+
+        value = self.fold(code)
+        if value is not NOT_CONSTANT:
+            return lambda e: value
+
+        raw_args = code[1:]
+        handler = getattr(type(self), 'c_%s' % name, None)
+        if name == 'debug' and self.strip_debug and raw_args:
+            return self._compile_debug(raw_args)
+        if name.split('.')[0] in self.bindings.names:
+            parts = name.split('.')
+            if len(parts) > 1 and parts[-1] not in PURE_METHODS:
+                self._note_method(parts[0])
+            # Anything callable on the variable stack takes precedence over
+            # the builtins, exactly like in eval()
+            if handler is not None and self._scopes:
+                # ...and the builtin might bind names if the variable is gone
+                self._scopes[-1].opaque = True
+            func = self._compile_lookup(name, allow_undefined=True)
+            args = map(self.compile, raw_args)
+
+            def call(e):
+                f = func(e)
+                if f is not None:
+                    return f(*[arg(e) for arg in args])
+                return e.eval(code)
+            return call
+
+        if handler is not None:
+            form = getattr(self, '_compile_%s' % name, None)
+            if form is not None:
+                builtin = form(raw_args)
+            elif handler.__doc__ is not None:
+                builtin = None
+            else:
+                builtin = self._compile_call(handler,
+                                             map(self.compile, raw_args))
+        elif hasattr(self, 'default'):
+            inlined = self._inline(name, raw_args)
+            if inlined is not None:
+                return self.compile(inlined)
+            builtin = self._compile_default(name, raw_args)
+        else:
+            builtin = None
+        if builtin is None:
+            call = self._compile_fallback(code)
+        else:
+            # The name might get bound only after compilation (eg. by another
+            # policy), eval() then takes care of calling the variable
+            names = self.bindings.names
+            key = name.split('.')[0]
+
+            def call(e):
+                if key in names:
+                    return e.eval(code)
+                return builtin(e)
+
+        if self.profile is None:
+            return call
+        elif handler is not None:
+            return profiled('builtins', name, call)
+        elif name != 'eval' and '.' not in name:
+            return profiled('functions', name, call)
+        return call
+
+    def _name(self, node):
+        """
+        Return the name of the function called by an expression whose first
+        element is token 'node', or None if it is not a valid one.
+        """
+        if node.kind == 'symbol':
+            return node.value
+        elif node.kind == 'operator' and node.value in self.operator_map:
+            return self.operator_map[node.value]
+        return None
+
+    def fold(self, code):
+        """
+        Evaluate code at compile time if its value only depends on literals
+        and constants, see the constants attribute.  Errors are left for the
+        evaluation to raise.
+        Return: The value, or NOT_CONSTANT
+        """
+        if self.constants is None:
+            return NOT_CONSTANT
+        if isinstance(code, Token):
+            if code.kind == 'symbol':
+                if code.value == 'nil':
+                    return None
+                return self.constants.get(code.value, NOT_CONSTANT)
+            elif code.kind in ('number', 'string'):
+                try:
+                    return self.eval(code)
+                except PolicyError:
+                    pass
+            return NOT_CONSTANT
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return NOT_CONSTANT
+        name = self._name(code[0])
+        if name not in self.foldable or name in self.variables or \
+                name in self.bindings.names:
+            return NOT_CONSTANT
+        if name == 'if':
+            if len(code) != 4:
+                return NOT_CONSTANT
+            cond = self.fold(code[1])
+            if cond is NOT_CONSTANT:
+                return NOT_CONSTANT
+            return self.fold(code[2] if cond else code[3])
+
+        args = map(self.fold, code[1:])
+        if NOT_CONSTANT in args:
+            return NOT_CONSTANT
+        try:
+            return getattr(self, 'c_%s' % name)(*args)
+        except Exception:
+            return NOT_CONSTANT
+
+    def _pure(self, code):
+        """
+        Check that evaluating code has no effect and cannot raise an error
+        about an undefined symbol, so that it can be left out.
+        """
+        if isinstance(code, Token):
+            if code.kind == 'symbol':
+                return code.value == 'nil' or \
+                    self.fold(code) is not NOT_CONSTANT or \
+                    self._bound(code.value)
+            elif code.kind == 'number':
+                try:
+                    self.eval_number(code)
+                except PolicyError:
+                    return False
+                return True
+            return code.kind == 'string'
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return False
+        name = self._name(code[0])
+        if name is None:
+            return False
+        parts = name.split('.')
+        if len(parts) == 2:
+            pure = parts[1] in PURE_METHODS and self._bound(parts[0])
+        elif name == 'debug':
+            pure = self.strip_debug
+        else:
+            pure = name in self.foldable and name not in self.variables
+        return pure and all(map(self._pure, code[1:]))
+
+    def _bound(self, name):
+        """
+        Check that variable 'name' is certainly bound by the code being
+        compiled at this point
+        """
+        depth = self._scope_depth(name)
+        return depth is not None and depth < len(self._scopes)
+
+    def _compile_debug(self, raw_args):
+        """
+        Compile a call of debug() while it prints nothing: only the arguments
+        with side effects and the last one, which is returned, are evaluated.
+        """
+        args = [self.compile(arg) for arg in raw_args[:-1]
+                if not self._pure(arg)]
+        last = self.compile(raw_args[-1])
+        if not args:
+            return last
+
+        def call(e):
+            for arg in args:
+                arg(e)
+            return last(e)
+        return call
+
+    def _inline(self, name, raw_args):
+        """
+        Return the body of trivial function 'name' with its parameters
+        replaced by the arguments of a call, or None if the call has to be
+        compiled as such.  Only literals and symbols are substituted, since
+        they evaluate the same wherever and however often they are evaluated.
+        """
+        if not self.functions or name not in self.functions:
+            return None
+        params, body, dotted = self.functions[name]
+        if len(params) != len(raw_args):
+            return None
+
+        args = {}
+        for param, arg in zip(params, raw_args):
+            if not isinstance(arg, Token) or \
+                    arg.kind not in ('symbol', 'number', 'string'):
+                return None
+            if param in dotted and (arg.kind != 'symbol' or
+                                    '.' in arg.value or arg.value == 'nil'):
+                return None
+            # Arguments are evaluated after binding the previous parameters
+            if arg.kind == 'symbol' and arg.value.split('.')[0] in args:
+                return None
+            args[param] = arg
+        return substitute(body, args)
+
+    def _note(self, effect):
+        """
+        Record an effect of the code being compiled: 'write' for assignments
+        of names the code does not bind itself, 'host' for calls of methods
+        with side effects on anything but the guest of the body, ('arg', i)
+        for such calls on parameter i, 'def', 'with', 'eval' for code left to
+        eval() and ('call', name, args) for calls of user function 'name',
+        args telling which arguments are the guest, see parallel_safe().
+        """
+        if self._effects is not None:
+            self._effects.add(effect)
+
+    def _note_method(self, name):
+        """
+        Record a call of a method with side effects on variable 'name'
+        """
+        entity = self._entities.get(name)
+        if entity is None:
+            # Host, or any variable which may hold it or another guest
+            self._note('host')
+        elif entity is not True:
+            self._note(('arg', entity))
+
+    def _compile_fallback(self, code):
+        # eval() may bind any name in the current scope
+        if self._scopes:
+            self._scopes[-1].opaque = True
+        self._note('eval')
+        return lambda e: e.eval(code)
+
+    def _compile_token(self, code):
+        if code.kind == 'number':
+            try:
+                value = self.eval_number(code)
+            except PolicyError:
+                return self._compile_fallback(code)
+            return lambda e: value
+        elif code.kind == 'string':
+            value = code.value[1:-1]
+            return lambda e: value
+        elif code.kind == 'symbol':
+            if code.value == 'nil':
+                return lambda e: None
+            value = self.fold(code)
+            if value is not NOT_CONSTANT:
+                return lambda e: value
+            return self._compile_lookup(code.value)
+        else:
+            return self._compile_fallback(code)
+
+    def _compile_call(self, fn, args):
+        """
+        Compile a call of builtin 'fn' whose arguments are all evaluated.  The
+        common arities are unrolled to avoid building an argument list.
+        """
+        if len(args) == 1:
+            a, = args
+            return lambda e: fn(e, a(e))
+        elif len(args) == 2:
+            a, b = args
+            return lambda e: fn(e, a(e), b(e))
+        return lambda e: fn(e, *[arg(e) for arg in args])
+
+    def _compile_default(self, name, raw_args):
+        return lambda e: e.default(name, raw_args)
+
+    def _scope_depth(self, key):
+        """
+        Return the number of scopes above the one certainly holding variable
+        'key' at the current point of the compiled code, len(self._scopes) if
+        the code being compiled does not bind it, or None if it cannot be
+        known.
+        """
+        depth = 0
+        for scope in reversed(self._scopes):
+            if scope.opaque:
+                return None
+            if key in scope.possible:
+                if key not in scope.definite:
+                    return None
+                break
+            depth += 1
+        return depth
+
+    def _compile_scope(self, key):
+        """
+        Resolve the scope holding variable 'key' at the current point of the
+        compiled code.
+        Return: A closure returning that Scope, or None if the stack has to be
+                searched.  The closure itself may return None, too.
+        """
+        depth = self._scope_depth(key)
+        if depth is None:
+            return None
+        elif depth == len(self._scopes):
+            # Not bound by the code being compiled.  Unless some code binds
+            # the name in an inner scope, it can only be a global.
+            local_names = self.bindings.local_names
+            if key in local_names:
+                return None
+            return lambda e: None if key in local_names else e.stack.globals
+
+        if depth == 0:
+            return lambda e: e.stack.scope
+        elif depth == 1:
+            return lambda e: e.stack.scope.parent
+
+        def scope_of(e):
+            scope = e.stack.scope
+            for i in xrange(depth):
+                scope = scope.parent
+            return scope
+        return scope_of
+
+    def _compile_lookup(self, name, allow_undefined=False):
+        """
+        Compile a read of variable 'name' with the semantics of
+        VariableStack.get().
+        """
+        parts = name.split('.')
+        key = parts[0]
+        scope_of = self._compile_scope(key)
+        if scope_of is None:
+            return lambda e: e.stack.get(name, allow_undefined)
+
+        if len(parts) == 1:
+            def lookup(e):
+                scope = scope_of(e)
+                if scope is not None and key in scope:
+                    return scope[key]
+                return e.stack.get(name, allow_undefined)
+        else:
+            attr = parts[1]
+
+            def lookup(e):
+                scope = scope_of(e)
+                if scope is not None and key in scope:
+                    try:
+                        return getattr(scope[key], attr)
+                    except AttributeError:
+                        pass
+                return e.stack.get(name, allow_undefined)
+        return lookup
+
+    def _compile_assign(self, name):
+        """
+        Compile a write of variable 'name' with the semantics of
+        VariableStack.set() without allocation.
+        """
+        depth = self._scope_depth(name)
+        if depth is None or depth == len(self._scopes):
+            self._note('write')
+        self._entities.pop(name, None)
+        scope_of = self._compile_scope(name)
+        if scope_of is None:
+            return lambda e, value: e.stack.set(name, value)
+
+        def assign(e, value):
+            scope = scope_of(e)
+            if scope is not None and name in scope:
+                scope[name] = value
+                return value
+            return e.stack.set(name, value)
+        return assign
+
+    def _bind(self, name):
+        """
+        Record that the code being compiled binds 'name' in the innermost scope
+        at this point.
+        """
+        self.bindings.add(name, bool(self._scopes))
+        # The name may not hold the guest any more
+        self._entities.pop(name, None)
+        if self._scopes:
+            scope = self._scopes[-1]
+            scope.definite.add(name)
+            scope.possible.add(name)
+
+    def _save_scopes(self):
+        return [(scope.definite.copy(), scope.possible.copy(), scope.opaque)
+                for scope in self._scopes]
+
+    def _restore_scopes(self, saved):
+        for scope, (definite, possible, opaque) in zip(self._scopes, saved):
+            scope.definite = definite
+            scope.possible = possible
+            scope.opaque = opaque
+
+    def _merge_scopes(self, saved):
+        """
+        Merge the state of another branch of the code into the current one
+        """
+        for scope, (definite, possible, opaque) in zip(self._scopes, saved):
+            scope.definite &= definite
+            scope.possible |= possible
+            scope.opaque |= opaque
+
+
+class Scope(dict):
+    """
+    A single level of the VariableStack.  Scopes are chained through their
+    parent so that entering and leaving one never copies the stack.
+    """
+    __slots__ = ('parent',)
+
+    def __init__(self, parent=None):
+        dict.__init__(self)
+        self.parent = parent
+
+
+class CompileScope(object):
+    """
+    Compile-time image of a Scope: the names that are certainly and the names
+    that may be bound in it at the current point of the compiled code.  An
+    opaque scope can hold anything.
+    """
+    def __init__(self, opaque=False):
+        self.definite = set()
+        self.possible = set()
+        self.opaque = opaque
+
+
+class Bindings(object):
+    """
+    Every name bound by the code compiled by a set of evaluators or allocated
+    on their stacks, and every name bound in a scope but the global one.
+    Compiled code relies on them to know which names can be looked up
+    directly.  The names are only added, by any thread.
+    """
     def __init__(self):
-        self.stack = []
+        self.names = set()
+        self.local_names = set()
+        self.lock = threading.Lock()
+
+    def add(self, name, local=False):
+        if name in self.names and (not local or name in self.local_names):
+            return
+        with self.lock:
+            self.names.add(name)
+            if local:
+                self.local_names.add(name)
+
+
+class VariableStack(object):
+    def __init__(self, bindings):
+        self.bindings = bindings
+        self.scope = None
+        self.globals = None
 
     def enter_scope(self):
-        self.stack = [{}] + self.stack
+        self.scope = Scope(self.scope)
+        if self.globals is None:
+            self.globals = self.scope
 
     def leave_scope(self):
-        self.stack = self.stack[1:]
+        self.scope = self.scope.parent
+        if self.scope is None:
+            self.globals = None
 
     def get(self, name, allow_undefined=False):
         # Split the name on '.' to handle object references
         parts = name.split('.')
         obj = parts[0]
-        for scope in self.stack:
-            if scope.has_key(obj):
+        scope = self.scope
+        while scope is not None:
+            if obj in scope:
                 if len(parts) > 1:
                     if hasattr(scope[obj], parts[1]):
                         return getattr(scope[obj], parts[1])
                 else:
                     return scope[obj]
+            scope = scope.parent
         if allow_undefined:
             return None
         raise PolicyError("undefined symbol %s" % name)
 
     def set(self, name, value, alloc=False):
         if alloc:
-            self.stack[0].setdefault(name, value)
-            return self.stack[0][name]
+            self.bindings.add(name, self.scope is not self.globals)
+            return self.scope.setdefault(name, value)
 
-        for scope in self.stack:
-            if scope.has_key(name):
+        scope = self.scope
+        while scope is not None:
+            if name in scope:
                 scope[name] = value
                 return value
+            scope = scope.parent
 
         raise PolicyError("undefined symbol %s" % name)
 
+
 class Evaluator(GenericEvaluator):
     operator_map = {'+': 'add', '-': 'sub',
                     '*': 'mul', '/': 'div',
@@ -329,13 +887,40 @@ class Evaluator(GenericEvaluator):
                     'and': 'and', 'or': 'or', 'not': 'not',
                     'min': 'min', 'max': 'max', "null": "null"}
 
-    def __init__(self):
-        GenericEvaluator.__init__(self)
-        self.stack = VariableStack()
+    foldable = frozenset(['add', 'sub', 'mul', 'div', 'lt', 'gt', 'lte', 'gte',
+                          'eq', 'neq', 'shl', 'shr', 'and', 'or', 'not',
+                          'min', 'max', 'null', 'if'])
+
+    # When set, compiled (with Guests ...) statements first try to evaluate
+    # their body for all guests at once with vectorize(e, iterator, guests,
+    # code, state), see Vector.evaluate()
+    vectorize = None
+
+    # When set, compiled (with Guests ...) statements of the global scope
+    # whose body only changes its own variables and the guest it is evaluated
+    # for split the guests in parallel.size batches evaluated concurrently by
+    # parallel.map(function, batches), see evaluate_parallel().  Profiled
+    # evaluations are never split.
+    parallel = None
+
+    def __init__(self, bindings=None):
+        GenericEvaluator.__init__(self, bindings)
+        self.stack = VariableStack(self.bindings)
         self.funcs = {}
         self.stack.enter_scope()
         self.import_externs()
 
+    def fork(self):
+        """
+        Return an evaluator sharing the functions and the variables visible
+        at this point, with a stack of its own on top of them.
+        """
+        e = copy.copy(self)
+        e.stack = VariableStack(self.bindings)
+        e.stack.scope = self.stack.scope
+        e.stack.globals = self.stack.globals
+        return e
+
     def import_externs(self):
         for i in dir(ExternalFunctions):
             if not re.match("__", i):
@@ -356,7 +941,7 @@ class Evaluator(GenericEvaluator):
         if name == 'eval':
             return map(self.eval, args)[-1]
 
-        params, code = self.funcs[name]
+        params, code, body = self.funcs[name]
         if len(params) != len(args):
             raise PolicyError('Function "%s" invoked with incorrect arity' % name)
 
@@ -366,25 +951,115 @@ class Evaluator(GenericEvaluator):
 
         return self.eval([Token('symbol', 'let'), scope, code])
 
+    def _compile_default(self, name, raw_args):
+        if name == 'eval':
+            if not raw_args:
+                return None
+            args = map(self.compile, raw_args)
+
+            def block(e):
+                for arg in args:
+                    result = arg(e)
+                return result
+            return block
+
+        self._note(('call', name, tuple(
+            (arg.value, self._entities[arg.value])
+            if self._is_symbol(arg) and arg.value in self._entities else None
+            for arg in raw_args)))
+        # Arguments are evaluated one by one in the scope of the called
+        # function, the same way the let generated by default() does it.  The
+        # names bound there are not known at this point.
+        self._scopes.append(CompileScope(opaque=True))
+        args = map(self.compile, raw_args)
+        self._scopes.pop()
+
+        def call(e):
+            params, code, body = e.funcs[name]
+            if body is None:
+                return e.default(name, raw_args)
+            if len(params) != len(args):
+                raise PolicyError('Function "%s" invoked with incorrect arity'
+                                  % name)
+            e.stack.enter_scope()
+            scope = e.stack.scope
+            for param, arg in zip(params, args):
+                scope.setdefault(param.value, arg(e))
+            result = body(e)
+            e.stack.leave_scope()
+            return result
+        return call
+
+    def _is_symbol(self, code):
+        return isinstance(code, Token) and code.kind == 'symbol'
+
     def c_def(self, name, params, code):
         'symbol code code'
-        self.funcs[name] = (params, code)
+        self.funcs[name] = (params, code, None)
         return name
 
+    def _compile_def(self, args):
+        if len(args) != 3 or not self._is_symbol(args[0]):
+            return None
+        name, params, code = args[0].value, args[1], args[2]
+        self._note('def')
+        if type(params) == list and all(map(self._is_symbol, params)):
+            # The body runs in a new scope holding the parameters, on top of
+            # whatever scope the function gets called from
+            outer = self._scopes, self._effects, self._entities
+            self._scopes = [CompileScope()]
+            self._effects = set()
+            for param in params:
+                self._bind(param.value)
+            self._entities = dict((param.value, index)
+                                  for index, param in enumerate(params))
+            body = self.compile(code)
+            # Looked up by parallel_safe() through the functions table
+            body.effects = frozenset(self._effects)
+            self._scopes, self._effects, self._entities = outer
+        else:
+            # Let default() report the malformed parameter list
+            body = None
+
+        def define(e):
+            e.funcs[name] = (params, code, body)
+            return name
+        return define
+
     # defun is an alias to def, maintain def for backwards compatibility
     c_defun = c_def
+    _compile_defun = _compile_def
 
     def c_set(self, name, value):
         'symbol value'
         return self.stack.set(name, value)
 
+    def _compile_set(self, args):
+        if len(args) != 2 or not self._is_symbol(args[0]):
+            return None
+        name, value = args[0].value, self.compile(args[1])
+        assign = self._compile_assign(name)
+        return lambda e: assign(e, value(e))
+
     # setq is an alias to set here, note that in lisp set evaluates it's first argument as well
     c_setq = c_set
+    _compile_setq = _compile_set
 
     def c_defvar(self, name, value):
         'symbol value'
         return self.stack.set(name, value, True)
 
+    def _compile_defvar(self, args):
+        if len(args) != 2 or not self._is_symbol(args[0]):
+            return None
+        name, value = args[0].value, self.compile(args[1])
+        self._bind(name)
+
+        def defvar(e):
+            result = value(e)
+            return e.stack.scope.setdefault(name, result)
+        return defvar
+
     def c_let(self, syms, *code):
         'code code ...'
         if type(syms) != list:
@@ -403,6 +1078,35 @@ class Evaluator(GenericEvaluator):
         self.stack.leave_scope()
         return result
 
+    def _compile_let(self, args):
+        if len(args) < 2 or type(args[0]) != list:
+            return None
+        for sym in args[0]:
+            if type(sym) != list or len(sym) != 2 or \
+                    not self._is_symbol(sym[0]):
+                return None
+
+        # Values are evaluated in the new scope, after the preceding names
+        # are bound
+        self._scopes.append(CompileScope())
+        bindings = []
+        for name, value in args[0]:
+            bindings.append((name.value, self.compile(value)))
+            self._bind(name.value)
+        body = map(self.compile, args[1:])
+        self._scopes.pop()
+
+        def let(e):
+            e.stack.enter_scope()
+            scope = e.stack.scope
+            for name, value in bindings:
+                scope.setdefault(name, value(e))
+            for expr in body:
+                result = expr(e)
+            e.stack.leave_scope()
+            return result
+        return let
+
     def c_with(self, iterable, iterator, code):
         'symbol symbol code'
 
@@ -419,6 +1123,47 @@ class Evaluator(GenericEvaluator):
             self.stack.leave_scope()
         return result
 
+    def _compile_with(self, args):
+        if len(args) != 3 or not self._is_symbol(args[0]) or \
+                not self._is_symbol(args[1]) or args[0].value != 'Guests':
+            return None
+        iterator, code = args[1].value, args[2]
+        items = self._compile_lookup(args[0].value)
+        self._note('with')
+        # Only statements evaluated in the global scope may run in parallel
+        top = not self._scopes
+        outer, entities = self._effects, self._entities
+        self._effects = set()
+        self._scopes.append(CompileScope())
+        self._bind(iterator)
+        self._entities = {iterator: True}
+        body = self.compile(code)
+        self._scopes.pop()
+        effects = frozenset(self._effects)
+        self._effects, self._entities = outer, entities
+        if outer is not None:
+            outer |= effects
+
+        state = {}
+
+        def with_(e):
+            guests = items(e)
+            if e.vectorize is not None and guests:
+                result = e.vectorize(e, iterator, guests, code, state)
+                if result is not None:
+                    return result
+            if top and e.parallel is not None and e.profile is None and \
+                    len(guests) > 1 and parallel_safe(e, effects):
+                return evaluate_parallel(e, iterator, guests, body)
+            result = []
+            for item in guests:
+                e.stack.enter_scope()
+                e.stack.scope[iterator] = item
+                result.append(body(e))
+                e.stack.leave_scope()
+            return result
+        return with_
+
     def c_if(self, cond, yes, no):
         'value code code'
 
@@ -427,6 +1172,24 @@ class Evaluator(GenericEvaluator):
         else:
             return self.eval(no)
 
+    def _compile_if(self, args):
+        if len(args) != 3:
+            return None
+        value = self.fold(args[0])
+        if value is not NOT_CONSTANT:
+            # Only one of the branches can ever be evaluated
+            return self.compile(args[1] if value else args[2])
+        cond = self.compile(args[0])
+        # Only one of the branches is evaluated, a name is certainly bound
+        # after the if only if both branches bind it
+        before = self._save_scopes()
+        yes = self.compile(args[1])
+        after_yes = self._save_scopes()
+        self._restore_scopes(before)
+        no = self.compile(args[2])
+        self._merge_scopes(after_yes)
+        return lambda e: yes(e) if cond(e) else no(e)
+
     def c_add(self, x, y):
         return x + y
 
@@ -485,22 +1248,155 @@ class Evaluator(GenericEvaluator):
             # some value is not null and not iterable
             return False
 
-def get_code(e, string):
+
+def get_code(e, string, allow_empty=False):
     try:
         scanner = Scanner(e.get_operators())
         tokens = scanner.tokenize(string)
+        if allow_empty and not tokens:
+            return []
         parser = Parser(start='value_list')
         return parser.parse(tokens)
     except SystemExit:
         raise PolicyError("parse error")
 
+
+def compile(e, code):
+    """
+    Compile every top-level expression of parsed code into a closure, see
+    GenericEvaluator.compile().
+    """
+    return map(e.compile, code)
+
+
+def substitute(code, args):
+    """
+    Return a copy of parsed code where the symbols named in 'args', including
+    the objects of dotted ones, are replaced by the corresponding tokens.
+    """
+    if isinstance(code, Token):
+        if code.kind == 'symbol':
+            parts = code.value.split('.', 1)
+            arg = args.get(parts[0])
+            if arg is not None:
+                if len(parts) == 1:
+                    return arg
+                return Token('symbol', '%s.%s' % (arg.value, parts[1]))
+        return code
+    return [substitute(c, args) for c in code]
+
+
+def parallel_safe(e, effects, guest=(), seen=None):
+    """
+    Check that compiled code with 'effects', including the user functions it
+    calls, can be evaluated for several guests in any order.  The parameters
+    of index in 'guest' hold the guest the code is evaluated for.
+    """
+    if seen is None:
+        seen = set()
+    for effect in effects:
+        if type(effect) != tuple:
+            return False
+        if effect[0] == 'arg':
+            if effect[1] not in guest:
+                return False
+            continue
+        name, args = effect[1:]
+        params, _, body = e.funcs.get(name, (None, None, None))
+        if body is None:
+            return False
+        # Arguments are evaluated after binding the previous parameters
+        names = [param.value for param in params]
+        passed = frozenset(
+            index for index, arg in enumerate(args)
+            if arg is not None and arg[0] not in names[:index] and
+            (arg[1] is True or arg[1] in guest))
+        if (name, passed) in seen:
+            continue
+        seen.add((name, passed))
+        called = getattr(body, 'effects', None)
+        if called is None or not parallel_safe(e, called, passed, seen):
+            return False
+    return True
+
+
+def evaluate_parallel(e, iterator, guests, body):
+    """
+    Evaluate the compiled body of a (with Guests iterator body) statement for
+    batches of guests at once with e.parallel, each batch in a fork of the
+    evaluator.
+    Return: The list of results, in the order of the guests
+    """
+    guests = list(guests)
+    size = -(-len(guests) // e.parallel.size)
+
+    def run(batch):
+        fork = e.fork()
+        result = []
+        for item in batch:
+            fork.stack.enter_scope()
+            fork.stack.scope[iterator] = item
+            result.append(body(fork))
+            fork.stack.leave_scope()
+        return result
+    result = []
+    for batch in e.parallel.map(run, [guests[i:i + size] for i in
+                                      xrange(0, len(guests), size)]):
+        result.extend(batch)
+    return result
+
+
+def profiled(section, name, fn):
+    """
+    Wrap compiled code so that its calls are recorded in the profile of the
+    evaluator running it, if any.  The profile maps (section, name) to
+    [calls, cumulative wall time in seconds, running], the time of recursive
+    calls is included in the outermost one only.
+    """
+    key = (section, name)
+
+    def call(e):
+        profile = e.profile
+        if profile is None:
+            return fn(e)
+        entry = profile.get(key)
+        if entry is None:
+            entry = profile[key] = [0, 0.0, False]
+        entry[0] += 1
+        if entry[2]:
+            return fn(e)
+        entry[2] = True
+        start = time.time()
+        try:
+            return fn(e)
+        finally:
+            entry[1] += time.time() - start
+            entry[2] = False
+    return call
+
+
+def summarize(code, width=40):
+    """
+    Return the beginning of the source text of a parsed expression
+    """
+    def text(code):
+        if isinstance(code, Token):
+            return str(code.value)
+        return '(%s)' % ' '.join(map(text, code))
+    string = text(code)
+    if len(string) > width:
+        string = string[:width - 3] + '...'
+    return string
+
+
 def eval(e, string):
-    code = get_code(e, string)
+    code = compile(e, get_code(e, string))
     results = []
     for expr in code:
-        results.append(e.eval(expr))
+        results.append(expr(e))
     return results
 
+
 def repl(e):
     while True:
         print '>>>',
@@ -511,6 +1407,7 @@ def repl(e):
 
         print eval(e, string)[0]
 
+
 if __name__ == '__main__':
     import sys
 
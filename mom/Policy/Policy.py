@@ -14,18 +14,73 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import hashlib
 import logging
 import threading
+from multiprocessing.pool import ThreadPool
+from Parser import Bindings
 from Parser import Evaluator
 from Parser import get_code
+from Parser import profiled
+from Parser import summarize
 from Parser import PolicyError
+import Optimizer
+import Vector
 
 DEFAULT_POLICY_NAME = "50_main_"
 
+class WorkerPool(object):
+    """
+    Threads evaluating batches of guests, see Evaluator.parallel
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pool = ThreadPool(size)
+
+    def map(self, fn, batches):
+        return self.pool.map(fn, batches)
+
+    def close(self):
+        """
+        Stop the threads once the batches in progress are done
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """
+        Stop the threads without waiting for the batches in progress
+        """
+        self.pool.terminate()
+
 class Policy:
-    def __init__(self):
+    def __init__(self, vectorize=False, profile=False, workers=0):
         self.logger = logging.getLogger('mom.Policy')
+        if vectorize and not Vector.available():
+            self.logger.warn("NumPy is not available, policies will not be "
+                             "vectorized")
+            vectorize = False
+        self.vectorize = vectorize
+        # Calls and time spent in the policies since the last reset, in the
+        # format of Evaluator.profile.  None if profiling is disabled.
+        self.profile = {} if profile else None
+        # Threads evaluating (with Guests ...) statements in parallel
+        self.pool = WorkerPool(workers) if workers > 0 else None
         self.policy_sem = threading.Semaphore()
+        # Names bound by the compiled policies, see Parser.Bindings.  The
+        # evaluators compiling and running them share it.
+        self.bindings = Bindings()
+        # Parsed and compiled code of each named policy, indexed by name.
+        # Parsed entries are (digest of the policy string, parsed code, names
+        # of the symbols in it), compiled ones (signature, list of compiled
+        # expressions) where the signature covers the digest and everything
+        # the optimisations relied on, see Optimizer.Program.signature().
+        # Both outlive clear_policy() so that reloading unchanged policies is
+        # cheap.
+        self.parsed = {}
+        self.compiled = {}
+        # Whether the policies were compiled to print debug output
+        self.debug = self._debug_enabled()
         self.clear_policy()
 
     def get_strings(self, name=None):
@@ -47,28 +102,100 @@ class Policy:
         keys = sorted(self.policy_strings.iterkeys())
         return '\n'.join(self.policy_strings[k] for k in keys) or '0'
 
+    def _cat_code(self):
+        """
+        Join the compiled code of all policies in the same order as
+        _cat_policies() joins their strings.
+        Return: A tuple, which is never modified once published as self.code
+        """
+        code = []
+        for name in sorted(self.policy_strings.iterkeys()):
+            code.extend(self.compiled[name][1])
+        return tuple(code)
+
+    def _debug_enabled(self):
+        return logging.getLogger('mom.Evaluator').isEnabledFor(logging.DEBUG)
+
+    def _parse(self, name, policyStr):
+        """
+        Parse one named policy unless the same string was already parsed
+        under this name.
+        """
+        if isinstance(policyStr, unicode):
+            digest = hashlib.sha1(policyStr.encode('utf-8')).hexdigest()
+        else:
+            digest = hashlib.sha1(policyStr).hexdigest()
+        cached = self.parsed.get(name)
+        if cached is not None and cached[0] == digest:
+            return
+
+        # Policies are separated by a newline when concatenated, keep it so
+        # that a trailing comment is terminated the same way
+        parsed = get_code(Evaluator(), policyStr + '\n', allow_empty=True)
+        self.parsed[name] = (digest, parsed, Optimizer.symbols(parsed))
+
+    def _optimize(self):
+        """
+        Analyse the loaded policies as a whole and compile again the ones
+        whose optimised code is no longer valid.
+        """
+        self.debug = self._debug_enabled()
+        names = sorted(self.policy_strings.iterkeys())
+        program = Optimizer.analyze(
+                [(name,) + self.parsed[name][:2] for name in names],
+                reserved=('Host', 'Guests'), strip_debug=not self.debug,
+                # Profiles show the functions the way they are written
+                inline=self.profile is None)
+        for name in names:
+            self._compile(name, program)
+        # evaluate() picks up the new code without taking the lock
+        self.code = self._cat_code()
+
+    def _compile(self, name, program):
+        """
+        Compile one named policy for 'program' unless it was compiled the
+        same way already.
+        """
+        digest, parsed, symbols = self.parsed[name]
+        signature = (digest, program.signature(symbols))
+        cached = self.compiled.get(name)
+        if cached is not None and cached[0] == signature:
+            return
+
+        evaluator = Evaluator(self.bindings)
+        if self.profile is not None:
+            evaluator.profile = {}
+        code = []
+        for i, expr in enumerate(parsed, 1):
+            program.prepare(evaluator, (name, i))
+            compiled = evaluator.compile(expr)
+            if self.profile is not None:
+                compiled = profiled('expressions',
+                                    '%s:%i %s' % (name, i, summarize(expr)),
+                                    compiled)
+            code.append(compiled)
+        self.compiled[name] = (signature, code)
+
     def set_policy(self, name, policyStr):
         if name is None:
             name = DEFAULT_POLICY_NAME
         with self.policy_sem:
-            oldStr = self.policy_strings.get(name)
             if policyStr is None:
                 try:
                     del self.policy_strings[name]
                     self.logger.info("Deleted policy '%s'", name)
                 except KeyError:
                     pass
+                self.parsed.pop(name, None)
+                self.compiled.pop(name, None)
             else:
+                try:
+                    self._parse(name, policyStr)
+                except PolicyError, e:
+                    self.logger.warn("Unable to load policy: %s" % e)
+                    return False
                 self.policy_strings[name] = policyStr
-            try:
-                self.code = get_code(Evaluator(), self._cat_policies())
-            except PolicyError, e:
-                self.logger.warn("Unable to load policy: %s" % e)
-                if oldStr is None:
-                    del self.policy_strings[name]
-                else:
-                    self.policy_strings[name] = oldStr
-                return False
+            self._optimize()
             if policyStr:
                 self.logger.info("Loaded policy '%s'", name)
             return True
@@ -76,25 +203,78 @@ class Policy:
     def clear_policy(self):
         with self.policy_sem:
             self.policy_strings = {}
-            self.code = []
+            self.code = ()
 
     def evaluate(self, host, guest_list):
         results = []
         # each run needs separate evaluator so the stack is clean
-        evaluator = Evaluator()
+        evaluator = Evaluator(self.bindings)
         evaluator.stack.set('Host', host, alloc=True)
         evaluator.stack.set('Guests', guest_list, alloc=True)
+        if self.vectorize:
+            evaluator.vectorize = Vector.evaluate
+        evaluator.parallel = self.pool
+        if self.profile is not None:
+            evaluator.profile = {}
 
-        with self.policy_sem:
-            try:
-                for expr in self.code:
-                    results.append(evaluator.eval(expr))
-                self.logger.debug("Results: %s" % results)
-            except PolicyError as e:
-                self.logger.error("Policy error: %s" % e)
-                return False
-            except Exception as e:
-                #TODO: https://docs.python.org/2/library/traceback.html#traceback.print_exception
-                self.logger.error("Unexpected error when evaluating policy: %s" % e)
-                return False
+        # Debug calls are dropped from the code while they print nothing
+        if self._debug_enabled() != self.debug:
+            with self.policy_sem:
+                if self._debug_enabled() != self.debug:
+                    self._optimize()
+
+        # The lock only protects the publication of the code, so that the
+        # RPC calls using it do not wait for the whole evaluation
+        code = self.code
+        try:
+            for expr in code:
+                results.append(expr(evaluator))
+            self.logger.debug("Results: %s" % results)
+        except PolicyError as e:
+            self.logger.error("Policy error: %s" % e)
+            return False
+        except Exception as e:
+            #TODO: https://docs.python.org/2/library/traceback.html#traceback.print_exception
+            self.logger.error("Unexpected error when evaluating policy: %s" % e)
+            return False
+        finally:
+            if self.profile is not None:
+                self._add_profile(evaluator.profile)
         return True
+
+    def _add_profile(self, profile):
+        with self.policy_sem:
+            for key, (calls, seconds, running) in profile.iteritems():
+                entry = self.profile.setdefault(key, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+
+    def shutdown(self):
+        """
+        Stop the threads evaluating guests in parallel, the policies are
+        evaluated one guest after another from then on
+        """
+        with self.policy_sem:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+    def get_profile(self):
+        """
+        Return the number of calls and the cumulative wall time in seconds of
+        every user function, builtin and top-level expression of the policies
+        since profiling was last reset.  Nothing is recorded unless profiling
+        is enabled.
+        """
+        ret = {'functions': {}, 'builtins': {}, 'expressions': {}}
+        with self.policy_sem:
+            if self.profile is not None:
+                for (section, name), (calls, seconds) in \
+                        self.profile.iteritems():
+                    ret[section][name] = {'calls': calls, 'time': seconds}
+        return ret
+
+    def reset_profile(self):
+        with self.policy_sem:
+            if self.profile is not None:
+                self.profile.clear()
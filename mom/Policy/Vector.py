@@ -0,0 +1,620 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Evaluation of (with Guests ...) bodies for all guests at once.
+
+The body is interpreted a single time.  Every value is either shared by all
+guests or a NumPy array holding one value per guest, so the arithmetic of the
+policy turns into a few array operations no matter how many guests there are.
+Only side-effect free code, Control() and UpdateStatVal() calls are supported.
+The controls are set and the statistics updated are passed on to the Monitors
+once the whole body has been evaluated, until then the statistics are only
+updated in copies.  Anything else, including any error, makes the caller
+evaluate the body one guest at a time instead.
+"""
+
+import logging
+import operator
+from Parser import ExternalFunctions
+from Parser import PURE_METHODS
+from Parser import Token
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Integers are kept in int64 arrays only while both NumPy and Python represent
+# them and everything computed from them exactly
+INT_LIMIT = 2 ** 53
+
+# Maximum depth of nested user function calls
+MAX_DEPTH = 32
+
+ARITHMETIC = {'add': operator.add, 'sub': operator.sub,
+              'mul': operator.mul, 'div': operator.div,
+              'shl': operator.lshift, 'shr': operator.rshift}
+
+COMPARISON = {'lt': operator.lt, 'gt': operator.gt,
+              'lte': operator.le, 'gte': operator.ge,
+              'eq': operator.eq, 'neq': operator.ne}
+
+logger = logging.getLogger('mom.Policy.Vector')
+
+
+class Unsupported(Exception):
+    """
+    The code cannot be evaluated for all guests at once.  A static failure
+    depends only on the code and is not worth trying again.
+    """
+    def __init__(self, message, static=False):
+        Exception.__init__(self, message)
+        self.static = static
+
+
+def available():
+    return numpy is not None
+
+
+def column(values):
+    """
+    Build the array holding one value per guest.  Values which do not all have
+    the same numeric type are kept in an object array.
+    """
+    kinds = set(map(type, values))
+    if kinds == set([float]):
+        array = numpy.array(values, dtype=numpy.float64)
+        if not numpy.isnan(array).any():
+            return array
+    elif kinds == set([bool]):
+        return numpy.array(values, dtype=numpy.bool_)
+    elif kinds <= set([int, long]) and \
+            -INT_LIMIT < min(values) and max(values) < INT_LIMIT:
+        return numpy.array(values, dtype=numpy.int64)
+
+    array = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def kind(value):
+    """
+    Return the NumPy kind of a value: 'b', 'i' or 'f' for numbers that can
+    take part in array operations and 'O' for anything else.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.dtype.kind
+    if type(value) is bool:
+        return 'b'
+    if type(value) in (int, long):
+        if -INT_LIMIT < value < INT_LIMIT:
+            return 'i'
+    elif type(value) is float:
+        return 'f'
+    return 'O'
+
+
+def magnitude(value):
+    if isinstance(value, numpy.ndarray):
+        return int(numpy.abs(value).max())
+    return abs(value)
+
+
+def as_int(value):
+    if isinstance(value, numpy.ndarray):
+        return value.astype(numpy.int64)
+    return int(value)
+
+
+class VectorEvaluator(object):
+    """
+    Interpreter of policy code over all guests.  Variables bound by the code
+    live in a stack of scopes mapping names to (value, bound), where 'bound'
+    is the mask of the guests the name is bound for, or None for all of them.
+    Code in the branches of an if is only meant for the guests in 'mask'.
+    """
+    def __init__(self, e, iterator, items):
+        self.e = e
+        self.size = len(items)
+        self.mask = None
+        self.scopes = [{iterator: (column(items), None)}]
+        self.columns = {}
+        # Control() and UpdateStatVal() calls as (name, entities, args, mask)
+        self.calls = []
+        # The statistics of the guests before they were updated, by Entity
+        self.saved = {}
+        # Code of the user functions the body called, indexed by name
+        self.funcs = {}
+        self.depth = 0
+
+    def run(self, code):
+        """
+        Evaluate the code, see commit() and rollback().
+        Return: The list of results for every guest
+        """
+        with numpy.errstate(all='raise', under='ignore'):
+            return self.values(self.eval(code))
+
+    def commit(self):
+        """
+        Set the controls the code asked for and pass the statistics it
+        updated on to the Monitors, in the order of the calls
+        """
+        for name, entities, args, mask in self.calls:
+            rows = zip(entities.tolist(), *map(self.values, args))
+            for i in self.lanes(mask):
+                if name == 'Control':
+                    rows[i][0].Control(*rows[i][1:])
+                else:
+                    rows[i][0].monitor.update_statistics_variable(
+                        *rows[i][1:])
+
+    def rollback(self):
+        """
+        Give the guests back the statistics they had before the code
+        """
+        for entity, (statistics, fields) in self.saved.iteritems():
+            entity.statistics = statistics
+            entity._fields = fields
+
+    def update_stat(self, entities, args):
+        """
+        Update the statistics of the guests in their Entities only
+        """
+        if len(args) != 2:
+            raise Unsupported('arity mismatch')
+        rows = zip(entities.tolist(), *map(self.values, args))
+        for i in self.lanes(self.mask):
+            entity = rows[i][0]
+            if entity not in self.saved:
+                self.saved[entity] = (entity.statistics, entity._fields)
+                entity.statistics = entity.statistics.snapshot()
+            entity._update_stat(*rows[i][1:])
+        self.calls.append(('UpdateStatVal', entities, args, self.mask))
+        # The methods called before read other statistics
+        self.columns.clear()
+
+    def values(self, value):
+        """
+        Return the list of the values of every guest
+        """
+        if isinstance(value, numpy.ndarray):
+            return value.tolist()
+        return [value] * self.size
+
+    def lanes(self, mask):
+        if mask is None:
+            return xrange(self.size)
+        return numpy.flatnonzero(mask).tolist()
+
+    def covers(self, bound):
+        """
+        Check that all guests code is evaluated for are in the mask 'bound'
+        """
+        if bound is None:
+            return True
+        if self.mask is None:
+            return bool(bound.all())
+        return not (self.mask & ~bound).any()
+
+    def each(self, fn, args):
+        """
+        Call fn with the arguments of each guest, one by one
+        """
+        if not any(isinstance(arg, numpy.ndarray) for arg in args):
+            return fn(*args)
+        return column([fn(*row) for row in zip(*map(self.values, args))])
+
+    def truth(self, value):
+        if not isinstance(value, numpy.ndarray):
+            return bool(value)
+        if value.dtype.kind == 'b':
+            return value
+        if value.dtype.kind in 'if':
+            return value != 0
+        return column([bool(v) for v in value.tolist()])
+
+    def merge(self, cond, yes, no):
+        """
+        Select the value of each guest from 'yes' or 'no' depending on the
+        truth mask 'cond'.  Values of different types are not converted.
+        """
+        if not isinstance(cond, numpy.ndarray):
+            return yes if cond else no
+        if yes is no:
+            return yes
+        if kind(yes) == kind(no) != 'O':
+            return numpy.where(cond, yes, no)
+        return column([y if c else n for c, y, n in
+                       zip(cond.tolist(), self.values(yes), self.values(no))])
+
+    def eval(self, code):
+        if isinstance(code, Token):
+            return self.eval_token(code)
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            raise Unsupported('malformed expression')
+        node = code[0]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator' and node.value in self.e.operator_map:
+            name = self.e.operator_map[node.value]
+        else:
+            raise Unsupported('malformed expression')
+        args = code[1:]
+
+        parts = name.split('.')
+        scope = self.find(parts[0])
+        if scope is not None:
+            if len(parts) == 1:
+                raise Unsupported('call of variable %s' % name, static=True)
+            value, bound = scope[parts[0]]
+            if not self.covers(bound):
+                raise Unsupported('%s is not bound for all guests' % name)
+            return self.method(value, parts[1], map(self.eval, args))
+
+        func = self.e.stack.get(name, allow_undefined=True)
+        if func is not None:
+            return self.call(name, func, map(self.eval, args))
+
+        if name in ARITHMETIC or name in COMPARISON:
+            if len(args) != 2:
+                raise Unsupported('arity mismatch')
+            return self.binary(name, self.eval(args[0]), self.eval(args[1]))
+        form = getattr(self, 'v_%s' % name, None)
+        if form is not None:
+            return form(args)
+        if hasattr(self.e, 'c_%s' % name):
+            raise Unsupported('%s is not supported' % name, static=True)
+        return self.user_call(name, args)
+
+    def eval_token(self, code):
+        if code.kind == 'number':
+            return self.e.eval_number(code)
+        elif code.kind == 'string':
+            return code.value[1:-1]
+        elif code.kind == 'symbol':
+            if code.value == 'nil':
+                return None
+            return self.lookup(code.value)
+        raise Unsupported('unexpected token type "%s"' % code.kind)
+
+    def find(self, name, index=None):
+        """
+        Return the innermost scope binding 'name', looking no further than
+        the scope at 'index'.
+        """
+        if index is None:
+            index = len(self.scopes) - 1
+        for i in xrange(index, -1, -1):
+            if name in self.scopes[i]:
+                return self.scopes[i]
+        return None
+
+    def lookup(self, name, index=None):
+        parts = name.split('.')
+        if index is None:
+            index = len(self.scopes) - 1
+        for i in xrange(index, -1, -1):
+            scope = self.scopes[i]
+            if parts[0] not in scope:
+                continue
+            value, bound = scope[parts[0]]
+            if len(parts) > 1:
+                if not self.covers(bound):
+                    raise Unsupported('%s is not bound for all guests' % name)
+                return self.attribute(value, parts[1])
+            if self.covers(bound):
+                return value
+            # The other guests see the variable of an outer scope
+            return self.merge(bound, value, self.lookup(name, i - 1))
+        return self.e.stack.get(name)
+
+    def attribute(self, value, attr):
+        if not isinstance(value, numpy.ndarray):
+            return getattr(value, attr)
+        key = (id(value), attr)
+        cached = self.columns.get(key)
+        if cached is None or cached[0] is not value:
+            cached = (value, column([getattr(v, attr)
+                                     for v in value.tolist()]))
+            self.columns[key] = cached
+        return cached[1]
+
+    def method(self, value, name, args):
+        if name == 'Control' and isinstance(value, numpy.ndarray):
+            self.calls.append((name, value, args, self.mask))
+            return None
+        if name == 'UpdateStatVal' and isinstance(value, numpy.ndarray):
+            self.update_stat(value, args)
+            return None
+        if name not in PURE_METHODS:
+            raise Unsupported('method %s is not supported' % name,
+                              static=True)
+        if not isinstance(value, numpy.ndarray):
+            return self.each(getattr(value, name), args)
+
+        key = (id(value), name) + tuple(args)
+        try:
+            cached = self.columns.get(key)
+        except TypeError:
+            # Arrays or other unhashable arguments
+            key = cached = None
+        if cached is None or cached[0] is not value:
+            def call(obj, *args):
+                return getattr(obj, name)(*args)
+            cached = (value, self.each(call, [value] + args))
+            if key is not None:
+                self.columns[key] = cached
+        return cached[1]
+
+    def call(self, name, func, args):
+        """
+        Call a function found on the variable stack
+        """
+        if func is ExternalFunctions.abs:
+            if len(args) != 1:
+                raise Unsupported('arity mismatch')
+            x = args[0]
+            if kind(x) == 'b':
+                x = as_int(x)
+            if isinstance(x, numpy.ndarray) and x.dtype.kind in 'if':
+                return numpy.abs(x)
+            return self.each(abs, [x])
+        elif func is ExternalFunctions.debug:
+            if logging.getLogger('mom.Evaluator').isEnabledFor(logging.DEBUG):
+                raise Unsupported('debug output is enabled')
+            return args[-1]
+        elif getattr(func, '__name__', None) in PURE_METHODS and \
+                getattr(func, 'im_self', None) is not None:
+            return self.each(func, args)
+        raise Unsupported('%s is not supported' % name, static=True)
+
+    def binary(self, name, x, y):
+        fn = getattr(self.e, 'c_%s' % name)
+        kx, ky = kind(x), kind(y)
+        if 'O' in (kx, ky):
+            return self.each(fn, [x, y])
+        elif name in COMPARISON:
+            return COMPARISON[name](x, y)
+
+        # Python does not treat booleans as bits in arithmetic
+        if kx == 'b':
+            x, kx = as_int(x), 'i'
+        if ky == 'b':
+            y, ky = as_int(y), 'i'
+        if kx == ky == 'i':
+            mx, my = magnitude(x), magnitude(y)
+            if name in ('add', 'sub'):
+                safe = mx + my < INT_LIMIT
+            elif name == 'mul':
+                safe = mx * my < INT_LIMIT
+            elif name in ('shl', 'shr'):
+                safe = numpy.min(y) >= 0 and my < 53 and \
+                    (name == 'shr' or mx << my < INT_LIMIT)
+            else:
+                safe = True
+            if not safe:
+                return self.each(fn, [x, y])
+        if name == 'div' and self.mask is not None and \
+                isinstance(y, numpy.ndarray):
+            # Do not fail on guests the code is not evaluated for
+            y = numpy.where(self.mask, y, 1)
+        return ARITHMETIC[name](x, y)
+
+    def v_and(self, args):
+        if len(args) != 2:
+            raise Unsupported('arity mismatch')
+        x, y = self.eval(args[0]), self.eval(args[1])
+        return self.merge(self.truth(x), y, x)
+
+    def v_or(self, args):
+        if len(args) != 2:
+            raise Unsupported('arity mismatch')
+        x, y = self.eval(args[0]), self.eval(args[1])
+        return self.merge(self.truth(x), x, y)
+
+    def v_not(self, args):
+        if len(args) != 1:
+            raise Unsupported('arity mismatch')
+        x = self.truth(self.eval(args[0]))
+        if isinstance(x, numpy.ndarray):
+            return ~x
+        return not x
+
+    def _extreme(self, fn, better, args):
+        if not args:
+            raise Unsupported('arity mismatch')
+        values = map(self.eval, args)
+        kinds = map(kind, values)
+        if 'O' in kinds or \
+                not any(isinstance(v, numpy.ndarray) for v in values):
+            return self.each(fn, values)
+        if len(set(kinds)) == 1:
+            return reduce(lambda x, y: numpy.where(better(y, x), y, x), values)
+
+        # Like Python, keep the first of the extreme values and its type.
+        # Numbers compare exactly as floats within INT_LIMIT.
+        best = values[0]
+        index = 0
+        for i, value in enumerate(values[1:], 1):
+            replace = better(value, best)
+            best = numpy.where(replace, value, best)
+            index = numpy.where(replace, i, index)
+        winners = set(kinds[i] for i in numpy.unique(index).tolist())
+        if len(winners) > 1:
+            return self.each(fn, values)
+        dtype = {'b': numpy.bool_, 'i': numpy.int64, 'f': numpy.float64}
+        return best.astype(dtype[winners.pop()])
+
+    def v_min(self, args):
+        return self._extreme(self.e.c_min, operator.lt, args)
+
+    def v_max(self, args):
+        return self._extreme(self.e.c_max, operator.gt, args)
+
+    def v_if(self, args):
+        if len(args) != 3:
+            raise Unsupported('arity mismatch')
+        cond = self.truth(self.eval(args[0]))
+        if not isinstance(cond, numpy.ndarray):
+            return self.eval(args[1] if cond else args[2])
+
+        mask = self.mask
+        yes = cond if mask is None else mask & cond
+        no = ~cond if mask is None else mask & ~cond
+        if not no.any():
+            return self.eval(args[1])
+        elif not yes.any():
+            return self.eval(args[2])
+        try:
+            self.mask = yes
+            yes = self.eval(args[1])
+            self.mask = no
+            no = self.eval(args[2])
+        finally:
+            self.mask = mask
+        return self.merge(cond, yes, no)
+
+    def _symbol(self, code):
+        if not isinstance(code, Token) or code.kind != 'symbol':
+            raise Unsupported('malformed expression')
+        return code.value
+
+    def define(self, name, value):
+        """
+        Bind 'name' in the innermost scope for the guests in the mask unless
+        it is already bound, like VariableStack.set() with allocation.
+        """
+        scope = self.scopes[-1]
+        if name not in scope:
+            scope[name] = (value, self.mask)
+            return value
+        old, bound = scope[name]
+        if self.covers(bound):
+            return old
+        value = self.merge(bound, old, value)
+        if self.mask is None:
+            scope[name] = (value, None)
+        else:
+            scope[name] = (value, bound | self.mask)
+        return value
+
+    def v_defvar(self, args):
+        if len(args) != 2:
+            raise Unsupported('arity mismatch')
+        name = self._symbol(args[0])
+        return self.define(name, self.eval(args[1]))
+
+    def v_set(self, args):
+        if len(args) != 2:
+            raise Unsupported('arity mismatch')
+        name = self._symbol(args[0])
+        value = self.eval(args[1])
+        scope = self.find(name)
+        if scope is None:
+            # Guests would see the values set for each other
+            raise Unsupported('set of non-local variable %s' % name)
+        old, bound = scope[name]
+        if not self.covers(bound):
+            raise Unsupported('%s is not bound for all guests' % name)
+        if self.mask is not None:
+            value = self.merge(self.mask, value, old)
+        scope[name] = (value, bound)
+        return value
+
+    v_setq = v_set
+
+    def v_let(self, args):
+        if len(args) < 2 or type(args[0]) != list:
+            raise Unsupported('malformed let')
+        for sym in args[0]:
+            if type(sym) != list or len(sym) != 2:
+                raise Unsupported('malformed let')
+            self._symbol(sym[0])
+
+        self.scopes.append({})
+        try:
+            for name, value in args[0]:
+                self.define(name.value, self.eval(value))
+            for expr in args[1:]:
+                result = self.eval(expr)
+        finally:
+            self.scopes.pop()
+        return result
+
+    def v_eval(self, args):
+        if not args:
+            raise Unsupported('empty block')
+        for expr in args:
+            result = self.eval(expr)
+        return result
+
+    def user_call(self, name, args):
+        if name not in self.e.funcs:
+            raise Unsupported('unknown function %s' % name)
+        params, code, body = self.e.funcs[name]
+        if body is None or len(params) != len(args):
+            raise Unsupported('malformed call of %s' % name)
+        if self.depth == MAX_DEPTH:
+            raise Unsupported('too deep recursion')
+        self.funcs[name] = code
+
+        # Arguments are evaluated in the scope of the function, see
+        # Evaluator.default()
+        self.scopes.append({})
+        self.depth += 1
+        try:
+            for param, arg in zip(params, args):
+                self.define(param.value, self.eval(arg))
+            return self.eval(code)
+        finally:
+            self.depth -= 1
+            self.scopes.pop()
+
+
+def evaluate(e, iterator, items, code, state):
+    """
+    Evaluate the body 'code' of a (with Guests iterator code) statement for
+    all of 'items' at once.  The caller keeps 'state' between evaluations of
+    the same statement.
+    Return: The list of results, or None if the body has to be evaluated for
+            each guest instead
+    """
+    funcs = state.get('unsupported')
+    if funcs is not None:
+        if all(e.funcs.get(name, (None, None))[1] is code
+               for name, code in funcs.iteritems()):
+            return None
+        del state['unsupported']
+
+    vector = VectorEvaluator(e, iterator, items)
+    try:
+        result = vector.run(code)
+    except Unsupported, err:
+        if err.static:
+            state['unsupported'] = vector.funcs
+        logger.debug("Not vectorized: %s", err)
+    except Exception, err:
+        logger.debug("Not vectorized: %s", err)
+    else:
+        # Errors from here on are the ones of evaluating each guest
+        vector.commit()
+        return result
+    vector.rollback()
+    return None
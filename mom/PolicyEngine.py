@@ -25,9 +25,12 @@ class PolicyEngine(threading.Thread):
     At a regular interval, this thread triggers system reconfiguration by
     sampling host and guest data, evaluating the policy and reporting the
     results to all enabled Controller plugins.
+
+    With a pipeline, every interval is a tick of the pipeline, which first
+    collects the host and the guests so that the policy acts on fresh data.
     """
     def __init__(self, config, hypervisor_iface, host_monitor, guest_manager,
-                 export_sample=None):
+                 export_sample=None, pipeline=None):
         threading.Thread.__init__(self, name="PolicyEngine")
         self.setDaemon(True)
         self.config = config
@@ -39,8 +42,12 @@ class PolicyEngine(threading.Thread):
         }
 
         self.plotter = export_sample
+        self.pipeline = pipeline
 
-        self.policy = Policy()
+        self.policy = Policy(
+            vectorize=config.getboolean('main', 'policy-vectorize'),
+            profile=config.getboolean('main', 'policy-profile'),
+            workers=config.getint('main', 'policy-workers'))
         self.load_policy()
         self.start()
 
@@ -90,6 +97,18 @@ class PolicyEngine(threading.Thread):
     def rpc_set_named_policy(self, name, policyStr):
         return self.policy.set_policy(name, policyStr)
 
+    def rpc_get_policy_profile(self):
+        return self.policy.get_profile()
+
+    def rpc_reset_policy_profile(self):
+        self.policy.reset_profile()
+        return True
+
+    def rpc_get_pipeline_stats(self):
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.stats()
+
     def get_controllers(self):
         """
         Initialize the Controllers called for in the config file.
@@ -117,8 +136,12 @@ class PolicyEngine(threading.Thread):
         host_last_data = self.properties['host_monitor'].get_last_data()
         if host is None:
             return
-        guest_list = self.properties['guest_manager'].interrogate().values()
-        guests_last_data = self.properties['guest_manager'].get_last_data()
+        fleet = self.properties['guest_manager'].snapshot()
+        guest_list = fleet.entities().values()
+        self._end_stage('snapshot',
+                        [self.properties['host_monitor']] + fleet.monitors)
+        # The snapshot is shared with the other readers of the guests
+        guests_last_data = dict(fleet.last_data)
 
         guests_last_data.update({'host': host_last_data})
 
@@ -127,10 +150,21 @@ class PolicyEngine(threading.Thread):
             self.plotter.set_data(guests_last_data)
 
         ret = self.policy.evaluate(host, guest_list)
+        self._end_stage('evaluate')
         if ret is False:
             return
         for c in self.controllers:
             c.process(host, guest_list)
+        self._end_stage('control')
+
+    def _end_stage(self, stage, monitors=()):
+        """
+        Record the end of a stage of the pipeline tick, and the age of the
+        data of 'monitors' used by it
+        """
+        if self.pipeline is not None:
+            self.pipeline.sample_ages(monitors)
+            self.pipeline.end_stage(stage)
 
     def run(self):
         try:
@@ -138,10 +172,20 @@ class PolicyEngine(threading.Thread):
             self.get_controllers()
             interval = self.config.getint('main', 'policy-engine-interval')
             while self.config.getint('__int__', 'running') == 1:
-                time.sleep(interval)
-                self.do_controls()
+                if self.pipeline is None:
+                    time.sleep(interval)
+                    self.do_controls()
+                    continue
+                self.pipeline.wait()
+                self.pipeline.collect()
+                try:
+                    self.do_controls()
+                finally:
+                    self.pipeline.end_tick()
         except Exception as e:
             self.logger.error("Policy Engine crashed", exc_info=True)
         else:
             self.logger.info("Policy Engine ending")
+        finally:
+            self.policy.shutdown()
 
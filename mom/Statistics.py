@@ -0,0 +1,764 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+# State of a field in a sample
+ABSENT = 0      # the sample has no such field
+NONE = 1        # the field is None
+VALUE = 2       # the field holds a value
+
+# Typecodes of the arrays holding columns of ints and floats, values of any
+# other type are kept in lists
+TYPECODES = {int: 'l', float: 'd'}
+
+# Types of the values the running aggregates are kept for
+NUMERIC = (int, long, float, bool)
+
+
+def monotonic():
+    """
+    Return the time in seconds since a fixed point in the past.  Unlike the
+    time of day, it never goes backwards.
+    """
+    return os.times()[4]
+
+
+class Aggregate(object):
+    """
+    Running aggregates of the values of a column, updated as samples are
+    appended and evicted: their number, their sum (exact as long as they are
+    all integers), their mean and sum of squared differences from the mean
+    (Welford's method), windows of candidates for their minimum and maximum,
+    and their exponentially weighted moving averages for some smoothing
+    factors.  They are only valid while numeric is set.
+    """
+    __slots__ = ('count', 'isum', 'fsum', 'floats', 'mean', 'm2', 'low',
+                 'high', 'ewmas', 'numeric')
+
+    def __init__(self):
+        self.reset()
+        # Smoothing factor -> [average before the latest sample, average,
+        # sequence number of the latest sample]
+        self.ewmas = {}
+
+    def reset(self):
+        self.count = 0
+        self.isum = 0
+        self.fsum = 0.0
+        self.floats = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        # (sequence number, value) of the values which are the minimum
+        # (maximum) of all the values appended after them, oldest first
+        self.low = deque()
+        self.high = deque()
+        self.numeric = True
+
+    @property
+    def total(self):
+        if self.floats:
+            return self.isum + self.fsum
+        return self.isum
+
+    def add(self, seq, value):
+        if type(value) not in NUMERIC:
+            self.numeric = False
+            return
+        self.count += 1
+        if type(value) is float:
+            self.fsum += value
+            self.floats += 1
+        else:
+            self.isum += value
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+
+        self.push(seq, value)
+
+        for alpha, ewma in self.ewmas.iteritems():
+            if ewma[2] == seq:
+                ewma[1] = _smooth(alpha, ewma[0], value)
+            else:
+                ewma[0] = ewma[1]
+                ewma[1] = _smooth(alpha, ewma[1], value)
+                ewma[2] = seq
+
+    def push(self, seq, value):
+        """
+        Add a value to the windows of extremes
+        """
+        # Equal values are kept, the first one is the minimum as for min()
+        low = self.low
+        while low and low[-1][1] > value:
+            low.pop()
+        low.append((seq, value))
+        high = self.high
+        while high and high[-1][1] < value:
+            high.pop()
+        high.append((seq, value))
+
+    def remove(self, seq, value):
+        """
+        Remove the oldest value, or the latest one before the windows of
+        extremes are rebuilt
+        """
+        if type(value) not in NUMERIC:
+            return
+        if self.count == 1:
+            self.count = 0
+            self.isum = 0
+            self.fsum = 0.0
+            self.floats = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+        else:
+            self.count -= 1
+            if type(value) is float:
+                self.fsum -= value
+                self.floats -= 1
+            else:
+                self.isum -= value
+            delta = value - self.mean
+            self.mean -= delta / float(self.count)
+            self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+        for window in (self.low, self.high):
+            if window and window[0][0] == seq:
+                window.popleft()
+
+    def copy(self, windows=True):
+        """
+        Return a copy of the aggregates.  Without 'windows', the windows of
+        extremes of the copy only hold the current minimum and maximum, and
+        it must be computed again before any change, see
+        Statistics._compact().
+        """
+        ret = Aggregate.__new__(Aggregate)
+        ret.count = self.count
+        ret.isum = self.isum
+        ret.fsum = self.fsum
+        ret.floats = self.floats
+        ret.mean = self.mean
+        ret.m2 = self.m2
+        if windows:
+            ret.low = deque(self.low)
+            ret.high = deque(self.high)
+        else:
+            ret.low = deque(self.low and [self.low[0]])
+            ret.high = deque(self.high and [self.high[0]])
+        ret.numeric = self.numeric
+        ret.ewmas = dict((alpha, list(ewma))
+                         for alpha, ewma in self.ewmas.iteritems())
+        return ret
+
+
+def _smooth(alpha, average, value):
+    if average is None:
+        return float(value)
+    return alpha * value + (1 - alpha) * average
+
+
+class Column(object):
+    """
+    The values of one field in every entry of a Statistics history, and their
+    state.  The values of a column are kept in an array as long as they all
+    have the same type, and in a list otherwise, so that every value is read
+    back exactly as it was stored.  Entries are only ever added at the end,
+    the oldest ones are dropped by replacing both with shorter copies, so
+    that snapshots can keep reading the entries they know of.  An entry which
+    may be read by another history is only changed in a copy of the column.
+    """
+    __slots__ = ('values', 'states', 'aggregate', 'shared')
+
+    def __init__(self, size, aggregate=None):
+        self.values = None
+        self.states = array('B', [ABSENT]) * size
+        self.aggregate = aggregate or Aggregate()
+        # Entries below shared may be read by other histories
+        self.shared = 0
+
+    def _fit(self, value):
+        """
+        Return the values, converted if needed to hold 'value'
+        """
+        values = self.values
+        typecode = TYPECODES.get(type(value))
+        if values is None:
+            if typecode is None:
+                self.values = values = [None] * len(self.states)
+            else:
+                self.values = values = array(typecode, [0]) * len(self.states)
+        elif type(values) is array and typecode != values.typecode:
+            self.values = values = list(values)
+        return values
+
+    def append(self, state, value=None):
+        if state == VALUE:
+            self._fit(value).append(value)
+        elif type(self.values) is array:
+            self.values.append(0)
+        elif self.values is not None:
+            self.values.append(None)
+        self.states.append(state)
+
+    def set(self, index, value):
+        if index < self.shared:
+            self.states = self.states[:]
+            if self.values is not None:
+                self.values = self.values[:]
+            self.shared = 0
+        if value is None:
+            self.states[index] = NONE
+            return
+        self._fit(value)[index] = value
+        self.states[index] = VALUE
+
+    def get(self, index, default=None):
+        state = self.states[index]
+        if state == VALUE:
+            return self.values[index]
+        elif state == NONE:
+            return None
+        return default
+
+    def compact(self, start, end):
+        """
+        Replace the entries by copies of the ones from 'start' to 'end'
+        """
+        self.states = self.states[start:end]
+        if self.values is not None:
+            self.values = self.values[start:end]
+        self.shared = 0
+
+    def share(self, end=0, windows=False):
+        """
+        Return a column reading the same entries, the ones below 'end' being
+        read by both, see Statistics.snapshot()
+        """
+        column = Column(0, self.aggregate.copy(windows))
+        column.states = self.states
+        column.values = self.values
+        column.shared = end
+        self.shared = max(self.shared, end)
+        return column
+
+
+class Rollup(object):
+    """
+    The values of the numeric fields summarised per period of 'period'
+    seconds, for the last 'count' periods including the current one: the
+    number, sum, minimum and maximum of the values of every field in each
+    period.  Summaries of closed periods never change and are only ever
+    added at the end of the list, so that snapshots can share it like the
+    entries of a Column.
+    """
+    __slots__ = ('period', 'count', 'buckets', 'start', 'end', 'index',
+                 'current')
+
+    def __init__(self, period, count):
+        self.period = period
+        self.count = count
+        # The closed periods in entries start to end, oldest first, as
+        # (index of the period, {name: (count, sum, minimum, maximum)})
+        self.buckets = []
+        self.start = 0
+        self.end = 0
+        # The index of the current period, counted from time 0, and its
+        # summaries
+        self.index = None
+        self.current = {}
+
+    def add(self, timestamp, names, values):
+        index = int(timestamp // self.period)
+        if index != self.index:
+            if self.current:
+                self._close()
+            self.index = index
+            self.current = {}
+        self._expire()
+        current = self.current
+        for name, value in zip(names, values):
+            if not isinstance(value, NUMERIC):
+                continue
+            summary = current.get(name)
+            if summary is None:
+                current[name] = (1, value, value, value)
+            else:
+                count, total, low, high = summary
+                current[name] = (count + 1, total + value, min(low, value),
+                                 max(high, value))
+
+    def _close(self):
+        if len(self.buckets) != self.end:
+            # Another history appended to the shared list
+            self.buckets = self.buckets[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        self.buckets.append((self.index, self.current))
+        self.end += 1
+
+    def _expire(self):
+        oldest = self.index - self.count
+        while self.start < self.end and self.buckets[self.start][0] <= oldest:
+            self.start += 1
+        if self.start >= self.count:
+            self.buckets = self.buckets[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+
+    def summaries(self, name):
+        """
+        Return the (start time, count, sum, minimum, maximum) of field 'name'
+        in every period it has values in, oldest first
+        """
+        ret = []
+        buckets = self.buckets[self.start:self.end]
+        buckets.append((self.index, self.current))
+        for index, summaries in buckets:
+            summary = summaries.get(name)
+            if summary is not None:
+                ret.append((index * self.period,) + summary)
+        return ret
+
+    def share(self):
+        """
+        Return a summary reading the same periods, see Statistics.snapshot()
+        """
+        rollup = Rollup(self.period, self.count)
+        rollup.buckets = self.buckets
+        rollup.start = self.start
+        rollup.end = self.end
+        rollup.index = self.index
+        rollup.current = dict(self.current)
+        return rollup
+
+
+def parse_rollups(spec):
+    """
+    Parse a list of rollup tiers such as '60:60, 600:144', each one the
+    period in seconds and the number of periods kept.
+    Return: A list of (period, count)
+    """
+    tiers = []
+    for tier in spec.split(','):
+        tier = tier.strip()
+        if not tier:
+            continue
+        try:
+            period, count = [int(part) for part in tier.split(':')]
+        except ValueError:
+            raise ValueError("Invalid rollup tier '%s'" % tier)
+        if period <= 0 or count <= 0:
+            raise ValueError("Invalid rollup tier '%s'" % tier)
+        tiers.append((period, count))
+    return tiers
+
+
+class Statistics(object):
+    """
+    The history of the samples collected for a Monitor, kept as one column
+    per field.  Appending a sample to a full history drops the oldest one.  A
+    history without a capacity grows instead.
+
+    Samples read back as dictionaries holding the fields they were appended
+    with, but the values of a single field can be read without building them.
+    The sum, mean, variance, extremes and moving averages of a field are kept
+    up to date as samples come and go, so reading them does not depend on
+    the length of the history.  Every sample is stamped with the monotonic()
+    time it was appended at, so that the samples of the last seconds can be
+    found by a binary search.
+
+    Older samples can also be summarised in rollup tiers of longer periods,
+    which bound the memory used no matter how far back they go.
+    """
+    def __init__(self, capacity=None, rollups=()):
+        self.capacity = capacity
+        # Period in seconds -> Rollup
+        self.rollups = dict((period, Rollup(period, count))
+                            for period, count in rollups)
+        # The samples are in entries start to end of the columns, oldest
+        # first.  Dropped entries are only removed once they are as many as
+        # the samples, so that removing them costs O(1) per sample.
+        self.start = 0
+        self.end = 0
+        # Sequence number of the sample in entry 0
+        self.base = 0
+        # Set in snapshots, whose columns belong to another history
+        self.borrowed = False
+        self.columns = {}
+        # The time of every entry
+        self.times = array('d')
+        # The names given to append_values() last, their columns and the
+        # other columns
+        self._layout = ((), [], [])
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        for index in xrange(self.start, self.end):
+            yield self._row(index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        return self._row(self.start + index)
+
+    def _row(self, index):
+        row = {}
+        for name, column in self.columns.iteritems():
+            state = column.states[index]
+            if state == VALUE:
+                row[name] = column.values[index]
+            elif state == NONE:
+                row[name] = None
+        return row
+
+    def _column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = Column(self.end)
+        return column
+
+    def append(self, sample, timestamp=None):
+        """
+        Append a sample given as a dictionary of field values, collected at
+        'timestamp' or now
+        """
+        self.append_values(sample.keys(), sample.values(), timestamp)
+
+    def append_values(self, names, values, timestamp=None):
+        """
+        Append a sample given as the values of the fields 'names', in the
+        same order.  The columns of the names are looked up again only when
+        another sequence of names is given, so the fixed names of a Monitor
+        are only resolved once.
+        """
+        if self.borrowed:
+            self._compact()
+        if self.capacity is not None and len(self) >= self.capacity:
+            self._evict()
+        seq = self.base + self.end
+        layout, columns, others = self._layout
+        if layout is not names or \
+                len(columns) + len(others) != len(self.columns):
+            columns = [self._column(name) for name in names]
+            given = set(names)
+            others = [column for name, column in self.columns.iteritems()
+                      if name not in given]
+            self._layout = (names, columns, others)
+        for column in others:
+            column.append(ABSENT)
+        for column, value in zip(columns, values):
+            if value is None:
+                column.append(NONE)
+            else:
+                column.append(VALUE, value)
+                column.aggregate.add(seq, value)
+        if timestamp is None:
+            timestamp = monotonic()
+        for rollup in self.rollups.itervalues():
+            rollup.add(timestamp, names, values)
+        self.times.append(timestamp)
+        self.end += 1
+        if self.start >= len(self):
+            self._compact()
+            # Once per round, so that rounding errors do not pile up
+            for column in self.columns.itervalues():
+                self._resync(column)
+
+    def _evict(self):
+        index = self.start
+        seq = self.base + index
+        for column in self.columns.itervalues():
+            if column.states[index] == VALUE:
+                column.aggregate.remove(seq, column.values[index])
+        self.start += 1
+
+    def _compact(self):
+        """
+        Replace the columns by copies holding the samples only, which belong
+        to this history
+        """
+        for column in self.columns.itervalues():
+            column.compact(self.start, self.end)
+        self.times = self.times[self.start:self.end]
+        self.base += self.start
+        self.end -= self.start
+        self.start = 0
+        if self.borrowed:
+            # Snapshots only know the current extremes
+            for column in self.columns.itervalues():
+                self._resync(column)
+            self.borrowed = False
+
+    def _samples(self, column):
+        """
+        Return the (sequence number, value) of the values of a column, oldest
+        first
+        """
+        states = column.states
+        values = column.values
+        return [(self.base + index, values[index])
+                for index in xrange(self.start, self.end)
+                if states[index] == VALUE]
+
+    def _resync(self, column):
+        """
+        Compute the aggregates of a column again from its values
+        """
+        aggregate = column.aggregate
+        ewmas = aggregate.ewmas
+        aggregate.reset()
+        aggregate.ewmas = {}
+        for seq, value in self._samples(column):
+            aggregate.add(seq, value)
+        aggregate.ewmas = ewmas
+
+    def update(self, name, value):
+        """
+        Set field 'name' of the latest sample.  The rollup tiers keep the
+        value collected.  Only the column of the field is copied if the
+        sample is shared with a snapshot.
+        """
+        if len(self) == 0:
+            raise IndexError('no samples')
+        column = self._column(name)
+        index = self.end - 1
+        seq = self.base + index
+        aggregate = column.aggregate
+        old = column.get(index)
+        if old is not None:
+            aggregate.remove(seq, old)
+            for ewma in aggregate.ewmas.itervalues():
+                if ewma[2] == seq:
+                    ewma[1], ewma[2] = ewma[0], None
+            for window in (aggregate.low, aggregate.high):
+                if window and window[-1][0] == seq:
+                    window.pop()
+        column.set(index, value)
+        if value is not None:
+            aggregate.add(seq, value)
+        # The old value may have pushed others out of the windows of
+        # extremes, which have to be rebuilt unless the new one pushes them
+        # out as well
+        if aggregate.numeric and old is not None and \
+                (value is None or value != old):
+            aggregate.low = deque()
+            aggregate.high = deque()
+            for seq, value in self._samples(column):
+                aggregate.push(seq, value)
+
+    def latest(self, name, default=None):
+        """
+        Return field 'name' of the latest sample, or 'default' if it has no
+        such field
+        """
+        column = self.columns.get(name)
+        if column is None or len(self) == 0:
+            return default
+        return column.get(self.end - 1, default)
+
+    def latest_time(self):
+        """
+        Return the monotonic() time of the latest sample, or None if there
+        are no samples
+        """
+        if len(self) == 0:
+            return None
+        return self.times[self.end - 1]
+
+    def values(self, name, none=False):
+        """
+        Return the values of field 'name' in all samples, oldest first.
+        Samples where the field is None are skipped unless 'none' is set.
+        """
+        column = self.columns.get(name)
+        if column is None:
+            return []
+        states = column.states
+        values = column.values
+        indexes = xrange(self.start, self.end)
+        if values is None:
+            return [None] * sum(1 for index in indexes
+                                if none and states[index] == NONE)
+        if none:
+            return [values[index] if states[index] == VALUE else None
+                    for index in indexes if states[index] != ABSENT]
+        return [values[index] for index in indexes if states[index] == VALUE]
+
+    def recent(self, name, count):
+        """
+        Return the latest 'count' values of field 'name', oldest first
+        """
+        column = self.columns.get(name)
+        ret = []
+        if column is None:
+            return ret
+        states = column.states
+        index = self.end - 1
+        while index >= self.start and len(ret) < count:
+            if states[index] == VALUE:
+                ret.append(column.values[index])
+            index -= 1
+        ret.reverse()
+        return ret
+
+    def window(self, name, seconds):
+        """
+        Return the (time, value) of the values of field 'name' in the samples
+        appended at most 'seconds' before the latest one, oldest first
+        """
+        column = self.columns.get(name)
+        if column is None or len(self) == 0:
+            return []
+        first = bisect_left(self.times, self.times[self.end - 1] - seconds,
+                            self.start, self.end)
+        states = column.states
+        values = column.values
+        times = self.times
+        return [(times[index], values[index])
+                for index in xrange(first, self.end)
+                if states[index] == VALUE]
+
+    def _aggregate(self, name):
+        """
+        Return the up to date Aggregate of field 'name', or None if its values
+        are not all numeric
+        """
+        column = self.columns.get(name)
+        if column is None:
+            return Aggregate()
+        if not column.aggregate.numeric:
+            self._resync(column)
+            if not column.aggregate.numeric:
+                return None
+        return column.aggregate
+
+    def total(self, name):
+        """
+        Return the number and the sum of the values of field 'name'
+        """
+        aggregate = self._aggregate(name)
+        if aggregate is not None:
+            return aggregate.count, aggregate.total
+        values = self.values(name)
+        total = 0
+        for value in values:
+            total = total + value
+        return len(values), total
+
+    def variance(self, name):
+        """
+        Return the population variance of the values of field 'name', or None
+        if there are none
+        """
+        aggregate = self._aggregate(name)
+        if aggregate is None:
+            values = self.values(name)
+            mean = float(sum(values)) / len(values)
+            return sum((value - mean) ** 2 for value in values) / len(values)
+        if aggregate.count == 0:
+            return None
+        return aggregate.m2 / aggregate.count
+
+    def minimum(self, name):
+        """
+        Return the lowest value of field 'name', or None if there are none
+        """
+        aggregate = self._aggregate(name)
+        if aggregate is None:
+            return min(self.values(name))
+        if not aggregate.low:
+            return None
+        return aggregate.low[0][1]
+
+    def maximum(self, name):
+        """
+        Return the highest value of field 'name', or None if there are none
+        """
+        aggregate = self._aggregate(name)
+        if aggregate is None:
+            return max(self.values(name))
+        if not aggregate.high:
+            return None
+        return aggregate.high[0][1]
+
+    def ewma(self, name, alpha):
+        """
+        Return the exponentially weighted moving average of the values of
+        field 'name' with smoothing factor 'alpha', or None if there are none.
+        The average is kept up to date from the first call for a given factor
+        on, and starts from the oldest value in the history at that time.
+        """
+        column = self.columns.get(name)
+        if column is None:
+            return None
+        aggregate = self._aggregate(name)
+        if aggregate is None:
+            raise TypeError("Statistic '%s' is not numeric" % name)
+        ewma = aggregate.ewmas.get(alpha)
+        if ewma is None:
+            ewma = [None, None, None]
+            for seq, value in self._samples(column):
+                ewma = [ewma[1], _smooth(alpha, ewma[1], value), seq]
+            aggregate.ewmas[alpha] = ewma
+        return ewma[1]
+
+    def rollup(self, name, period):
+        """
+        Return the summaries of field 'name' in the rollup tier of 'period'
+        seconds, see Rollup.summaries().  Raise KeyError if there is no such
+        tier.
+        """
+        return self.rollups[period].summaries(name)
+
+    def snapshot(self):
+        """
+        Return a copy of the history, taken in a time which does not depend on
+        its length: the copy reads the same entries of the columns as this
+        history until either of them changes them.
+        """
+        ret = Statistics(self.capacity)
+        ret.start = self.start
+        ret.end = self.end
+        ret.base = self.base
+        ret.times = self.times
+        ret.borrowed = True
+        ret.rollups = dict((period, rollup.share())
+                           for period, rollup in self.rollups.iteritems())
+        ret.columns = dict((name, column.share(self.end))
+                           for name, column in self.columns.iteritems())
+        return ret
+
+    def copy(self):
+        ret = Statistics(self.capacity)
+        ret.rollups = dict((period, rollup.share())
+                           for period, rollup in self.rollups.iteritems())
+        ret.end = len(self)
+        ret.base = self.base + self.start
+        ret.times = self.times[self.start:self.end]
+        for name, column in self.columns.iteritems():
+            column = ret.columns[name] = column.share(windows=True)
+            column.compact(self.start, self.end)
+        return ret
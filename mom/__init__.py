@@ -8,8 +8,10 @@ from mom.LogUtils import *
 from mom.HostMonitor import HostMonitor
 from mom.GuestManager import GuestManager
 from mom.PolicyEngine import PolicyEngine
+from mom.Pipeline import Pipeline
 from mom.PlotLib import Plot
 from mom.RPCServer import RPCServer
+from mom.Statistics import parse_rollups
 from mom.MOMFuncs import MOMFuncs, EXPORTED_ATTRIBUTE
 
 class MOM:
@@ -26,10 +28,16 @@ class MOM:
         self.logger.info("MOM starting")
         self.config.set('__int__', 'running', '1')
         hypervisor_iface = self.get_hypervisor_interface()
-        host_monitor = HostMonitor(self.config, hypervisor_iface)
+        if self.config.getboolean('main', 'pipeline'):
+            pipeline = Pipeline(
+                self.config.getint('main', 'policy-engine-interval'),
+                self.config.getint('main', 'guest-collector-threads'))
+        else:
+            pipeline = None
+        host_monitor = HostMonitor(self.config, hypervisor_iface, pipeline)
         if not hypervisor_iface:
             self.shutdown()
-        guest_manager = GuestManager(self.config, hypervisor_iface)
+        guest_manager = GuestManager(self.config, hypervisor_iface, pipeline)
 
         export_sampl_filename = self.config.get('liveplot', 'export-samples')
         liveplot_fields = self.config.get('liveplot', 'fields')
@@ -41,7 +49,8 @@ class MOM:
                                      hypervisor_iface,
                                      host_monitor,
                                      guest_manager,
-                                     live_plotter)
+                                     live_plotter,
+                                     pipeline)
 
         threads = { 'host_monitor': host_monitor,
                     'guest_manager': guest_manager,
@@ -95,14 +104,22 @@ class MOM:
         self.config.set('main', 'guest-manager-interval', '5')
         self.config.set('main', 'hypervisor-interface', 'libvirt')
         self.config.set('main', 'guest-monitor-interval', '5')
+        self.config.set('main', 'guest-collector-threads', '0')
+        self.config.set('main', 'guest-collector-events', 'false')
         self.config.set('main', 'policy-engine-interval', '10')
+        self.config.set('main', 'pipeline', 'false')
         self.config.set('main', 'sample-history-length', '10')
         self.config.set('main', 'libvirt-hypervisor-uri', '')
         self.config.set('main', 'controllers', 'Balloon')
         self.config.set('main', 'plot-dir', '')
+        self.config.set('main', 'history-dir', '')
+        self.config.set('main', 'history-tiers', '')
         self.config.set('main', 'rpc-port', '-1')
         self.config.set('main', 'policy', '')
         self.config.set('main', 'policy-dir', '')
+        self.config.set('main', 'policy-vectorize', 'false')
+        self.config.set('main', 'policy-profile', 'false')
+        self.config.set('main', 'policy-workers', '0')
         self.config.add_section('logging')
         self.config.set('logging', 'log', 'stdio')
         self.config.set('logging', 'verbosity', 'info')
@@ -147,6 +164,11 @@ class MOM:
             self.logger.error("Only one of 'policy' and 'policy-dir' may be"
                                "specified")
             return False
+        try:
+            parse_rollups(self.config.get('main', 'history-tiers'))
+        except ValueError, e:
+            self.logger.error("Invalid history-tiers: %s", e)
+            return False
         return True
 
     def _configure_logger(self):
@@ -211,7 +233,11 @@ class MOM:
         Check to make sure a list of expected threads are still alive
         """
         for t in threads:
-            if not t.isAlive():
+            if isinstance(t, HostMonitor):
+                alive = t.is_active()
+            else:
+                alive = t.isAlive()
+            if not alive:
                 self.logger.error("Thread '%s' has exited" % t.getName())
                 return False
         return True
@@ -0,0 +1,285 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from testrunner import MomTestCase as TestCaseBase
+
+import gc
+import logging
+import os
+import sys
+import timeit
+import unittest
+from mom.Entity import Entity
+from mom.Policy import Parser
+from mom.Policy import Vector
+from StatisticsTests import make_monitor
+from VectorTests import BALLOON_POLICY, make_guests
+
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def allocations(func):
+    """
+    Call func and return its result and the number of memory blocks it
+    allocated which are still in use, or None if tracemalloc (pytracemalloc
+    on Python 2) is not available.
+    """
+    if tracemalloc is None:
+        return func(), None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        ret = func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return ret, sum(stat.count_diff
+                    for stat in after.compare_to(before, 'filename'))
+
+
+def footprint(obj):
+    """
+    Return the size in bytes of an object and of its attribute dictionary
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def per_call(func, number):
+    """
+    Return the average wall time of one call of func in microseconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+class DispatchBenchmark(TestCaseBase):
+    def testIfSignatureCache(self):
+        parsed = []
+
+        class CountingEvaluator(Parser.Evaluator):
+            # A class of its own, whose signature table starts empty
+            def parse_doc(self, doc):
+                parsed.append(doc)
+                return Parser.Evaluator.parse_doc(self, doc)
+
+        e = CountingEvaluator()
+        code = Parser.get_code(e, '(if (> 2 1) "yes" "no")')[0]
+        self.assertFalse('_signatures' in CountingEvaluator.__dict__)
+        self.assertEquals(e.eval(code), 'yes')
+        signatures = CountingEvaluator._signatures
+        signature = signatures['c_if']
+        count = len(parsed)
+        self.assertTrue(count > 0)
+
+        # Reused by every evaluator of the class, without parsing again
+        other = CountingEvaluator()
+        self.assertEquals(other.eval(code), 'yes')
+        self.assertEquals(e.eval(code), 'yes')
+        self.assertTrue(CountingEvaluator._signatures is signatures)
+        self.assertTrue(signatures['c_if'] is signature)
+        self.assertEquals(len(parsed), count)
+
+        def uncached():
+            # Drop the signature table to force parsing the docstring again
+            e._signatures.clear()
+            return e.eval(code)
+
+        def cached():
+            return e.eval(code)
+
+        before = per_call(uncached, 50)
+        after = per_call(cached, 500)
+        self.log.info("c_if dispatch: %.1f us uncached, %.1f us cached",
+                      before, after)
+
+
+class ParserBenchmark(TestCaseBase):
+    def _policy(self, copies):
+        """
+        Build a synthetic policy out of many renamed copies of the shipped one
+        """
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'rules', '40_mom.policy')
+        with open(fname, 'r') as f:
+            policy = f.read()
+        return '\n'.join(policy.replace('_guest ', '_guest_%i ' % i)
+                         for i in xrange(copies))
+
+    def testLargePolicy(self):
+        e = Parser.Evaluator()
+        small = self._policy(10)
+        large = self._policy(40)
+
+        def read(policy):
+            # Count the tokens taken by the reader, and the nodes it made
+            tokens = Parser.Scanner(e.get_operators()).tokenize(policy)
+            taken = []
+
+            def stream():
+                for token in tokens:
+                    taken.append(token)
+                    yield token
+            code = Parser.Parser(start='value_list').parse(stream())
+            self.assertEquals(len(taken), len(tokens))
+            return code, len(tokens), nodes(code)
+
+        def nodes(code):
+            if isinstance(code, list):
+                return 1 + sum(nodes(node) for node in code)
+            return 1
+
+        small_code, small_tokens, small_nodes = read(small)
+        large_code, large_tokens, large_nodes = read(large)
+        self.assertEquals(small_code, Parser.get_code(e, small))
+        self.assertEquals(4 * len(small_code), len(large_code))
+        # Each token is read once, into one node
+        self.assertEquals(4 * small_tokens, large_tokens)
+        self.assertEquals(4 * (small_nodes - 1), large_nodes - 1)
+
+        small_time = per_call(lambda: Parser.get_code(e, small), 3)
+        large_time = per_call(lambda: Parser.get_code(e, large), 3)
+        self.log.info("get_code: %i bytes in %.0f us, %i bytes in %.0f us, "
+                      "%.1f times longer", len(small), small_time,
+                      len(large), large_time, large_time / small_time)
+
+
+@unittest.skipIf(not Vector.available(), "NumPy is not available")
+class VectorBenchmark(TestCaseBase):
+    def testFleet(self):
+        guests = make_guests(500, 0, mixed=False)
+        code = Parser.get_code(Parser.Evaluator(), BALLOON_POLICY)
+
+        def run(vectorize):
+            e = Parser.Evaluator()
+            e.stack.set('Guests', guests, True)
+            if vectorize:
+                e.vectorize = Vector.evaluate
+            return [expr(e) for expr in Parser.compile(e, code)]
+
+        # Bodies printing debug output are not vectorized
+        logger = logging.getLogger('mom.Evaluator')
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            self.assertEquals(run(False), run(True))
+            scalar = per_call(lambda: run(False), 5)
+            vector = per_call(lambda: run(True), 5)
+        finally:
+            logger.setLevel(level)
+        self.log.info("with Guests over %i guests: %.0f us scalar, "
+                      "%.0f us vectorized", len(guests), scalar, vector)
+
+
+class InterrogateBenchmark(TestCaseBase):
+    def testSnapshot(self):
+        monitors = [make_monitor('guest%i' % i, 100) for i in xrange(1000)]
+
+        def copy():
+            # What interrogate() did before Entities shared the Monitor data
+            for monitor in monitors:
+                entity = Entity(monitor=monitor)
+                monitor.data_sem.acquire()
+                for prop in monitor.properties.keys():
+                    entity.properties[prop] = monitor.properties[prop]
+                for var in monitor.variables.keys():
+                    entity.variables[var] = monitor.variables[var]
+                entity.statistics = monitor.statistics.copy()
+                monitor.data_sem.release()
+                # Entities had one attribute per latest statistic
+                attributes = {}
+                for stat, value in entity.statistics[-1].iteritems():
+                    attributes[stat] = value
+
+        def snapshot():
+            for monitor in monitors:
+                monitor.interrogate()
+
+        # The Entities read the columns of the Monitors
+        for monitor in monitors[:10]:
+            entity = monitor.interrogate()
+            columns = monitor.statistics.columns
+            self.assertEqual(sorted(entity.statistics.columns),
+                             sorted(columns))
+            for name, column in entity.statistics.columns.iteritems():
+                self.assertTrue(column.values is columns[name].values)
+                self.assertTrue(column.states is columns[name].states)
+
+        before = per_call(copy, 1)
+        after = per_call(snapshot, 1)
+        self.log.info("interrogate %i guests x 100 samples: %.0f us copying, "
+                      "%.0f us sharing", len(monitors), before, after)
+
+    def testUpdateStatVal(self):
+        monitors = [make_monitor('guest%i' % i, 100) for i in xrange(1000)]
+
+        # Only the column updated is copied, by the Entity and the Monitor
+        for monitor in monitors[:10]:
+            entity = monitor.interrogate()
+            columns = dict((name, column.values) for name, column
+                           in monitor.statistics.columns.iteritems())
+            entity.UpdateStatVal('field0', -1)
+            self.assertEqual(entity.field0, -1)
+            self.assertEqual(monitor.statistics.latest('field0'), -1)
+            self.assertEqual(monitor.interrogate().field0, -1)
+            for name, values in columns.iteritems():
+                shared = monitor.statistics.columns[name].values
+                if name == 'field0':
+                    self.assertFalse(shared is values)
+                    self.assertFalse(
+                        entity.statistics.columns[name].values is values)
+                    self.assertFalse(
+                        entity.statistics.columns[name].values is shared)
+                else:
+                    self.assertTrue(shared is values)
+                    self.assertTrue(
+                        entity.statistics.columns[name].values is values)
+
+        def update():
+            for monitor in monitors:
+                monitor.interrogate().UpdateStatVal('field0', 1)
+
+        elapsed = per_call(update, 1)
+        self.log.info("UpdateStatVal on %i guests x 100 samples: %.0f us",
+                      len(monitors), elapsed)
+
+
+class AllocationBenchmark(TestCaseBase):
+    def testTokens(self):
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'rules', '40_mom.policy')
+        with open(fname, 'r') as f:
+            policy = f.read()
+        scanner = Parser.Scanner(Parser.Evaluator().get_operators())
+        tokens, count = allocations(lambda: scanner.tokenize(policy * 10))
+        self.log.info("%i tokens: %s blocks allocated, %i bytes each",
+                      len(tokens), count, footprint(tokens[0]))
+        self.assertFalse(hasattr(tokens[0], '__dict__'))
+
+    def testEntities(self):
+        monitors = [make_monitor('guest%i' % i, 100) for i in xrange(1000)]
+        entities, count = allocations(
+                lambda: [monitor.interrogate() for monitor in monitors])
+        self.log.info("%i entities: %s blocks allocated, %i bytes each",
+                      len(entities), count, footprint(entities[0]))
+        self.assertFalse(hasattr(entities[0], '__dict__'))
+        self.assertEqual(entities[0].field0, 99)
@@ -0,0 +1,387 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import ConfigParser
+import socket
+import threading
+import time
+import unittest
+from mom.CollectionEngine import CollectionEngine
+from mom.CollectionScheduler import CollectionScheduler
+from mom.Collectors.Collector import AsyncCollector
+from mom.Collectors.Collector import CollectionError
+from mom.Collectors.Collector import READ
+from mom.Collectors.GuestNetworkDaemon import GuestNetworkDaemon
+from mom.Collectors.GuestNetworkDaemon import _FakeServer
+from mom.GuestManager import GuestManager
+from mom.HypervisorInterfaces.HypervisorInterface import HypervisorInterface
+from mom.HypervisorInterfaces.HypervisorInterface import VM_STARTED
+from mom.HypervisorInterfaces.HypervisorInterface import VM_STOPPED
+from mom.Pipeline import Pipeline
+from mom.Statistics import monotonic
+from StatisticsTests import StaticCollector
+from StatisticsTests import make_monitor
+
+
+class FakeMonitor(object):
+    """
+    Count the collections, and the ones which overlapped
+    """
+    def __init__(self, name, crash=False):
+        self.name = name
+        self.crash = crash
+        self.collections = 0
+        self.overlaps = 0
+        self.collecting = False
+        self._terminate = False
+
+    def collect(self):
+        if self.collecting:
+            self.overlaps += 1
+        self.collecting = True
+        try:
+            if self.crash:
+                raise RuntimeError('crash')
+            self.collections += 1
+            time.sleep(0.01)
+        finally:
+            self.collecting = False
+
+    def terminate(self):
+        self._terminate = True
+
+    def _should_run(self):
+        return not self._terminate
+
+
+class TestCollectionScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = CollectionScheduler(2)
+
+    def tearDown(self):
+        self.scheduler.shutdown(5)
+        for thread in self.scheduler.threads:
+            self.assertFalse(thread.isAlive())
+
+    def test_intervals(self):
+        monitors = [FakeMonitor('guest%i' % i) for i in xrange(6)]
+        for monitor in monitors:
+            self.scheduler.add(monitor, 0.1)
+        time.sleep(0.75)
+        for monitor in monitors:
+            # The first collection is within the first interval
+            self.assertTrue(4 <= monitor.collections <= 8,
+                            monitor.collections)
+            self.assertEqual(monitor.overlaps, 0)
+            self.assertTrue(self.scheduler.scheduled(monitor))
+        utilization = self.scheduler.utilization()
+        self.assertEqual(len(utilization), 2)
+        for fraction in utilization:
+            self.assertTrue(0 < fraction <= 1, fraction)
+
+    def test_stop(self):
+        monitor = FakeMonitor('guest')
+        crashing = FakeMonitor('crashing', crash=True)
+        self.scheduler.add(monitor, 0.05)
+        self.scheduler.add(crashing, 0.05)
+        time.sleep(0.2)
+        self.assertFalse(self.scheduler.scheduled(crashing))
+        self.assertTrue(self.scheduler.scheduled(monitor))
+        monitor.terminate()
+        time.sleep(0.2)
+        self.assertFalse(self.scheduler.scheduled(monitor))
+        collections = monitor.collections
+        time.sleep(0.1)
+        self.assertEqual(monitor.collections, collections)
+        self.assertEqual(self.scheduler.heap, [])
+
+
+def start_server(delay=0):
+    server = _FakeServer('127.0.0.1', 0, delay)
+    thread = threading.Thread(target=server.run)
+    thread.setDaemon(True)
+    thread.start()
+    return server, thread
+
+
+def network_collector(server, name='guest'):
+    collector = GuestNetworkDaemon({'name': name,
+                                    'config': {'port': str(server.port)}})
+    collector.ip = '127.0.0.1'
+    return collector
+
+
+def running_monitor(name, collectors):
+    monitor = make_monitor(name, 0, history=5)
+    monitor.config = ConfigParser.SafeConfigParser()
+    monitor.config.add_section('__int__')
+    monitor.config.set('__int__', 'running', '1')
+    monitor.ready = None
+    monitor.collectors = collectors
+    return monitor
+
+
+class SlowCollector(StaticCollector):
+    """
+    Report the same data after a while
+    """
+    def __init__(self, data, fields, delay, timeout=None):
+        StaticCollector.__init__(self, data, fields)
+        self.delay = delay
+        if timeout is not None:
+            self.timeout = timeout
+
+    def collect(self):
+        time.sleep(self.delay)
+        return self.data
+
+
+class SilentCollector(AsyncCollector):
+    """
+    Wait for data which never comes
+    """
+    timeout = 0.1
+
+    def __init__(self):
+        self.sockets = socket.socketpair()
+
+    def collect_async(self):
+        yield (self.sockets[0], READ)
+        yield {'a': 1}
+
+    def getFields(self=None):
+        return set(['a'])
+
+
+class TestAsyncCollectors(unittest.TestCase):
+    def setUp(self):
+        self.server, self.thread = start_server()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+    def test_network_daemon(self):
+        collector = network_collector(self.server)
+        self.assertEqual(collector.collect()['major_fault'], 1)
+        self.assertEqual(collector.collect()['major_fault'], 2)
+        self.assertEqual(sorted(collector.collect()),
+                         sorted(collector.getFields()))
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        collector = network_collector(self.server)
+        collector.timeout = 0.1
+        self.assertRaises(CollectionError, collector.collect)
+        self.assertEqual(collector.socket, None)
+        self.assertRaises(CollectionError, SilentCollector().collect)
+
+
+class TestCollectionEngine(unittest.TestCase):
+    def setUp(self):
+        self.server, self.thread = start_server(delay=0.3)
+        self.engine = CollectionEngine(2)
+
+    def tearDown(self):
+        self.engine.shutdown(5)
+        self.assertFalse(self.engine.thread.isAlive())
+        self.server.stop()
+        self.thread.join()
+
+    def test_overlap(self):
+        monitors = [running_monitor('guest%i' % i,
+                                    [network_collector(self.server),
+                                     StaticCollector({'x': i}, ['x'])])
+                    for i in xrange(40)]
+        for monitor in monitors:
+            self.engine.add(monitor, 1)
+        # One after the other, the collections would take 12 seconds
+        time.sleep(1.6)
+        for i, monitor in enumerate(monitors):
+            self.assertTrue(monitor.isReady(), monitor.name)
+            self.assertEqual(monitor.statistics.latest('x'), i)
+            self.assertTrue(monitor.statistics.latest('mem_available') > 0)
+        self.assertTrue(self.server.requests >= 40)
+        self.assertEqual(len(self.engine.utilization()), 1)
+
+    def test_timeouts(self):
+        slow = running_monitor('slow', [SlowCollector({'a': 1}, ['a'], 0.5,
+                                                      timeout=0.1)])
+        silent = running_monitor('silent', [SilentCollector()])
+        for monitor in (slow, silent):
+            self.engine.add(monitor, 0.2)
+        time.sleep(0.8)
+        for monitor in (slow, silent):
+            self.assertFalse(monitor.isReady())
+            self.assertEqual(len(monitor.statistics), 0)
+            self.assertTrue(self.engine.scheduled(monitor))
+
+        silent.terminate()
+        time.sleep(0.5)
+        self.assertFalse(self.engine.scheduled(silent))
+        self.assertEqual(self.engine.waiting, {})
+
+
+class EventHypervisor(HypervisorInterface):
+    """
+    Report guests started and stopped by the test
+    """
+    def __init__(self, vms):
+        self.vms = vms
+        self.callbacks = []
+
+    def registerVmEventCallback(self, callback):
+        self.callbacks.append(callback)
+        return True
+
+    def getVmList(self):
+        return list(self.vms)
+
+    def getVmInfo(self, id):
+        return {'name': 'guest%i' % id, 'uuid': 'uuid-%i' % id}
+
+    def event(self, event, id):
+        if event == VM_STARTED:
+            self.vms.append(id)
+        else:
+            self.vms.remove(id)
+        for callback in self.callbacks:
+            callback(event, id if event == VM_STARTED else None,
+                     'uuid-%i' % id)
+
+
+class TestGuestEvents(unittest.TestCase):
+    def setUp(self):
+        self.config = ConfigParser.SafeConfigParser()
+        self.config.add_section('main')
+        for name, value in (('guest-manager-interval', '1'),
+                            ('guest-monitor-interval', '1'),
+                            ('guest-collector-threads', '1'),
+                            ('guest-collector-events', 'false'),
+                            ('sample-history-length', '5'),
+                            ('history-dir', ''),
+                            ('history-tiers', '')):
+            self.config.set('main', name, value)
+        self.config.add_section('guest')
+        self.config.set('guest', 'collectors', '')
+        self.config.add_section('__int__')
+        self.config.set('__int__', 'running', '1')
+        self.config.set('__int__', 'plot-subdir', '')
+
+    def wait_for(self, manager, ids):
+        for i in xrange(50):
+            if sorted(manager.guests) == ids:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(manager.guests), ids)
+
+    def test_events(self):
+        hypervisor = EventHypervisor([1])
+        manager = GuestManager(self.config, hypervisor)
+        try:
+            self.wait_for(manager, [1])
+            guest = manager.guests[1]
+            # Well before the next poll
+            hypervisor.event(VM_STARTED, 2)
+            self.wait_for(manager, [1, 2])
+            hypervisor.event(VM_STOPPED, 1)
+            self.wait_for(manager, [2])
+            self.assertFalse(guest._should_run())
+        finally:
+            self.config.set('__int__', 'running', '0')
+            manager.join(5)
+        self.assertFalse(manager.isAlive())
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline(0.1, 2)
+
+    def tearDown(self):
+        self.pipeline.shutdown()
+
+    def test_tick(self):
+        monitors = [running_monitor('guest%i' % i,
+                                    [SlowCollector({'x': i}, ['x'], 0.025)])
+                    for i in xrange(4)]
+        crashing = FakeMonitor('crashing', crash=True)
+        for monitor in monitors + [crashing]:
+            self.pipeline.add(monitor, 5)
+        self.assertEqual(self.pipeline.stats(),
+                         {'latency': {}, 'sample_age': {}})
+
+        self.pipeline.collect()
+        # Collected in parallel, at once rather than at their interval
+        for i, monitor in enumerate(monitors):
+            self.assertEqual(monitor.statistics.latest('x'), i)
+        self.assertFalse(self.pipeline.scheduled(crashing))
+        self.pipeline.sample_ages(monitors)
+        self.pipeline.end_stage('snapshot')
+        self.pipeline.end_stage('evaluate')
+        self.pipeline.end_tick()
+
+        stats = self.pipeline.stats()
+        self.assertEqual(sorted(stats['latency']),
+                         ['collect', 'evaluate', 'snapshot'])
+        # Two rounds of collections, well within the interval.  monotonic()
+        # counts in clock ticks of 10ms.
+        self.assertTrue(0.04 <= stats['latency']['collect'] < 0.1,
+                        stats['latency'])
+        self.assertEqual(sorted(stats['sample_age']),
+                         sorted(m.name for m in monitors))
+        for age in stats['sample_age'].values():
+            self.assertTrue(0 <= age < 0.2, age)
+        self.assertEqual(len(self.pipeline.utilization()), 1)
+
+        monitors[0].terminate()
+        self.pipeline.collect()
+        self.pipeline.end_tick()
+        self.assertFalse(self.pipeline.scheduled(monitors[0]))
+        self.assertEqual(self.pipeline.stats()['sample_age'], {})
+
+    def test_late(self):
+        slow = running_monitor('slow', [SlowCollector({'x': 1}, ['x'], 0.25)])
+        fast = running_monitor('fast', [StaticCollector({'x': 2}, ['x'])])
+        for monitor in (slow, fast):
+            self.pipeline.add(monitor, 5)
+        start = monotonic()
+        self.pipeline.collect()
+        # The tick does not wait for the late Monitor
+        self.assertTrue(monotonic() - start < 0.2)
+        self.assertEqual(fast.statistics.latest('x'), 2)
+        self.assertEqual(len(slow.statistics), 0)
+
+        # Nor collects it again until it completes
+        self.pipeline.collect()
+        self.assertEqual(len(fast.statistics), 2)
+        time.sleep(0.3)
+        self.assertEqual(len(slow.statistics), 1)
+        self.pipeline.collect()
+        self.assertEqual(len(fast.statistics), 3)
+        self.assertTrue(self.pipeline.scheduled(slow))
+
+    def test_wait(self):
+        start = monotonic()
+        for i in xrange(3):
+            self.pipeline.wait()
+            # Work does not make the ticks drift
+            time.sleep(0.05)
+        self.assertTrue(0.29 <= monotonic() - start < 0.4)
+        # Late ticks are skipped
+        time.sleep(0.25)
+        before = monotonic()
+        self.pipeline.wait()
+        self.assertTrue(monotonic() - before < 0.05)
@@ -178,6 +178,25 @@ class TestEval(unittest.TestCase):
         """
         self.verify(pol, [ 10, 'foo', 2, 2, 'foo', 4, 2, 5, 4, 5, 5, 5 ])
 
+    def test_dynamic_scope(self):
+        pol = """
+        (defvar x 1)
+        (def get_x () x)
+        (def f (x) (get_x))             # functions see the caller's variables
+        (f 2)
+        (get_x)
+        (def g (c) {
+            (if c (defvar y 1) 0)       # y is bound only if c is true
+            (defvar y 2)
+            y
+        })
+        (g 1)
+        (g 0)
+        (let ((a 5) (b a)) b)           # let values see the preceding names
+        (let ((min abs)) (min -3))      # variables take precedence
+        """
+        self.verify(pol, [1, 'get_x', 'f', 2, 1, 'g', 1, 2, 5, 3])
+
     def test_multi_statements(self):
         pol = """
         { 10 4 }                # A multi-statement evaluates to the last value
@@ -289,6 +308,22 @@ class TestEval(unittest.TestCase):
         """
         self.assertRaises(Parser.PolicyError, Parser.eval, self.e, pol)
 
+    def test_brackets(self):
+        pol = """
+        [+ 1 2]                 # Square brackets are plain lists
+        (- [* 2 3] (+ 1 1))
+        """
+        self.verify(pol, [3, 4])
+
+        code = Parser.get_code(self.e, "() {}")
+        self.assertEqual(len(code), 2)
+        self.assertEqual(code[0], [])
+        self.assertEqual(code[1][0].value, 'eval')
+
+    def test_unbalanced_brackets(self):
+        for pol in ("(+ 1 2]", "(+ 1 2))", ")", "{ (+ 1 2) ", ""):
+            self.assertRaises(Parser.PolicyError, Parser.get_code, self.e, pol)
+
     def test_parse_error(self):
         pol = """
         (2 + 2)
@@ -334,5 +369,73 @@ class TestEval(unittest.TestCase):
         """
         self.verify(pol, ["lala"])
 
+    def test_debug_stripped(self):
+        e = Parser.Evaluator()
+        e.strip_debug = True
+        code = Parser.compile(e, Parser.get_code(e, '''
+            (debug "test" 1 nil "lala")
+            (def f (x) (debug x (x.Prop "a") 2))
+            (debug undefined_name 3)
+            (debug (undefined_name.Prop "a") 4)
+        '''))
+        self.assertEqual(code[0](e), "lala")
+        self.assertEqual(code[1](e), "f")
+        # Undefined symbols are reported even though nothing is printed
+        self.assertRaises(Parser.PolicyError, code[2], e)
+        self.assertRaises(KeyError, code[3], e)
+
+    def test_compile(self):
+        pol = """
+        (defvar a 3)
+        (def f (x y) { (defvar z (* x y)) (set a (+ a z)) (- z a) })
+        (f 2 (+ a 1))
+        (let ((a 1) (b a)) (f a b))
+        (if (> a 10) "big" "small")
+        (setq a (max a 4 (min 1 2)))
+        { (abs -1) a }
+        """
+        code = Parser.get_code(self.e, pol)
+        interpreted = map(Parser.Evaluator().eval, code)
+        evaluator = Parser.Evaluator()
+        compiled = [expr(evaluator)
+                    for expr in Parser.compile(evaluator, code)]
+        self.assertEqual(interpreted, compiled)
+
+    def test_compile_late_binding(self):
+        class TestEntity(object):
+            def get(self):
+                return 3
+        # Compiled before any stack knows the name of the entity
+        code = Parser.compile(self.e, Parser.get_code(self.e, '''
+        (LateEntity.get)
+        (+ 1 (LateEntity.get))
+        '''))
+        self.e.stack.set('LateEntity', TestEntity(), True)
+        self.assertEqual([expr(self.e) for expr in code], [3, 4])
+
+    def test_compile_bindings(self):
+        # Names bound in inner scopes by the code of one evaluator do not
+        # prevent another one from reading its globals directly
+        e = Parser.Evaluator()
+        Parser.compile(e, Parser.get_code(e, '(let ((local_x 1)) local_x)'))
+        self.assertTrue('local_x' in e.bindings.local_names)
+        other = Parser.Evaluator()
+        self.assertFalse('local_x' in other.bindings.names)
+        other.stack.set('local_x', 2, True)
+        code = Parser.compile(other, Parser.get_code(other, 'local_x'))
+        self.assertEqual(code[0](other), 2)
+        self.assertFalse('local_x' in other.bindings.local_names)
+        # Forks share the names of their evaluator
+        self.assertTrue(e.fork().bindings is e.bindings)
+
+    def test_compile_error(self):
+        pol = """
+        (2 + 2)
+        """
+        # Malformed expressions still fail when evaluated, not when compiled
+        code = Parser.compile(self.e, Parser.get_code(self.e, pol))
+        self.assertRaises(Parser.PolicyError, code[0], self.e)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,304 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import threading
+import unittest
+from mom.Entity import Entity
+from mom.Policy import Parser
+from mom.Policy.Parser import Evaluator
+from mom.Policy.Policy import Policy, WorkerPool
+from VectorTests import BALLOON_POLICY, make_guests
+
+
+class PolicyTests(unittest.TestCase):
+    def setUp(self):
+        self.policy = Policy()
+
+    def run_code(self):
+        evaluator = Evaluator(self.policy.bindings)
+        return [expr(evaluator) for expr in self.policy.code]
+
+    def test_named_policies(self):
+        self.assertTrue(self.policy.set_policy('20_b', '(+ 1 1) # no newline'))
+        self.assertTrue(self.policy.set_policy('10_a', '(- 1 1)'))
+        self.assertTrue(self.policy.set_policy('30_c', '# only a comment\n'))
+        self.assertEqual(self.policy.get_string(),
+                         '(- 1 1)\n(+ 1 1) # no newline\n# only a comment\n')
+        self.assertEqual(self.run_code(), [0, 2])
+
+    def test_incremental(self):
+        self.policy.set_policy('10_a', '(+ 1 1)')
+        self.policy.set_policy('20_b', '(+ 2 2)')
+        code = list(self.policy.code)
+
+        # Only the changed policy is compiled again
+        self.policy.set_policy('20_b', '(+ 3 3)')
+        self.assertTrue(self.policy.code[0] is code[0])
+        self.assertFalse(self.policy.code[1] is code[1])
+
+        # Reloading an unchanged policy reuses its code
+        self.policy.clear_policy()
+        self.policy.set_policy('10_a', '(+ 1 1)')
+        self.assertTrue(self.policy.code[0] is code[0])
+
+    def test_bad_policy(self):
+        self.policy.set_policy('10_a', '(+ 1 1)')
+        self.assertFalse(self.policy.set_policy('10_a', '(+ 1'))
+        self.assertEqual(self.policy.get_string(), '(+ 1 1)')
+        self.assertEqual(self.run_code(), [2])
+
+        self.assertTrue(self.policy.set_policy('10_a', None))
+        self.assertEqual(self.policy.get_string(), '0')
+        self.assertEqual(self.policy.code, ())
+
+    def test_unlocked_evaluation(self):
+        class Host(object):
+            started = threading.Event()
+            release = threading.Event()
+            def Prop(self, name):
+                self.started.set()
+                self.release.wait()
+                return 1
+
+        host = Host()
+        results = []
+        self.policy.set_policy('10_a', '(Host.Prop "a")')
+        thread = threading.Thread(
+            target=lambda: results.append(self.policy.evaluate(host, [])))
+        thread.start()
+        try:
+            host.started.wait()
+            self.assertTrue(self.policy.policy_sem.acquire(False))
+            self.policy.policy_sem.release()
+            # Policies can be read and replaced while they are evaluated...
+            self.assertTrue(self.policy.set_policy('10_a', '(+ 1 1)'))
+            self.assertEqual(self.policy.get_string(), '(+ 1 1)')
+        finally:
+            host.release.set()
+            thread.join()
+        # ...without changing the code of the running evaluation
+        self.assertEqual(results, [True])
+        self.assertEqual(self.run_code(), [2])
+
+    def test_optimize(self):
+        logger = logging.getLogger('mom.Evaluator')
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            self.policy.set_policy('10_a', '''
+                (defvar a 2)
+                (defvar b (* a 3))
+                (defvar c 1)
+                (def inc (x) (+ x b))
+                (* b (inc a))
+                (debug "b" b)
+            ''')
+            code = self.policy.code
+            # Constants, inlined calls and debug calls need nothing bound
+            self.assertEqual(code[4](Evaluator()), 48)
+            self.assertEqual(code[5](Evaluator()), 6)
+
+            # Reassigned anywhere, the variable is not a constant anymore
+            self.policy.set_policy('20_b', '(set b 1) (inc 1)')
+            self.assertFalse(self.policy.code[4] is code[4])
+            self.assertEqual(self.run_code(), [2, 6, 1, 'inc', 48, 6, 1, 2])
+
+            # Debug output is printed again once enabled
+            logger.setLevel(logging.DEBUG)
+            self.assertTrue(self.policy.evaluate(None, []))
+            self.assertTrue(self.policy.debug)
+        finally:
+            logger.setLevel(level)
+
+    def test_optimize_semantics(self):
+        policies = {
+            '10_a': '''
+                (defvar limit 100)
+                (defvar ratio (/ limit 4.0))
+                (defvar shadowed 1)
+                (defvar later 5)
+                (def early () later)
+                (def scale (guest n) (* n (- guest.balloon_cur ratio)))
+                (def clamp (v) (min (max v 0) limit))
+                (def uses_shadowed () shadowed)
+                (def twice (a b) (+ a b))
+            ''',
+            '20_b': '''
+                (defvar later 6)
+                (let ((shadowed 2)) (uses_shadowed))
+                (twice limit ratio)
+                (if (> limit 10) (defvar big 1) (defvar big 0))
+                (with Guests guest
+                    (clamp (scale guest (debug "n" (guest.Prop "n")))))
+                (with Guests guest (debug (guest.Control "t" ratio) 0))
+                (early)
+                (let ((b 3)) (twice b b))
+            ''',
+        }
+        def guests():
+            ret = []
+            for i in xrange(4):
+                guest = Entity()
+                guest._set_property('n', i)
+                guest._set_statistics([{'balloon_cur': 20 * i}])
+                guest._finalize()
+                ret.append(guest)
+            return ret
+
+        e = Evaluator()
+        expected_guests = guests()
+        e.stack.set('Guests', expected_guests, True)
+        expected = Parser.eval(e, '\n'.join(policies[k]
+                                            for k in sorted(policies)))
+
+        logger = logging.getLogger('mom.Evaluator')
+        level = logger.level
+        try:
+            for debug in (logging.INFO, logging.DEBUG):
+                logger.setLevel(debug)
+                policy = Policy()
+                for name, string in policies.items():
+                    policy.set_policy(name, string)
+                e = Evaluator(policy.bindings)
+                results_guests = guests()
+                e.stack.set('Guests', results_guests, True)
+                results = [expr(e) for expr in policy.code]
+                self.assertEqual(repr(results), repr(expected))
+                self.assertEqual([g.controls for g in results_guests],
+                                 [g.controls for g in expected_guests])
+        finally:
+            logger.setLevel(level)
+
+    def test_parallel(self):
+        class Pool(WorkerPool):
+            batches = 0
+            def map(self, fn, batches):
+                self.batches += len(batches)
+                return WorkerPool.map(self, fn, batches)
+
+        logger = logging.getLogger('mom.Evaluator')
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            serial = Policy()
+            serial.set_policy(None, BALLOON_POLICY)
+            parallel = Policy(workers=4)
+            parallel.pool.close()
+            parallel.pool = Pool(4)
+            parallel.set_policy(None, BALLOON_POLICY)
+            for seed in xrange(5):
+                expected = make_guests(200, seed)
+                guests = make_guests(200, seed)
+                self.assertTrue(serial.evaluate(None, expected))
+                self.assertTrue(parallel.evaluate(None, guests))
+                self.assertEqual([g.controls for g in guests],
+                                 [g.controls for g in expected])
+            self.assertEqual(parallel.pool.batches, 20)
+
+            # Changing global variables needs the guests one after another
+            parallel.pool.batches = 0
+            parallel.set_policy(None, '''
+                (defvar total 0)
+                (def accumulate (guest) (set total (+ total guest.balloon_cur)))
+                (with Guests guest (accumulate guest))
+                (with Guests guest (Host.Control "last" guest.balloon_cur))
+            ''')
+            host = Entity()
+            guests = make_guests(20, 0)
+            self.assertTrue(parallel.evaluate(host, guests))
+            self.assertEqual(host.controls, {'last': guests[-1].balloon_cur})
+            self.assertEqual(parallel.pool.batches, 0)
+
+            # So does changing the Host or a guest through another name
+            for policy in ('(defvar hh Host)\n'
+                           '(with Guests guest '
+                           '(hh.Control "last" guest.balloon_cur))',
+                           '(def last (host guest) '
+                           '(host.Control "last" guest.balloon_cur))\n'
+                           '(with Guests guest (last Host guest))',
+                           '(def last (guest host) '
+                           '(host.Control "last" guest.balloon_cur))\n'
+                           '(with Guests guest (last Host guest))',
+                           '(with Guests guest '
+                           '{ (defvar hh Host) '
+                           '(hh.Control "last" guest.balloon_cur) })'):
+                parallel.set_policy(None, policy)
+                host = Entity()
+                self.assertTrue(parallel.evaluate(host, guests))
+                self.assertEqual(host.controls,
+                                 {'last': guests[-1].balloon_cur})
+            self.assertEqual(parallel.pool.batches, 0)
+
+            # Unlike changing the guest through a function
+            parallel.set_policy(None, """
+                (def set_target (target guest)
+                    (guest.Control "balloon_target" target))
+                (with Guests guest (set_target guest.balloon_cur guest))
+            """)
+            self.assertTrue(parallel.evaluate(host, guests))
+            self.assertEqual([g.controls['balloon_target'] for g in guests],
+                             [g.balloon_cur for g in guests])
+            self.assertEqual(parallel.pool.batches, 4)
+
+            parallel.shutdown()
+            self.assertTrue(parallel.pool is None)
+            self.assertTrue(parallel.evaluate(host, guests))
+        finally:
+            logger.setLevel(level)
+
+    def test_profile(self):
+        policy = Policy(profile=True)
+        policy.set_policy('10_a', '''
+            (def fact (n) (if (< n 2) 1 (* n (fact (- n 1)))))
+            (fact 5)
+            { (fact 2) (debug "fact") }
+        ''')
+        self.assertTrue(policy.evaluate(None, []))
+        self.assertTrue(policy.evaluate(None, []))
+
+        profile = policy.get_profile()
+        self.assertEqual(sorted(profile['expressions'].keys()),
+                         ['10_a:1 (def fact (n) (if (< n 2) 1 (* n (fac...',
+                          '10_a:2 (fact 5)',
+                          '10_a:3 (eval (fact 2) (debug "fact"))'])
+        self.assertEqual(profile['functions'].keys(), ['fact'])
+        self.assertEqual(profile['functions']['fact']['calls'], 14)
+        self.assertEqual(profile['builtins']['def']['calls'], 2)
+        self.assertEqual(profile['builtins']['lt']['calls'], 14)
+        self.assertEqual(profile['builtins']['mul']['calls'], 10)
+        for section in profile.values():
+            for entry in section.values():
+                self.assertTrue(entry['time'] >= 0)
+        # The time of recursive calls is only counted once
+        self.assertTrue(profile['functions']['fact']['time'] <=
+                        profile['expressions']['10_a:2 (fact 5)']['time'] +
+                        profile['expressions'][
+                            '10_a:3 (eval (fact 2) (debug "fact"))']['time'])
+
+        policy.reset_profile()
+        self.assertEqual(policy.get_profile(),
+                         {'functions': {}, 'builtins': {}, 'expressions': {}})
+
+    def test_profile_disabled(self):
+        self.policy.set_policy('10_a', '(+ 1 1)')
+        self.assertTrue(self.policy.evaluate(None, []))
+        self.assertEqual(self.policy.get_profile(),
+                         {'functions': {}, 'builtins': {}, 'expressions': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
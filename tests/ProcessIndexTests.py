@@ -0,0 +1,119 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import shutil
+import tempfile
+import unittest
+from mom.Collectors.ProcessIndex import ProcessIndex
+
+UUID1 = '0f1d3ab6-59b5-4c1f-9a62-7e3b1c5e1f01'
+UUID2 = '0f1d3ab6-59b5-4c1f-9a62-7e3b1c5e1f02'
+
+
+class TestProcessIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = ProcessIndex(self.root)
+        self.index.page_kb = 4
+        self.reads = 0
+        read = self.index._read
+
+        def counting_read(pid, name):
+            if name == 'cmdline':
+                self.reads += 1
+            return read(pid, name)
+        self.index._read = counting_read
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def process(self, pid, argv, pages=0):
+        path = os.path.join(self.root, str(pid))
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        with open(os.path.join(path, 'cmdline'), 'w') as f:
+            f.write(''.join(arg + '\0' for arg in argv))
+        with open(os.path.join(path, 'statm'), 'w') as f:
+            f.write('%i 10 5 1 0 3 0\n' % pages)
+
+    def exit(self, pid):
+        shutil.rmtree(os.path.join(self.root, str(pid)))
+
+    def test_find_uuid(self):
+        self.process(1, ['/sbin/init'])
+        self.process(2, [])
+        self.process(100, ['/usr/bin/qemu-kvm', '-name', 'guest1',
+                           '-uuid', UUID1])
+        self.process(200, ['/usr/bin/qemu-kvm', '-name', 'guest2',
+                           '-uuid', UUID2])
+        os.mkdir(os.path.join(self.root, 'self'))
+        # Every process, and the match again
+        self.assertEqual(self.index.find_uuid(UUID1), [100])
+        self.assertEqual(self.reads, 5)
+
+        # Remembered while the process is running
+        self.assertEqual(self.index.find_uuid(UUID1), [100])
+        self.assertEqual(self.reads, 6)
+
+        # Only the processes new or indexed by the last lookup are read,
+        # and the matches again
+        self.process(300, ['/usr/bin/python', 'tool', UUID2])
+        self.assertEqual(self.index.find_uuid(UUID2), [200, 300])
+        self.assertEqual(self.reads, 13)
+        self.exit(300)
+        self.assertEqual(self.index.find_uuid(UUID2), [200])
+        self.assertEqual(self.reads, 14)
+
+        # The pid of an exited process is reused
+        self.exit(100)
+        self.process(100, ['/usr/bin/sleep', '1'])
+        self.assertEqual(self.index.find_uuid(UUID1), [])
+        self.process(101, ['/usr/bin/qemu-kvm', '-uuid', UUID1])
+        self.assertEqual(self.index.find_uuid(UUID1), [101])
+
+    def test_exec(self):
+        # Indexed between fork() and exec()
+        self.process(100, ['/usr/sbin/libvirtd'])
+        self.assertEqual(self.index.find_name('qemu'), [])
+        self.process(100, ['/usr/bin/qemu-system-x86_64', '-uuid', UUID1])
+        self.assertEqual(self.index.find_name('qemu'), [100])
+        self.assertEqual(self.index.find_uuid(UUID1), [100])
+
+    def test_miss(self):
+        # A host without guests, looked up at every collection
+        self.process(1, ['/sbin/init'])
+        self.process(100, ['/usr/sbin/libvirtd'])
+        self.assertEqual(self.index.find_name('qemu'), [])
+        self.assertEqual(self.index.find_uuid(UUID1), [])
+        self.assertEqual(self.reads, 4)
+        for i in xrange(3):
+            self.assertEqual(self.index.find_name('qemu'), [])
+            self.assertEqual(self.index.find_uuid(UUID1), [])
+        self.assertEqual(self.reads, 4)
+
+    def test_find_name(self):
+        self.process(1, ['/sbin/init'])
+        self.process(2, [])
+        self.process(100, ['/usr/libexec/qemu-kvm', '-uuid', UUID1], 1000)
+        self.process(200, ['qemu-system-x86_64', '-uuid', UUID2], 500)
+        self.process(300, ['/usr/bin/vim', 'qemu.conf'])
+        pids = self.index.find_name('qemu')
+        self.assertEqual(pids, [100, 200])
+        self.assertEqual([self.index.vsz(pid) for pid in pids], [4000, 2000])
+        self.exit(100)
+        self.assertEqual(self.index.vsz(100), None)
+        self.assertEqual(self.index.find_name('qemu'), [200])
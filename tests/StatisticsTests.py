@@ -0,0 +1,568 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import ConfigParser
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mom.Collectors.Collector import Collector
+from mom.Entity import Entity
+from mom.Entity import EntityError
+from mom.GuestManager import GuestManager
+from mom.HistoryFile import HistoryFile
+from mom.HypervisorInterfaces.HypervisorInterface import HypervisorInterface
+from mom.Monitor import Monitor
+from mom.Plotter import Plotter
+from mom.Statistics import Statistics
+from mom.Statistics import parse_rollups
+
+
+def make_monitor(name, samples, fields=10, history=None, history_dir=''):
+    """
+    Build a ready Monitor holding 'samples' samples of 'fields' fields
+    """
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('main')
+    config.set('main', 'sample-history-length', str(history or samples))
+    config.set('main', 'history-dir', history_dir)
+    config.set('main', 'history-tiers', '')
+    config.add_section('__int__')
+    config.set('__int__', 'plot-subdir', '')
+    monitor = Monitor(config, name)
+    monitor.fields = set('field%i' % i for i in xrange(fields))
+    monitor.optional_fields = set()
+    monitor.field_index = frozenset(monitor.fields)
+    monitor.properties['name'] = name
+    for i in xrange(samples):
+        monitor.statistics.append(dict((field, i) for field in monitor.fields))
+    monitor._publish()
+    monitor.ready = True
+    return monitor
+
+
+class CountingCollector(Collector):
+    """
+    Report the number of calls in fields 'a' and 'b'
+    """
+    def __init__(self, properties):
+        self.count = 0
+
+    def collect(self):
+        self.count += 1
+        return {'a': self.count, 'b': self.count}
+
+    def getFields(self=None):
+        return set(['a', 'b'])
+
+
+class TestStatistics(unittest.TestCase):
+    def test_ring(self):
+        stats = Statistics(3)
+        for i in xrange(5):
+            stats.append({'a': i, 'b': i * 0.5})
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(list(stats), [{'a': 2, 'b': 1.0}, {'a': 3, 'b': 1.5},
+                                       {'a': 4, 'b': 2.0}])
+        self.assertEqual(stats[0], {'a': 2, 'b': 1.0})
+        self.assertEqual(stats[-1], {'a': 4, 'b': 2.0})
+        self.assertRaises(IndexError, stats.__getitem__, 3)
+        self.assertEqual(stats.values('a'), [2, 3, 4])
+        self.assertEqual(stats.latest('b'), 2.0)
+
+    def test_grow(self):
+        stats = Statistics()
+        for i in xrange(100):
+            stats.append({'a': i})
+        self.assertEqual(len(stats), 100)
+        self.assertEqual(stats.values('a'), range(100))
+
+    def test_fields(self):
+        stats = Statistics(3)
+        stats.append({'a': 1, 'opt': None})
+        stats.append({'a': 2, 'opt': 5})
+        stats.update('new', 'x')
+        self.assertEqual(list(stats), [{'a': 1, 'opt': None},
+                                       {'a': 2, 'opt': 5, 'new': 'x'}])
+        self.assertEqual(stats.values('opt'), [5])
+        self.assertEqual(stats.values('opt', none=True), [None, 5])
+        self.assertEqual(stats.latest('missing', 0), 0)
+
+        # A sample drops the fields it does not have when it is evicted
+        stats.append({'a': 3})
+        stats.append({'a': 4})
+        self.assertEqual(list(stats), [{'a': 2, 'opt': 5, 'new': 'x'},
+                                       {'a': 3}, {'a': 4}])
+        stats.append({'a': 5})
+        self.assertEqual(stats.values('new'), [])
+
+    def test_types(self):
+        stats = Statistics(4)
+        values = [1, 2.5, True, 'str']
+        for value in values:
+            stats.append({'a': value})
+        self.assertEqual(map(type, stats.values('a')), map(type, values))
+        self.assertEqual(stats.values('a'), values)
+
+    def test_copy(self):
+        stats = Statistics(2)
+        stats.append({'a': 1})
+        copy = stats.copy()
+        stats.append({'a': 2})
+        copy.update('a', 3)
+        self.assertEqual(stats.values('a'), [1, 2])
+        self.assertEqual(copy.values('a'), [3])
+
+    def test_entity(self):
+        rows = [{'a': 1, 'b': None}, {'a': 2, 'b': 4}, {'a': 4, 'b': 6}]
+        entity = Entity()
+        entity._set_statistics(rows)
+        self.assertEqual(entity.Stat('a'), 4)
+        self.assertEqual(entity.Stat('c', 0), 0)
+        # Integer statistics average like they always did
+        self.assertEqual(entity.StatAvg('a'), 2.0)
+        self.assertEqual(entity.StatAvg('b'), 5.0)
+        self.assertEqual(entity.StatAvg('c'), 0.0)
+        self.assertAlmostEqual(entity.StatStdDeviation('a'), 1.247219128924647)
+        self.assertEqual(entity.StatStdDeviation('c'), None)
+
+    def test_aggregates(self):
+        rand = random.Random(1)
+        stats = Statistics(7)
+        for i in xrange(100):
+            if i % 5 == 0:
+                stats.append({'a': None})
+            elif i < 50:
+                stats.append({'a': rand.randint(-100, 100)})
+            else:
+                stats.append({'a': rand.uniform(-100, 100)})
+            if i % 3 == 0:
+                stats.update('a', rand.choice([None, 0, 100, -100]))
+
+            values = stats.values('a')
+            count, total = stats.total('a')
+            self.assertEqual(count, len(values))
+            if all(type(value) is int for value in values):
+                self.assertEqual(total, sum(values))
+                self.assertEqual(type(total), int)
+            else:
+                self.assertAlmostEqual(total, sum(values))
+            if values:
+                mean = float(sum(values)) / len(values)
+                variance = sum((v - mean) ** 2 for v in values) / len(values)
+                self.assertAlmostEqual(stats.variance('a'), variance)
+                self.assertEqual(stats.minimum('a'), min(values))
+                self.assertEqual(stats.maximum('a'), max(values))
+            else:
+                self.assertEqual(stats.variance('a'), None)
+                self.assertEqual(stats.minimum('a'), None)
+
+        # Values of other types are aggregated the way they always were
+        stats.append({'a': 'str'})
+        self.assertRaises(TypeError, stats.total, 'a')
+        self.assertEqual(stats.maximum('a'), 'str')
+        for i in xrange(7):
+            stats.append({'a': i})
+        self.assertEqual(stats.total('a'), (7, 21))
+
+    def test_ewma(self):
+        stats = Statistics(3)
+        self.assertEqual(stats.ewma('a', 0.5), None)
+        for value in (1, 3, 5):
+            stats.append({'a': value})
+        self.assertEqual(stats.ewma('a', 0.5), 3.5)
+        # From then on older values are part of the average
+        stats.append({'a': 7})
+        self.assertEqual(stats.ewma('a', 0.5), 5.25)
+        stats.update('a', 9)
+        self.assertEqual(stats.ewma('a', 0.5), 6.25)
+        stats.update('a', None)
+        self.assertEqual(stats.ewma('a', 0.5), 3.5)
+        self.assertEqual(stats.copy().ewma('a', 0.5), 3.5)
+
+    def test_entity_aggregates(self):
+        entity = Entity()
+        entity._set_statistics([{'a': 3}, {'a': 1.5}, {'a': 2}])
+        self.assertEqual(entity.StatMin('a'), 1.5)
+        self.assertEqual(entity.StatMax('a'), 3)
+        self.assertEqual(entity.StatMin('c'), None)
+        self.assertEqual(entity.StatEWMA('a', 1), 2.0)
+        self.assertEqual(entity.StatEWMA('c', 0.5), None)
+        self.assertRaises(EntityError, entity.StatEWMA, 'a', 0)
+        mean = 6.5 / 3
+        self.assertAlmostEqual(entity.StatStdDeviation('a'), math.sqrt(
+            ((3 - mean) ** 2 + (1.5 - mean) ** 2 + (2 - mean) ** 2) / 3))
+
+    def test_snapshot(self):
+        stats = Statistics(3)
+        for i in xrange(3):
+            stats.append({'a': i})
+        snapshot = stats.snapshot()
+        for i in xrange(3, 8):
+            stats.append({'a': i, 'b': 'x'})
+        stats.update('a', 10)
+        self.assertEqual(list(snapshot), [{'a': 0}, {'a': 1}, {'a': 2}])
+        self.assertEqual(snapshot.total('a'), (3, 3))
+        self.assertEqual(stats.values('a'), [5, 6, 10])
+
+        # Changing the latest sample right after a snapshot copies its column
+        snapshot = stats.snapshot()
+        stats.update('a', 11)
+        self.assertEqual(snapshot.values('a'), [5, 6, 10])
+        self.assertTrue(stats.columns['b'].states is
+                        snapshot.columns['b'].states)
+        self.assertFalse(stats.columns['a'].states is
+                         snapshot.columns['a'].states)
+        snapshot.update('a', 12)
+        snapshot.append({'a': 13})
+        self.assertEqual(snapshot.values('a'), [6, 12, 13])
+        self.assertEqual(stats.values('a'), [5, 6, 11])
+        self.assertEqual(stats.maximum('a'), 11)
+
+    def test_interrogate(self):
+        monitor = make_monitor('guest', 3, fields=2)
+        monitor.update_variables({'x': 1})
+        entity = monitor.interrogate()
+        self.assertEqual(entity.field0, 2)
+        self.assertEqual(entity.Prop('name'), 'guest')
+        self.assertRaises(AttributeError, getattr, entity, 'missing')
+
+        # Entities write to their own copies
+        entity.SetVar('x', 2)
+        entity.UpdateStatVal('field0', 5)
+        self.assertEqual(monitor.variables, {'x': 1})
+        self.assertEqual(entity.GetVar('x'), 2)
+        self.assertEqual(entity.field0, 5)
+        self.assertEqual(monitor.statistics.latest('field0'), 5)
+        monitor.statistics.append({'field0': 6, 'field1': 6})
+        self.assertEqual(entity.field0, 5)
+        self.assertEqual(entity.field1, 2)
+
+    def test_window(self):
+        stats = Statistics(4)
+        samples = ((0, 1), (10, 2), (20, None), (25, 8), (30, 16))
+        for timestamp, value in samples:
+            stats.append({'a': value}, timestamp)
+        self.assertEqual(stats.window('a', 10), [(25, 8), (30, 16)])
+        self.assertEqual(stats.window('a', 20), [(10, 2), (25, 8), (30, 16)])
+        self.assertEqual(stats.window('a', 100), stats.window('a', 20))
+        self.assertEqual(stats.window('b', 10), [])
+        self.assertEqual(stats.recent('a', 3), [2, 8, 16])
+
+        entity = Entity()
+        entity._set_statistics(stats)
+        self.assertEqual(entity.StatAvgWindow('a', 10), 12.0)
+        self.assertEqual(entity.StatAvgWindow('a', 0), 16.0)
+        self.assertEqual(entity.StatAvgWindow('b', 10), None)
+        self.assertEqual(entity.StatRate('a', 20), 0.7)
+        self.assertEqual(entity.StatRate('a', 0), None)
+        self.assertEqual(entity.StatDelta('a'), 8)
+        self.assertEqual(entity.StatDelta('b'), None)
+
+        # Timestamps survive snapshots and compaction
+        for timestamp in xrange(31, 40):
+            stats.append({'a': timestamp}, timestamp)
+        self.assertEqual(stats.window('a', 2), [(37, 37), (38, 38), (39, 39)])
+        self.assertEqual(entity.StatAvgWindow('a', 10), 12.0)
+
+    def test_rollups(self):
+        self.assertEqual(parse_rollups(' 60:60, 600:144,'),
+                         [(60, 60), (600, 144)])
+        self.assertEqual(parse_rollups(''), [])
+        self.assertRaises(ValueError, parse_rollups, '60')
+        self.assertRaises(ValueError, parse_rollups, '0:10')
+
+        stats = Statistics(2, [(10, 3)])
+        for t in xrange(0, 50, 5):
+            stats.append({'a': t, 'b': 'x'}, t)
+        self.assertEqual(len(stats), 2)
+        # Periods 20 to 40, the last one open
+        self.assertEqual(stats.rollup('a', 10), [(20, 2, 45, 20, 25),
+                                                 (30, 2, 65, 30, 35),
+                                                 (40, 2, 85, 40, 45)])
+        self.assertEqual(stats.rollup('b', 10), [])
+        self.assertRaises(KeyError, stats.rollup, 'a', 60)
+
+        # Snapshots and copies keep the periods they were taken with
+        snapshot = stats.snapshot()
+        copy = stats.copy()
+        stats.append({'a': 100}, 100)
+        copy.append({'a': 51}, 51)
+        self.assertEqual(stats.rollup('a', 10), [(100, 1, 100, 100, 100)])
+        self.assertEqual(snapshot.rollup('a', 10)[-1], (40, 2, 85, 40, 45))
+        self.assertEqual(copy.rollup('a', 10)[-2:],
+                         [(40, 2, 85, 40, 45), (50, 1, 51, 51, 51)])
+        self.assertEqual(len(snapshot.rollup('a', 10)), 3)
+
+        entity = Entity()
+        entity._set_statistics(stats)
+        self.assertEqual(entity.StatAvgTier('a', 10), 100.0)
+        self.assertEqual(entity.StatAvgTier('c', 10), None)
+        self.assertRaises(EntityError, entity.StatAvgTier, 'a', 60)
+
+
+class StaticCollector(Collector):
+    """
+    Report the same data every time
+    """
+    def __init__(self, data, fields, optional_fields=()):
+        self.data = data
+        self.fields = set(fields)
+        self.optional_fields = set(optional_fields)
+
+    def collect(self):
+        return self.data
+
+    def getFields(self=None):
+        return self.fields
+
+    def getOptionalFields(self=None):
+        return self.optional_fields
+
+
+class TestCollect(unittest.TestCase):
+    def test_schema(self):
+        monitor = make_monitor('guest', 0, history=5)
+        headers = []
+        monitor.plotter = Plotter('', 'guest')
+        monitor.plotter.setFields = headers.append
+        monitor.collectors = [
+            StaticCollector({'a': None, 'b': 2}, ['a'], ['b', 'c']),
+            StaticCollector({'a': 1, 'b': 3, 'x': 4}, ['a', 'b'])]
+        self.assertEqual(monitor.collect(),
+                         {'a': 1, 'b': 2, 'c': None, 'x': 4})
+        self.assertEqual(monitor.collect(),
+                         {'a': 1, 'b': 2, 'c': None, 'x': 4})
+        self.assertEqual(headers, [('a', 'b', 'c')])
+        self.assertEqual(monitor.fields, set(['a', 'b']))
+        self.assertEqual(monitor.optional_fields, set(['c']))
+        self.assertEqual(monitor.statistics.values('x'), [4, 4])
+        entity = monitor.interrogate()
+        self.assertEqual((entity.a, entity.b, entity.c), (1, 2, None))
+        self.assertRaises(AttributeError, getattr, entity, 'x')
+
+        # The schema follows the collectors
+        monitor.collectors = [StaticCollector({'b': 5}, ['b', 'd'])]
+        self.assertEqual(monitor.collect(), None)
+        self.assertFalse(monitor.isReady())
+        self.assertEqual(headers[-1], ('b', 'd'))
+        monitor.collectors[0].data = {'b': 5, 'd': 6}
+        self.assertEqual(monitor.collect(), {'b': 5, 'd': 6})
+        self.assertEqual(list(monitor.statistics)[-1], {'b': 5, 'd': 6})
+        self.assertEqual(len(headers), 2)
+
+
+class TestHistoryFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ring(self):
+        history = HistoryFile(self.dir, 'guest', 3)
+        self.assertEqual(history.attach(['a', 'b']), [])
+        for i in xrange(5):
+            history.append([i, i / 2.0])
+        history.append([None, 'text'])
+        history.close()
+
+        history = HistoryFile(self.dir, 'guest', 3)
+        records = history.attach(['a', 'b'])
+        self.assertEqual([sample for timestamp, sample in records],
+                         [{'a': 3, 'b': 1.5}, {'a': 4, 'b': 2.0},
+                          {'a': None}])
+        self.assertEqual(type(records[0][1]['a']), int)
+        timestamps = [timestamp for timestamp, sample in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # Records of other fields are dropped
+        self.assertEqual(history.attach(['a', 'c']), [])
+        history.append([7, 8])
+        self.assertEqual(HistoryFile(self.dir, 'guest', 3).attach(['a', 'b']),
+                         [])
+        history.close()
+
+    def test_types(self):
+        history = HistoryFile(self.dir, 'guest', 3)
+        history.attach(['a', 'b', 'c'])
+        history.append([True, False, 1])
+        history.close()
+
+        history = HistoryFile(self.dir, 'guest', 3)
+        sample = history.attach(['a', 'b', 'c'])[0][1]
+        history.close()
+        self.assertEqual(sample, {'a': True, 'b': False, 'c': 1})
+        self.assertEqual([type(sample[name]) for name in 'abc'],
+                         [bool, bool, int])
+
+    def test_unavailable(self):
+        history = HistoryFile(os.path.join(self.dir, 'missing'), 'guest', 3)
+        self.assertEqual(history.attach(['a']), [])
+        history.append([1])
+
+    def test_restart(self):
+        def run(samples):
+            monitor = make_monitor('guest', 0, history=4,
+                                   history_dir=self.dir)
+            monitor.collectors = [StaticCollector({}, ['a'], ['b'])]
+            for a in samples:
+                monitor.collectors[0].data = {'a': a, 'b': 'x'}
+                monitor.collect()
+            return monitor
+
+        run([1, 2, 3])
+        monitor = run([4])
+        self.assertEqual(monitor.statistics.values('a'), [1, 2, 3, 4])
+        self.assertEqual(monitor.statistics.values('b'), ['x'])
+        self.assertEqual(monitor.interrogate().StatAvg('a'), 2)
+        monitor = run([5])
+        self.assertEqual(monitor.statistics.values('a'), [2, 3, 4, 5])
+
+
+class TestPublication(unittest.TestCase):
+    def test_readers_do_not_wait(self):
+        monitor = make_monitor('guest', 3, fields=2)
+        monitor.data_sem.acquire()
+        try:
+            self.assertEqual(monitor.interrogate().field0, 2)
+            self.assertEqual(monitor.get_last_data(), [])
+        finally:
+            monitor.data_sem.release()
+
+    def test_fleet(self):
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('main')
+        config.set('main', 'guest-manager-interval', '5')
+        config.set('main', 'guest-collector-threads', '0')
+        config.set('main', 'guest-collector-events', 'false')
+        config.add_section('__int__')
+        config.set('__int__', 'running', '0')
+        manager = GuestManager(config, HypervisorInterface())
+        manager.join()
+        manager.guests = {2: make_monitor('guest2', 2, fields=2),
+                          1: make_monitor('guest1', 1, fields=1),
+                          3: make_monitor('guest3', 0)}
+        manager.guests[3].ready = False
+        manager.guests[3]._publish(['data'])
+
+        fleet = manager.snapshot()
+        self.assertEqual(fleet.ids, (1, 2))
+        self.assertEqual(fleet.fields, ('field0', 'field1'))
+        self.assertEqual(fleet.columns, {'field0': [0, 1],
+                                         'field1': [None, 1]})
+        self.assertEqual([p['name'] for p in fleet.properties],
+                         ['guest1', 'guest2'])
+        self.assertEqual(manager.get_last_data(),
+                         {1: [], 2: [], 3: ['data']})
+        entities = manager.interrogate()
+        self.assertEqual(sorted(entities), [1, 2])
+        self.assertEqual(entities[2].field1, 1)
+
+        # Reused until a guest publishes again
+        self.assertTrue(manager.snapshot() is fleet)
+        manager.guests[1].update_statistics_variable('field0', 5)
+        fleet = manager.snapshot()
+        self.assertEqual(fleet.columns['field0'], [5, 1])
+        self.assertTrue(manager.snapshot() is fleet)
+        manager.guests[3].ready = True
+        self.assertEqual(manager.snapshot().ids, (1, 2, 3))
+        del manager.guests[3]
+        self.assertEqual(manager.snapshot().ids, (1, 2))
+
+    def test_stress(self):
+        monitors = []
+        for i in xrange(8):
+            monitor = make_monitor('guest%i' % i, 0, history=5)
+            monitor.collectors = [CountingCollector({})]
+            monitors.append(monitor)
+        stop = threading.Event()
+        errors = []
+        reads = [0]
+        updates = [0]
+
+        def write(monitor):
+            while not stop.is_set():
+                sample = monitor.collect()
+                # Like a policy calling UpdateStatVal
+                monitor.update_statistics_variable('b', -sample['b'])
+
+        def policy():
+            while not stop.is_set():
+                for monitor in monitors:
+                    entity = monitor.interrogate()
+                    if entity is None or len(entity.statistics) == 0:
+                        continue
+                    # The Monitor may have collected again since
+                    rows = list(entity.statistics)
+                    rows[-1]['c'] = entity.a
+                    entity.UpdateStatVal('c', entity.a)
+                    if list(entity.statistics) != rows:
+                        errors.append(rows)
+                    updates[0] += 1
+
+        def read():
+            generations = {}
+            entities = []
+            while not stop.is_set():
+                # Entities never change
+                for entity, rows in entities:
+                    if list(entity.statistics) != rows:
+                        errors.append(rows)
+                entities = []
+                for monitor in monitors:
+                    generation = monitor.published.generation
+                    entity = monitor.interrogate()
+                    if entity is None or len(entity.statistics) == 0:
+                        continue
+                    a = entity.statistics.values('a')
+                    b = [-value for value in entity.statistics.values('b')]
+                    expected = range(a[-1] - len(a) + 1, a[-1] + 1)
+                    # Only the latest sample may not be updated yet
+                    if a != expected or b[:-1] != a[:-1] or \
+                            abs(b[-1]) != a[-1] or len(a) > 5 or \
+                            entity.a != a[-1] or \
+                            any(row.get('c', 0) > row['a']
+                                for row in entity.statistics) or \
+                            generation < generations.get(monitor, 0):
+                        errors.append(list(entity.statistics))
+                    generations[monitor] = generation
+                    entities.append((entity, list(entity.statistics)))
+                    reads[0] += 1
+
+        threads = [threading.Thread(target=write, args=(writer,))
+                   for writer in monitors]
+        threads += [threading.Thread(target=read) for i in xrange(4)]
+        threads.append(threading.Thread(target=policy))
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(reads[0] > 0)
+        self.assertTrue(updates[0] > 0)
+        self.assertTrue(all(monitor.published.generation > 0
+                            for monitor in monitors))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# Memory Overcommitment Manager
+# Copyright (C) 2010 Adam Litke, IBM Corporation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import os
+import random
+import unittest
+from mom.Entity import Entity
+from mom.Policy import Parser
+from mom.Policy import Vector
+
+BALLOON_POLICY = """
+(defvar min_guest_free_percent 0.20)
+(defvar max_balloon_change_percent 0.05)
+
+(def change_big_enough (guest new_val)
+    (if (> (abs (- new_val guest.balloon_cur)) (* 0.0025 guest.balloon_cur))
+        1 0))
+
+(def shrink_guest (guest) {
+    (defvar guest_used_mem (- (guest.StatAvg "balloon_cur")
+                              (guest.StatAvg "mem_unused")))
+    (defvar balloon_min (max guest.balloon_min (+ guest_used_mem
+                           (* min_guest_free_percent guest.balloon_cur))))
+    (defvar balloon_size (* guest.balloon_cur
+                            (- 1 max_balloon_change_percent)))
+    (if (< balloon_size balloon_min)
+        (set balloon_size balloon_min)
+        0)
+    (debug "balloon_size" balloon_size)
+    (if (and (<= balloon_size guest.balloon_cur)
+             (change_big_enough guest balloon_size))
+        (guest.Control "balloon_target" balloon_size)
+        0)
+})
+
+(with Guests guest (shrink_guest guest))
+"""
+
+
+class RecordingMonitor(object):
+    """
+    Record the statistics updated through the Entities of a guest
+    """
+    def __init__(self, name):
+        self.name = name
+        self.updates = []
+
+    def update_statistics_variable(self, name, value):
+        self.updates.append((name, value))
+
+
+def make_guests(count, seed, mixed=True):
+    """
+    Build guests holding integer statistics like the collectors report them,
+    or a mix of integer and floating point ones if 'mixed' is set.
+    """
+    rnd = random.Random(seed)
+
+    def sample():
+        if mixed and rnd.randint(0, 1):
+            return rnd.uniform(0, 2048)
+        return rnd.randint(0, 2048)
+    guests = []
+    for i in xrange(count):
+        guest = Entity()
+        balloon_min = rnd.choice([0, 256, 512])
+        guest._set_statistics([{'balloon_cur': sample(),
+                                'mem_unused': sample(),
+                                'balloon_min': balloon_min,
+                                'balloon_max': 2048}
+                               for j in xrange(3)])
+        guest._finalize()
+        guest.monitor = RecordingMonitor('guest%i' % i)
+        guests.append(guest)
+    return guests
+
+
+@unittest.skipIf(not Vector.available(), "NumPy is not available")
+class TestVector(unittest.TestCase):
+    def setUp(self):
+        # Bodies printing debug output are not vectorized
+        self.logger = logging.getLogger('mom.Evaluator')
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        # Whether each (with Guests ...) statement was vectorized
+        self.vectorized = []
+
+    def tearDown(self):
+        self.logger.setLevel(self.level)
+
+    def evaluate(self, pol, guests, vectorize, host=None):
+        e = Parser.Evaluator()
+        e.stack.set('Host', host, True)
+        e.stack.set('Guests', guests, True)
+        if vectorize:
+            def evaluate(*args):
+                result = Vector.evaluate(*args)
+                self.vectorized.append(result is not None)
+                return result
+            e.vectorize = evaluate
+        return Parser.eval(e, pol)
+
+    def verify(self, pol, seed=0, count=50, mixed=True, host=None):
+        scalar_guests = make_guests(count, seed, mixed)
+        vector_guests = make_guests(count, seed, mixed)
+        expected = self.evaluate(pol, scalar_guests, False, host)
+        results = self.evaluate(pol, vector_guests, True, host)
+        self.assertEqual(results, expected)
+        # Results of the same type, not only equal ones
+        self.assertEqual(repr(results), repr(expected))
+        self.assertEqual([g.controls for g in vector_guests],
+                         [g.controls for g in scalar_guests])
+        self.assertEqual([g.monitor.updates for g in vector_guests],
+                         [g.monitor.updates for g in scalar_guests])
+        self.assertEqual([list(g.statistics) for g in vector_guests],
+                         [list(g.statistics) for g in scalar_guests])
+        return results
+
+    def test_balloon(self):
+        for seed in xrange(5):
+            self.verify(BALLOON_POLICY, seed)
+        self.verify(BALLOON_POLICY, mixed=False)
+
+    def test_shipped_policy(self):
+        fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'rules', '40_mom.policy')
+        with open(fname, 'r') as f:
+            pol = f.read()
+        # With the host under memory pressure or not
+        for mem_free in (200, 1800):
+            host = Entity()
+            host._set_statistics([{'mem_free': mem_free,
+                                   'mem_available': 2048}])
+            host._finalize()
+            for seed in xrange(3):
+                self.vectorized = []
+                self.verify(pol, seed, host=host)
+                self.assertEqual(self.vectorized, [True])
+
+    def test_vectorized(self):
+        guests = make_guests(10, 0)
+        e = Parser.Evaluator()
+        e.stack.set('Guests', guests, True)
+        Parser.eval(e, BALLOON_POLICY)
+        code = Parser.get_code(e, '(shrink_guest guest)')[0]
+        state = {}
+        results = Vector.evaluate(e, 'guest', guests, code, state)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(state, {})
+
+    def test_branches(self):
+        pol = """
+        (def ratio (a b) (/ a b))
+        (with Guests guest {
+            (if (> guest.mem_unused 100)
+                (defvar x (ratio guest.balloon_cur guest.mem_unused))
+                0)
+            (defvar x -1)                   # only bound for the other guests
+            (let ((a (<< guest.balloon_min 2)) (b (>> a 1)))
+                (or (or (and (> x 1) a) b) (not x)))
+        })
+        (with Guests guest
+            (min (+ 1 guest.balloon_min) (/ guest.mem_unused 3) 100))
+        (with Guests guest (if (> guest.balloon_cur 1024) "big" 1))
+        """
+        for seed in xrange(5):
+            self.verify(pol, seed)
+
+    def test_integers(self):
+        pol = """
+        (with Guests guest
+            (/ (* guest.balloon_min 3) (+ (- 2 (< 1 guest.balloon_min)) 5)))
+        (with Guests guest (* (* guest.balloon_min 0x100000) 0x100000))
+        (with Guests guest (+ (> guest.balloon_min 1) (> guest.balloon_min 1)))
+        """
+        for seed in xrange(5):
+            self.verify(pol, seed)
+
+    def test_fallback(self):
+        pol = """
+        (with Guests guest (guest.SetVar "a" 1))
+        (with Guests guest (/ 1 guest.balloon_min))
+        """
+        guests = make_guests(10, 0)
+        self.assertRaises(ZeroDivisionError, self.evaluate, pol, guests, True)
+        self.assertEqual([g.variables for g in guests], [{'a': 1}] * 10)
+
+        # Unsupported code is not tried again
+        e = Parser.Evaluator()
+        code = Parser.get_code(e, '(guest.SetVar "a" 2)')[0]
+        state = {}
+        self.assertEqual(Vector.evaluate(e, 'guest', guests, code, state),
+                         None)
+        self.assertEqual(state, {'unsupported': {}})
+        self.assertEqual([g.variables for g in guests], [{'a': 1}] * 10)
+
+        # Changes made before the unsupported code are only made once
+        pol = """
+        (with Guests guest {
+            (guest.UpdateStatVal "a" (+ (guest.StatAvg "a") 1))
+            (guest.Control "a" (guest.StatAvg "a"))
+            (guest.SetVar "a" 3)
+        })
+        """
+        self.vectorized = []
+        self.verify(pol)
+        self.assertEqual(self.vectorized, [False])
+
+
+if __name__ == '__main__':
+    unittest.main()